@@ -1,4 +1,4 @@
-from Emall.base_redis import manager_redis
+from Emall.base_redis import manager_redis, redis_pipeline
 from Emall.celery_app import app as celery_apps
 
-__all__ = ['celery_apps','manager_redis']
\ No newline at end of file
+__all__ = ['celery_apps', 'manager_redis', 'redis_pipeline']
\ No newline at end of file
@@ -4,8 +4,15 @@
 # @File : base_redis.py
 # @Software: PyCharm
 import contextlib
+import json
+import math
+import random
+import threading
+import time
+import uuid
 
-from django_redis import get_redis_connection
+from Emall.json_serializer import JsonCustomEncoder
+from Emall.redis_pool import connection_manager
 from Emall.settings import REDIS_SECRET
 from Emall.loggings import Logging
 
@@ -14,7 +21,18 @@ common_logger = Logging.logger('django')
 
 class BaseRedis:
     _instance = {}
-    _redis_instances = {}
+    _lock = threading.Lock()
+
+    # 只删除自己持有的锁
+    # KEYS[1]:锁  ARGV[1]:持有者token
+    UNLOCK_SCRIPT = """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        return redis.call('DEL', KEYS[1])
+    end
+    return 0
+    """
+
+    FLIGHT_WAIT_INTERVAL = 0.05  # 未拿到重建锁时轮询缓存的间隔
 
     def __init__(self, db, redis):
         self.db = db  # 选择配置中哪一种的数据库
@@ -25,12 +43,17 @@ class BaseRedis:
         """
         选择配置中指定的数据库
         单例模式，减小new实例的大量创建的次数，减少内存等资源的消耗（打开和关闭连接），共享同一个资源
+        每个(操作类, 数据库)一个实例，同一个类可以同时操作多个数据库
         """
-
-        if not cls._instance.setdefault(cls.__name__, None):
-            cls._redis_instances[db] = get_redis_connection(db)  # redis实例
-            cls._instance[cls.__name__] = cls(db, cls._redis_instances[db])  # 自定义操作类实例
-        return cls._instance[cls.__name__]
+        key = (cls.__name__, db)
+        instance = cls._instance.get(key)
+        if instance is None:
+            with cls._lock:
+                instance = cls._instance.get(key)
+                if instance is None:
+                    # 自定义操作类实例，redis客户端由连接管理器按数据库共享连接池
+                    instance = cls._instance[key] = cls(db, connection_manager.get_client(db))
+        return instance
 
     @property
     def redis(self):
@@ -55,6 +78,14 @@ class BaseRedis:
         # return make_password('-'.join(keywords), salt=self.salt)   # 加密贼耗时
         return '-'.join(keywords)
 
+    @staticmethod
+    def tag(value):
+        """
+        哈希标签，分片时标签相同的键落在同一节点，lua脚本和事务涉及的多个键需使用相同的标签
+        :return: str  {value}
+        """
+        return '{%s}' % value
+
     def check_code(self, key, value):
         """
         检查value是否和redis中key映射的value对应？
@@ -96,7 +127,7 @@ class BaseRedis:
         with manager_redis(self.db) as redis:
             if redis is None:
                 return False
-            redis.ttl(key)
+            return redis.ttl(key)
 
     @staticmethod
     def get_client_ip(request):
@@ -108,15 +139,128 @@ class BaseRedis:
            ip = request.META.get('REMOTE_ADDR')   # 代理IP,如果没有代理,也是真实IP
         return ip
 
+    @property
+    def unlock_script(self):
+        script = self.__dict__.get('_unlock_script')
+        if script is None:
+            script = self._unlock_script = self.redis.register_script(self.UNLOCK_SCRIPT)
+        return script
+
+    @contextlib.contextmanager
+    def single_flight(self, key, lock_seconds=5):
+        """
+        单飞锁，同一时刻只有一个请求重建key对应的缓存，锁超时自动释放，防止持有者宕机
+        with self.single_flight(key) as acquired:
+            if acquired:
+                重建缓存
+        :return: bool 是否拿到锁
+        """
+        lock_key = self.key(key, 'lock')  # 保留key中的哈希标签，与缓存落在同一节点
+        token = uuid.uuid4().hex
+        acquired = self.redis.set(lock_key, token, ex=lock_seconds, nx=True)
+        try:
+            yield bool(acquired)
+        finally:
+            if acquired:
+                self.unlock_script(keys=[lock_key], args=[token])
+
+    @staticmethod
+    def xfetch(ttl_ms, delta_ms, beta=1.0):
+        """
+        XFetch概率提前刷新，剩余有效期越短、重建越慢，越可能在过期前由某一个请求提前重建
+        :param ttl_ms: 缓存剩余有效期(毫秒)，PTTL的返回值
+        :param delta_ms: 上次重建耗时(毫秒)
+        :param beta: 大于1更倾向提前刷新
+        :return: bool
+        """
+        if ttl_ms is None or ttl_ms < 0 or not delta_ms:
+            return False
+        return -delta_ms * beta * math.log(1 - random.random()) >= ttl_ms
+
+    def _get_flight_value(self, key):
+        """读取缓存值和剩余有效期，未命中返回None, None"""
+        with self.redis.pipeline(transaction=False) as pipe:
+            pipe.get(key)
+            pipe.pttl(key)
+            value, ttl_ms = pipe.execute()
+        return (json.loads(value), ttl_ms) if value is not None else (None, None)
+
+    def _set_flight_value(self, key, compute, ttl, empty_ttl):
+        """回源并写入缓存，同时记录回源耗时供XFetch使用"""
+        start = time.perf_counter()
+        value = compute()
+        delta_ms = int((time.perf_counter() - start) * 1000)
+        expire = empty_ttl if empty_ttl is not None and not value else ttl
+        self.redis.set(key, json.dumps({'value': value, 'delta': delta_ms}, cls=JsonCustomEncoder), ex=expire)
+        return value
+
+    def get_or_compute(self, key, compute, ttl, empty_ttl=None, beta=1.0, lock_seconds=5, wait_seconds=1):
+        """
+        防击穿的读缓存
+        命中：未触发提前刷新直接返回，触发时只有拿到锁的请求回源，其余请求继续返回旧值
+        未命中：只有拿到锁的请求回源，其余请求轮询等待其写入，超过wait_seconds仍未写入则自行回源且不写缓存
+        :param key: 缓存的键，值以JSON存储
+        :param compute: 回源函数，返回可JSON序列化的值
+        :param ttl: 缓存秒数
+        :param empty_ttl: 空结果的缓存秒数(负缓存)，None表示与ttl相同
+        :return: 缓存值或回源结果
+        """
+        cached, ttl_ms = self._get_flight_value(key)
+        if cached is not None:
+            if not self.xfetch(ttl_ms, cached['delta'], beta):
+                return cached['value']
+            with self.single_flight(key, lock_seconds) as acquired:
+                if acquired:
+                    return self._set_flight_value(key, compute, ttl, empty_ttl)
+            return cached['value']
+        deadline = time.time() + wait_seconds
+        while True:
+            with self.single_flight(key, lock_seconds) as acquired:
+                if acquired:
+                    cached, _ = self._get_flight_value(key)  # 拿到锁之前可能已被其他请求写入
+                    if cached is not None:
+                        return cached['value']
+                    return self._set_flight_value(key, compute, ttl, empty_ttl)
+            if time.time() >= deadline:
+                return compute()
+            time.sleep(self.FLIGHT_WAIT_INTERVAL)
+            cached, _ = self._get_flight_value(key)
+            if cached is not None:
+                return cached['value']
+
+    @contextlib.contextmanager
+    def pipeline(self, transaction=True):
+        """
+        管道上下文，退出时一次发送所有命令，发生异常则丢弃
+        with self.pipeline() as pipe:
+            pipe.set(...)
+        """
+        with self.redis.pipeline(transaction=transaction) as pipe:
+            yield pipe
+            pipe.execute()
 
 
 @contextlib.contextmanager
-def manager_redis(db, redis_class=BaseRedis, redis=None):
+def manager_redis(db, redis_class=BaseRedis):
+    """
+    获取指定数据库的redis客户端
+    连接由连接池管理，每条命令执行完毕即归还，不需要也不应该close
+    异常记录日志后继续抛出，由调用方决定如何处理
+    """
     try:
-        # redis = get_redis_connection(db)  # redis实例链接
-        redis = redis_class.choice_redis_db(db).redis
-        yield redis
+        yield redis_class.choice_redis_db(db).redis
     except Exception as e:
-        common_logger.info(e)
-    finally:
-        redis.close()  # 其实可以不要,除非single client connection, 每条执行执行完都会调用conn.release()
\ No newline at end of file
+        common_logger.error(e)
+        raise
+
+
+@contextlib.contextmanager
+def redis_pipeline(db, transaction=True):
+    """
+    指定数据库的管道上下文，transaction=True时以MULTI/EXEC原子执行
+    with redis_pipeline('redis') as pipe:
+        pipe.incr(...)
+    """
+    with connection_manager.get_client(db).pipeline(transaction=transaction) as pipe:
+        yield pipe
+        pipe.execute()
\ No newline at end of file
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+# @Time  : 2020/11/22 下午3:05
+# @Author : 司云中
+# @File : redis_pool.py
+# @Software: Pycharm
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+import redis
+from django.conf import settings
+from redis.client import Pipeline
+
+from Emall.redis_shard import DEFAULT_SHARDING_OPTIONS, ShardedRedis, node_name
+
+# 延迟直方图的桶(毫秒)
+LATENCY_BUCKETS = (0.5, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+# 连接池默认参数，可在settings.REDIS_POOL_OPTIONS中按别名覆盖
+DEFAULT_POOL_OPTIONS = {
+    'max_connections': 64,  # 每个进程每个库的最大连接数，uwsgi每个进程8个线程，留足余量
+    'timeout': 5,  # 连接耗尽时等待空闲连接的最长时间
+    'health_check_interval': 30,  # 连接空闲超过该秒数，使用前先PING检查
+    'socket_timeout': 5,
+    'socket_connect_timeout': 3,
+    'retry_on_timeout': True,
+}
+
+
+class Histogram:
+    """固定桶的延迟直方图，线程安全"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        """记录一次耗时(毫秒)"""
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def snapshot(self):
+        with self._lock:
+            counts, total = list(self._counts), self._sum
+        count = sum(counts)
+        buckets = {'<={}ms'.format(bound): value for bound, value in zip(self.buckets, counts)}
+        buckets['+Inf'] = counts[-1]
+        return {'buckets': buckets, 'count': count, 'sum_ms': round(total, 3),
+                'avg_ms': round(total / count, 3) if count else 0}
+
+
+class PoolMetrics:
+    """单个连接池的指标：使用中的连接数、获取连接的等待时间、命令耗时"""
+
+    def __init__(self):
+        self.in_use = 0
+        self.max_in_use = 0
+        self.errors = 0  # 获取连接失败的次数(等待超时或连接失败)
+        self.wait = Histogram()
+        self.command = Histogram()
+        self._lock = threading.Lock()
+
+    def acquired(self, wait_ms):
+        self.wait.observe(wait_ms)
+        with self._lock:
+            self.in_use += 1
+            self.max_in_use = max(self.max_in_use, self.in_use)
+
+    def released(self):
+        with self._lock:
+            self.in_use = max(self.in_use - 1, 0)
+
+    def reset(self):
+        with self._lock:
+            self.in_use = 0
+
+    def snapshot(self):
+        return {
+            'in_use': self.in_use,
+            'max_in_use': self.max_in_use,
+            'errors': self.errors,
+            'wait': self.wait.snapshot(),
+            'command': self.command.snapshot(),
+        }
+
+
+class InstrumentedConnectionPool(redis.BlockingConnectionPool):
+    """
+    带指标的阻塞连接池
+    连接数达到上限时等待空闲连接而不是无限创建，等待超时抛出ConnectionError
+    """
+
+    def __init__(self, metrics=None, **kwargs):
+        self.metrics = metrics or PoolMetrics()  # reset()会在父类__init__中被调用，需先创建
+        super().__init__(**kwargs)
+
+    def reset(self):
+        """fork后子进程重建连接池，计数随之清零"""
+        super().reset()
+        self.metrics.reset()
+
+    def get_connection(self, command_name, *keys, **options):
+        start = time.perf_counter()
+        try:
+            connection = super().get_connection(command_name, *keys, **options)
+        except redis.ConnectionError:
+            self.metrics.errors += 1
+            raise
+        self.metrics.acquired((time.perf_counter() - start) * 1000)
+        return connection
+
+    def release(self, connection):
+        super().release(connection)
+        self.metrics.released()
+
+
+class InstrumentedPipeline(Pipeline):
+    """记录整个pipeline执行耗时"""
+
+    def execute(self, raise_on_error=True):
+        start = time.perf_counter()
+        try:
+            return super().execute(raise_on_error)
+        finally:
+            self.connection_pool.metrics.command.observe((time.perf_counter() - start) * 1000)
+
+
+class InstrumentedRedis(redis.Redis):
+    """记录每条命令耗时的客户端"""
+
+    def execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            return super().execute_command(*args, **options)
+        finally:
+            self.connection_pool.metrics.command.observe((time.perf_counter() - start) * 1000)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+class RedisConnectionManager:
+    """
+    redis连接管理
+    按(别名, 库)创建独立的连接池，地址和密码读取settings.CACHES，连接池参数读取settings.REDIS_POOL_OPTIONS
+    同一进程内共享连接池，客户端用完即归还连接，无需手动close
+    settings.REDIS_SHARDING中列出且配置了多个节点的别名返回ShardedRedis，每个节点一个连接池
+    """
+
+    def __init__(self):
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def pool_options(alias):
+        """连接池参数：默认参数 <- default <- 别名"""
+        options = dict(DEFAULT_POOL_OPTIONS)
+        overrides = getattr(settings, 'REDIS_POOL_OPTIONS', {})
+        options.update(overrides.get('default', {}))
+        options.update(overrides.get(alias, {}))
+        return options
+
+    @staticmethod
+    def sharding_options(alias):
+        """分片参数：默认参数 <- default <- 别名，别名未开启分片返回None"""
+        sharding = getattr(settings, 'REDIS_SHARDING', {})
+        if alias == 'default' or alias not in sharding:
+            return None
+        options = dict(DEFAULT_SHARDING_OPTIONS)
+        options.update(sharding.get('default', {}))
+        options.update(sharding[alias])
+        return options
+
+    @staticmethod
+    def locations(alias):
+        """别名配置的所有节点地址"""
+        location = settings.CACHES[alias]['LOCATION']
+        return [location] if isinstance(location, str) else list(location)
+
+    def create_pool(self, location, alias, db=None):
+        """创建连接池，db为None时使用地址中的库"""
+        if db is not None:
+            location = urlparse(location)._replace(path='/{}'.format(db)).geturl()
+        options = self.pool_options(alias)
+        password = settings.CACHES[alias].get('OPTIONS', {}).get('PASSWORD')
+        if password:
+            options.setdefault('password', password)
+        return InstrumentedConnectionPool.from_url(location, **options)
+
+    def create_client(self, alias, db=None):
+        """单节点返回InstrumentedRedis，开启分片的多节点返回ShardedRedis"""
+        locations = self.locations(alias)
+        options = self.sharding_options(alias)
+        if options is None or len(locations) == 1:
+            return InstrumentedRedis(connection_pool=self.create_pool(locations[0], alias, db))
+        nodes = OrderedDict((node_name(location),
+                             InstrumentedRedis(connection_pool=self.create_pool(location, alias, db)))
+                            for location in locations)
+        return ShardedRedis(nodes, **options)
+
+    def get_client(self, alias, db=None):
+        """
+        获取指定别名和库的客户端，同一(别名, 库)只创建一次连接池
+        :param alias: settings.CACHES中的别名
+        :param db: 库，None表示使用配置中的库
+        :return: InstrumentedRedis or ShardedRedis
+        """
+        key = (alias, db)
+        client = self._clients.get(key)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(key)
+                if client is None:
+                    client = self._clients[key] = self.create_client(alias, db)
+        return client
+
+    def pools(self):
+        """
+        所有已创建的单节点客户端，分片客户端展开为各个节点
+        :return: generator  ('alias/db' 或 'alias/db/host:port', InstrumentedRedis)
+        """
+        for (alias, db), client in list(self._clients.items()):
+            name = '{}/{}'.format(alias, 'default' if db is None else db)
+            if isinstance(client, ShardedRedis):
+                for node, node_client in client.nodes.items():
+                    yield '{}/{}'.format(name, node), node_client
+            else:
+                yield name, client
+
+    def metrics(self):
+        """
+        所有连接池的指标
+        :return: dict  {'alias/db': {...}}
+        """
+        return {name: client.connection_pool.metrics.snapshot() for name, client in self.pools()}
+
+    def health_check(self):
+        """PING所有已创建的连接池，返回 {'alias/db': bool}"""
+        result = {}
+        for name, client in self.pools():
+            try:
+                result[name] = client.ping()
+            except redis.RedisError:
+                result[name] = False
+        return result
+
+
+connection_manager = RedisConnectionManager()
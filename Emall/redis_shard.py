@@ -0,0 +1,466 @@
+# -*- coding: utf-8 -*-
+# @Time  : 2020/11/23 上午10:12
+# @Author : 司云中
+# @File : redis_shard.py
+# @Software: Pycharm
+import bisect
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+import redis
+from django_redis.client import ShardClient as DjangoShardClient
+from redis.client import CaseInsensitiveDict
+from redis.exceptions import NoScriptError
+
+from Emall.loggings import Logging
+
+common_logger = Logging.logger('django')
+
+REPLICAS = 160  # 每个节点在哈希环上的虚拟节点数，业务客户端和django缓存使用相同的值，同一个键落在同一节点
+
+# 分片参数默认值，可在settings.REDIS_SHARDING中按别名覆盖
+DEFAULT_SHARDING_OPTIONS = {
+    'failover': True,  # 节点故障时是否把该节点的键改写到哈希环上的下一个节点
+    'retry_seconds': 30,  # 节点被标记故障后，间隔多少秒再探测一次
+}
+
+# 按节点拆分执行再合并结果的多键命令
+SPLIT_COMMANDS = {'DEL', 'UNLINK', 'EXISTS', 'TOUCH', 'MGET'}
+
+# 在所有节点上执行的无键命令
+BROADCAST_COMMANDS = {'PING', 'SCRIPT LOAD', 'SCRIPT FLUSH', 'FLUSHDB', 'FLUSHALL'}
+
+# 在所有节点上执行并合并结果的命令
+GATHER_COMMANDS = {'KEYS', 'DBSIZE'}
+
+# 结果只对单个节点有意义的命令，无法路由也无法合并，需通过nodes[节点名]直接执行
+NODE_COMMANDS = {'RANDOMKEY', 'SCAN', 'INFO', 'TIME', 'LASTSAVE', 'SAVE', 'BGSAVE', 'BGREWRITEAOF',
+                 'CONFIG GET', 'CONFIG SET', 'CONFIG RESETSTAT', 'CLIENT LIST', 'SLOWLOG GET', 'MEMORY STATS'}
+
+# 不拆分执行的多键命令，所有键必须在同一节点，按参数的位置分类
+ALL_KEYS_COMMANDS = {'SUNION', 'SINTER', 'SDIFF', 'SUNIONSTORE', 'SINTERSTORE', 'SDIFFSTORE',
+                     'PFCOUNT', 'PFMERGE', 'WATCH'}  # 所有参数都是键
+TWO_KEYS_COMMANDS = {'RENAME', 'RENAMENX', 'SMOVE', 'RPOPLPUSH', 'BRPOPLPUSH', 'LMOVE', 'BLMOVE',
+                     'COPY'}  # 前两个参数是键
+BLOCKING_COMMANDS = {'BLPOP', 'BRPOP', 'BZPOPMIN', 'BZPOPMAX'}  # 除最后的超时时间外都是键
+NUMKEYS_STORE_COMMANDS = {'ZUNIONSTORE', 'ZINTERSTORE', 'ZDIFFSTORE'}  # destination numkeys key...
+NUMKEYS_COMMANDS = {'ZUNION', 'ZINTER', 'ZDIFF'}  # numkeys key...
+PAIRS_COMMANDS = {'MSET', 'MSETNX'}  # key value key value...
+
+
+class CrossShardError(redis.RedisError):
+    """多键命令的键不在同一节点，需要使用哈希标签"""
+
+
+def hash_tag(key):
+    """
+    键的哈希标签，规则与redis cluster一致
+    键中包含{...}且括号内不为空时只对括号内的部分求哈希，例如Cart-{5}和Cart-{5}-loaded落在同一节点
+    """
+    if isinstance(key, bytes):
+        key = key.decode()
+    else:
+        key = str(key)
+    start = key.find('{')
+    if start != -1:
+        end = key.find('}', start + 1)
+        if end > start + 1:
+            return key[start + 1:end]
+    return key
+
+
+def node_name(location):
+    """节点名 host:port，同一台redis的不同库属于同一个节点"""
+    parsed = urlparse(location)
+    return '{}:{}'.format(parsed.hostname, parsed.port or 6379)
+
+
+class HashRing:
+    """一致性哈希环，节点故障时只有该节点上的键改写到下一个节点"""
+
+    def __init__(self, nodes, replicas=REPLICAS):
+        self.nodes = list(nodes)
+        self._points = []
+        self._owners = []
+        ring = sorted((self.hash('{}-{}'.format(node, i)), node) for node in self.nodes for i in range(replicas))
+        for point, node in ring:
+            self._points.append(point)
+            self._owners.append(node)
+
+    @staticmethod
+    def hash(value):
+        return int(hashlib.md5(value.encode()).hexdigest()[:8], 16)
+
+    def get_node(self, key, available=None):
+        """
+        顺时针查找第一个可用的节点
+        :param key: 键(已提取哈希标签)
+        :param available: 判断节点是否可用的函数，None表示不检查
+        :return: 节点名，没有可用节点返回None
+        """
+        if not self._points:
+            return None
+        index = bisect.bisect(self._points, self.hash(key))
+        checked = set()
+        for offset in range(len(self._points)):
+            node = self._owners[(index + offset) % len(self._points)]
+            if node in checked:
+                continue
+            if available is None or available(node):
+                return node
+            checked.add(node)
+            if len(checked) == len(self.nodes):
+                break
+        return None
+
+
+class NodeHealth:
+    """
+    节点健康状态，进程内所有分片客户端共享
+    命令在某个节点上发生连接错误时标记为故障，retry_seconds之后由一次请求PING探测，探测成功则恢复
+    """
+
+    def __init__(self):
+        self._retry_at = {}  # 节点 -> 下次探测时间
+        self._lock = threading.Lock()
+
+    def mark_failed(self, node, retry_seconds):
+        with self._lock:
+            self._retry_at[node] = time.time() + retry_seconds
+        common_logger.error('redis node {} marked as failed'.format(node))
+
+    def mark_alive(self, node):
+        with self._lock:
+            self._retry_at.pop(node, None)
+
+    def available(self, node, probe=None, retry_seconds=DEFAULT_SHARDING_OPTIONS['retry_seconds']):
+        """
+        :param probe: 探测函数probe(node) -> bool
+        """
+        retry_at = self._retry_at.get(node)
+        if retry_at is None:
+            return True
+        if probe is None or time.time() < retry_at:
+            return False
+        with self._lock:
+            if self._retry_at.get(node) != retry_at:  # 其他线程已在探测
+                return False
+            self._retry_at[node] = time.time() + retry_seconds
+        if probe(node):
+            self.mark_alive(node)
+            common_logger.info('redis node {} recovered'.format(node))
+            return True
+        return False
+
+    def failed_nodes(self):
+        return list(self._retry_at)
+
+
+node_health = NodeHealth()
+
+
+class ShardedScript:
+    """分片客户端的lua脚本，按KEYS路由，脚本的所有键必须在同一节点"""
+
+    def __init__(self, registered_client, script):
+        self.registered_client = registered_client
+        self.script = script
+        self.sha = hashlib.sha1(script.encode() if isinstance(script, str) else script).hexdigest()
+
+    def __call__(self, keys=[], args=[], client=None):
+        if client is None:
+            client = self.registered_client
+        args = tuple(keys) + tuple(args)
+        if isinstance(client, ShardedPipeline):  # 管道中无法处理NOSCRIPT，直接发送脚本
+            return client.eval(self.script, len(keys), *args)
+        try:
+            return client.evalsha(self.sha, len(keys), *args)
+        except NoScriptError:  # 节点首次执行或故障转移到了新节点
+            client.node_client(keys).script_load(self.script)
+            return client.evalsha(self.sha, len(keys), *args)
+
+
+class ShardedRedis(redis.Redis):
+    """
+    客户端分片的redis
+    按键的哈希标签在一致性哈希环上选择节点，命令原样交给该节点的客户端执行，各节点有独立的连接池
+    DEL/EXISTS/MGET等多键命令按节点拆分后合并结果，其他多键命令和lua脚本的键必须使用相同的哈希标签，
+    否则抛出CrossShardError，不会按第一个键路由后在错误的节点上执行
+    KEYS/DBSIZE在所有节点上执行后合并，RANDOMKEY/INFO等单节点命令直接报错，不会按参数猜测节点
+
+    failover为True时，节点连接失败会被标记为故障并立即在下一个节点重试，故障期间该节点的键改写到其他节点
+    节点恢复后这些键回到原节点，故障期间写入的数据留在其他节点，只适合可从数据库重建的缓存数据
+    """
+
+    def __init__(self, nodes, failover=True, retry_seconds=30):
+        """
+        父类的连接池不会被使用，因此不调用父类__init__
+        :param nodes: OrderedDict  节点名 -> redis客户端
+        """
+        self.nodes = nodes
+        self.ring = HashRing(nodes)
+        self.failover = failover
+        self.retry_seconds = retry_seconds
+        self.connection = None
+        self.response_callbacks = CaseInsensitiveDict(self.__class__.RESPONSE_CALLBACKS)
+
+    def __repr__(self):
+        return '{}<{}>'.format(type(self).__name__, ', '.join(self.nodes))
+
+    def close(self):
+        """连接由各节点的连接池管理"""
+
+    def _available(self, node):
+        return node_health.available(node, self._probe, self.retry_seconds)
+
+    def _probe(self, node):
+        try:
+            return self.nodes[node].ping()
+        except redis.RedisError:
+            return False
+
+    def node_for_key(self, key):
+        """键所在的节点名"""
+        node = self.ring.get_node(hash_tag(key), self._available if self.failover else None)
+        if node is None:
+            raise redis.ConnectionError('all redis nodes are down: {}'.format(', '.join(self.nodes)))
+        return node
+
+    def node_for_keys(self, keys):
+        """多个键所在的节点名，键不在同一节点时抛出CrossShardError"""
+        if not keys:
+            raise redis.RedisError('sharded redis can not route a command without keys')
+        nodes = {self.node_for_key(key) for key in keys}
+        if len(nodes) > 1:
+            raise CrossShardError('keys {} are on different nodes, use a hash tag'.format(list(keys)))
+        return nodes.pop()
+
+    def node_client(self, keys):
+        """多个键所在节点的客户端"""
+        return self.nodes[self.node_for_keys(keys)]
+
+    def group_keys(self, keys):
+        """
+        按节点分组
+        :return: OrderedDict  节点名 -> [(原位置, 键), ...]
+        """
+        groups = OrderedDict()
+        for index, key in enumerate(keys):
+            groups.setdefault(self.node_for_key(key), []).append((index, key))
+        return groups
+
+    @staticmethod
+    def command_keys(args):
+        """命令中的键，多键命令返回全部的键，由node_for_keys检查是否在同一节点"""
+        command = args[0].upper()
+        if command in ('EVAL', 'EVALSHA'):
+            return args[3:3 + int(args[2])]
+        if command in ALL_KEYS_COMMANDS:
+            return args[1:]
+        if command in TWO_KEYS_COMMANDS:
+            return args[1:3]
+        if command in BLOCKING_COMMANDS:
+            return args[1:-1]
+        if command in NUMKEYS_STORE_COMMANDS:
+            return args[1:2] + args[3:3 + int(args[2])]
+        if command in NUMKEYS_COMMANDS:
+            return args[2:2 + int(args[1])]
+        if command in PAIRS_COMMANDS:
+            return args[1::2]
+        if command == 'BITOP':  # BITOP operation destkey key...
+            return args[2:]
+        if command in ('XREAD', 'XREADGROUP'):
+            index = next(i for i, arg in enumerate(args)
+                         if (arg.decode() if isinstance(arg, bytes) else str(arg)).upper() == 'STREAMS')
+            return args[index + 1:index + 1 + (len(args) - index - 1) // 2]
+        if command == 'OBJECT':
+            return args[2:3]
+        return args[1:2]
+
+    @staticmethod
+    def check_routable(command):
+        """单节点命令无法路由，抛出异常"""
+        if command in NODE_COMMANDS:
+            raise redis.RedisError('{} can not be routed by sharded redis, run it on nodes[name]'.format(command))
+
+    @staticmethod
+    def gather(command, results):
+        """合并在所有节点上执行的结果"""
+        if command == 'KEYS':
+            return [key for result in results for key in result]
+        return sum(results)
+
+    @staticmethod
+    def combine(command, parts):
+        """
+        合并拆分执行的结果
+        :param parts: [(该节点的键在原命令中的位置, 该节点的结果), ...]
+        """
+        if command == 'MGET':
+            values = {}
+            for indexes, result in parts:
+                values.update(zip(indexes, result))
+            return [values[index] for index in sorted(values)]
+        return sum(result for _, result in parts)
+
+    def _execute(self, node, keys, args, options):
+        try:
+            return self.nodes[node].execute_command(*args, **options)
+        except (redis.ConnectionError, redis.TimeoutError):
+            if not self.failover:
+                raise
+            node_health.mark_failed(node, self.retry_seconds)
+            retry = self.node_for_keys(keys)
+            if retry == node:
+                raise
+            return self.nodes[retry].execute_command(*args, **options)
+
+    def execute_command(self, *args, **options):
+        command = args[0].upper()
+        self.check_routable(command)
+        if command in BROADCAST_COMMANDS:
+            return [client.execute_command(*args, **options) for client in self.nodes.values()][0]
+        if command in GATHER_COMMANDS:
+            return self.gather(command, [client.execute_command(*args, **options) for client in self.nodes.values()])
+        if command in SPLIT_COMMANDS:
+            parts = []
+            for node, items in self.group_keys(args[1:]).items():
+                indexes, keys = zip(*items)
+                parts.append((indexes, self._execute(node, keys, (args[0],) + keys, options)))
+            return self.combine(command, parts)
+        keys = self.command_keys(args)
+        return self._execute(self.node_for_keys(keys), keys, args, options)
+
+    def ping(self):
+        return all(client.ping() for client in self.nodes.values())
+
+    def scan_iter(self, match=None, count=None, **kwargs):
+        """依次扫描所有节点"""
+        for client in self.nodes.values():
+            yield from client.scan_iter(match=match, count=count, **kwargs)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return ShardedPipeline(self, transaction)
+
+    def register_script(self, script):
+        return ShardedScript(self, script)
+
+
+class ShardedPipeline(ShardedRedis):
+    """
+    分片管道，命令按节点分别放入各节点的管道，execute时依次执行再按原顺序合并结果
+    transaction=True时每个节点的命令以MULTI/EXEC原子执行，不同节点之间不保证原子性
+    """
+
+    def __init__(self, sharded, transaction=True):
+        self.nodes = sharded.nodes
+        self.ring = sharded.ring
+        self.failover = sharded.failover
+        self.retry_seconds = sharded.retry_seconds
+        self.connection = None
+        self.response_callbacks = sharded.response_callbacks
+        self.transaction = transaction
+        self.reset()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.reset()
+
+    def __del__(self):
+        try:
+            self.reset()
+        except Exception:
+            pass
+
+    def __len__(self):
+        return len(self.command_stack)
+
+    def __bool__(self):
+        return True
+
+    def reset(self):
+        for pipe in getattr(self, 'pipelines', {}).values():
+            pipe.reset()
+        self.pipelines = OrderedDict()  # 节点名 -> 该节点的管道
+        self.command_stack = []  # [(命令, [(节点名, 在该节点管道中的位置, 键的原位置), ...]), ...]
+
+    def _queue(self, node, args, options):
+        pipe = self.pipelines.get(node)
+        if pipe is None:
+            pipe = self.pipelines[node] = self.nodes[node].pipeline(transaction=self.transaction)
+        pipe.execute_command(*args, **options)
+        return len(pipe) - 1
+
+    def execute_command(self, *args, **options):
+        command = args[0].upper()
+        if command == 'WATCH':
+            raise redis.RedisError('WATCH is not supported by sharded pipeline')
+        self.check_routable(command)
+        if command in BROADCAST_COMMANDS or command in GATHER_COMMANDS:
+            parts = [(node, self._queue(node, args, options), None) for node in self.nodes]
+        elif command in SPLIT_COMMANDS:
+            parts = []
+            for node, items in self.group_keys(args[1:]).items():
+                indexes, keys = zip(*items)
+                parts.append((node, self._queue(node, (args[0],) + keys, options), indexes))
+        else:
+            node = self.node_for_keys(self.command_keys(args))
+            parts = [(node, self._queue(node, args, options), None)]
+        self.command_stack.append((command, parts))
+        return self
+
+    def execute(self, raise_on_error=True):
+        if not self.command_stack:
+            return []
+        results = {}
+        try:
+            for node, pipe in self.pipelines.items():
+                try:
+                    results[node] = pipe.execute(raise_on_error)
+                except (redis.ConnectionError, redis.TimeoutError):
+                    if self.failover:  # 已执行的节点无法回滚，只标记故障，由调用方决定是否重试
+                        node_health.mark_failed(node, self.retry_seconds)
+                    raise
+            response = []
+            for command, parts in self.command_stack:
+                if command in SPLIT_COMMANDS:
+                    response.append(self.combine(command, [(indexes, results[node][index])
+                                                           for node, index, indexes in parts]))
+                elif command in GATHER_COMMANDS:
+                    response.append(self.gather(command, [results[node][index] for node, index, _ in parts]))
+                else:
+                    node, index, _ = parts[0]
+                    response.append(results[node][index])
+            return response
+        finally:
+            self.reset()
+
+
+class ShardClient(DjangoShardClient):
+    """
+    django缓存后端的分片客户端
+    与ShardedRedis使用相同的哈希标签规则、哈希环和节点健康状态，业务代码标记的故障节点缓存同样会绕开
+    settings.CACHES中 'CLIENT_CLASS': 'Emall.redis_shard.ShardClient'
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._locations = OrderedDict((node_name(location), location) for location in self._server)
+        self._shard_ring = HashRing(self._locations)
+
+    def _probe(self, node):
+        try:
+            return self._serverdict[self._locations[node]].ping()
+        except redis.RedisError:
+            return False
+
+    def get_server_name(self, _key):
+        tag = hash_tag(_key)
+        node = self._shard_ring.get_node(tag, lambda name: node_health.available(name, self._probe)) or \
+            self._shard_ring.get_node(tag)
+        return self._locations[node]
@@ -246,6 +246,42 @@ ACQUIRE_COUPON_SUCCESS = 822
 
 ACQUIRE_COUPON_ERROR = 821
 
+# 秒杀抢购成功
+
+SECKILL_SUCCESS = 901
+
+# 秒杀商品已抢完
+
+SECKILL_SOLD_OUT = -901
+
+# 超出秒杀限购数量
+
+SECKILL_LIMIT_ERROR = -902
+
+# 秒杀活动不存在
+
+SECKILL_NOT_EXIST = -903
+
+# 不在秒杀活动时间内
+
+SECKILL_NOT_IN_TIME = -904
+
+# 秒杀订单排队生成中
+
+SECKILL_ORDER_PENDING = 905
+
+# 秒杀订单已生成
+
+SECKILL_ORDER_SUCCESS = 906
+
+# 秒杀订单生成失败
+
+SECKILL_ORDER_FAILED = -905
+
+# 秒杀订单凭证不存在
+
+SECKILL_ORDER_NOT_EXIST = -906
+
 
 class ResponseCode:
     result = {
@@ -668,4 +704,58 @@ class ResponseCode:
         """获取优惠卷"""
         self.result.update(dict(code=ACQUIRE_COUPON_ERROR, msg='acquire_error', status='error'))
 
+    @property
+    def seckill_success(self):
+        """秒杀抢购成功"""
+        self.result.update(dict(code=SECKILL_SUCCESS, msg='seckill_success', status='success'))
+        return self.result
+
+    @property
+    def seckill_sold_out(self):
+        """秒杀商品已抢完"""
+        self.result.update(dict(code=SECKILL_SOLD_OUT, msg='sold_out', status='error'))
+        return self.result
+
+    @property
+    def seckill_limit_error(self):
+        """超出限购数量"""
+        self.result.update(dict(code=SECKILL_LIMIT_ERROR, msg='limit_error', status='error'))
+        return self.result
+
+    @property
+    def seckill_not_exist(self):
+        """秒杀活动不存在"""
+        self.result.update(dict(code=SECKILL_NOT_EXIST, msg='not_exist', status='error'))
+        return self.result
+
+    @property
+    def seckill_not_in_time(self):
+        """不在秒杀活动时间内"""
+        self.result.update(dict(code=SECKILL_NOT_IN_TIME, msg='not_in_time', status='error'))
+        return self.result
+
+    @property
+    def seckill_order_pending(self):
+        """秒杀订单排队生成中"""
+        self.result.update(dict(code=SECKILL_ORDER_PENDING, msg='order_pending', status='success'))
+        return self.result
+
+    @property
+    def seckill_order_success(self):
+        """秒杀订单已生成"""
+        self.result.update(dict(code=SECKILL_ORDER_SUCCESS, msg='order_success', status='success'))
+        return self.result
+
+    @property
+    def seckill_order_failed(self):
+        """秒杀订单生成失败"""
+        self.result.update(dict(code=SECKILL_ORDER_FAILED, msg='order_failed', status='error'))
+        return self.result
+
+    @property
+    def seckill_order_not_exist(self):
+        """秒杀订单凭证不存在"""
+        self.result.update(dict(code=SECKILL_ORDER_NOT_EXIST, msg='order_not_exist', status='error'))
+        return self.result
+
 response_code = ResponseCode()
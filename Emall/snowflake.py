@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+# @Time  : 2020/11/17 上午10:21
+# @Author : 司云中
+# @File : snowflake.py
+# @Software: Pycharm
+import os
+import threading
+import time
+import uuid
+
+from redis import RedisError
+
+from Emall import settings
+from Emall.base_redis import BaseRedis
+from Emall.loggings import Logging
+
+common_logger = Logging.logger('django')
+
+
+class ClockBackwardsError(Exception):
+    """系统时钟回拨超过容忍范围"""
+
+
+class WorkerIdUnavailableError(Exception):
+    """无法获取机器id：redis不可用或全部机器id均已被租用"""
+
+
+class WorkerIdLease(BaseRedis):
+    """
+    机器id租约
+    每个生成id的进程从redis租用一个机器id：snowflake-worker-{id}，值为持有者token，LEASE_SECONDS秒后过期
+    持有者在租约剩余不足一半时续期，进程退出或宕机后租约过期，机器id可被其他进程重新租用
+    """
+
+    LEASE_SECONDS = 60
+
+    # 只续期自己持有的租约
+    # KEYS[1]:机器id的键  ARGV[1]:持有者token  ARGV[2]:租约秒数
+    RENEW_SCRIPT = """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        return redis.call('EXPIRE', KEYS[1], ARGV[2])
+    end
+    return 0
+    """
+
+    def __init__(self, db, redis):
+        super().__init__(db, redis)
+        self.renew_script = self.redis.register_script(self.RENEW_SCRIPT)
+
+    def worker_key(self, worker_id):
+        """机器id租约的键"""
+        return self.key('snowflake', 'worker', worker_id)
+
+    @property
+    def sequence_key(self):
+        """租用的起始位置，各进程从不同的位置开始尝试，减少冲突"""
+        return self.key('snowflake', 'worker', 'sequence')
+
+    def acquire(self, token, max_worker):
+        """
+        租用一个空闲的机器id
+        :return: int 机器id，全部已被租用返回None
+        """
+        start = self.redis.incr(self.sequence_key)
+        for offset in range(max_worker + 1):
+            worker_id = (start + offset) & max_worker
+            if self.redis.set(self.worker_key(worker_id), token, ex=self.LEASE_SECONDS, nx=True):
+                return worker_id
+        return None
+
+    def renew(self, worker_id, token):
+        """续期，租约已过期或已被其他进程租用返回False"""
+        return bool(self.renew_script(keys=[self.worker_key(worker_id)], args=[token, self.LEASE_SECONDS]))
+
+
+class Snowflake:
+    """
+    雪花算法id生成器，不访问数据库和redis
+    64位id = 1位符号位 + 41位毫秒时间戳 + 10位机器id + 12位序列号
+    同一毫秒内最多生成4096个id，按时间递增，可直接排序
+
+    机器id优先读取settings.SNOWFLAKE_WORKER_ID，配置的值必须在所有生成id的进程中唯一
+    未配置时每个进程在首次生成id时从redis租用机器id，uwsgi、celery的每个进程各自拥有不同的机器id，
+    生成id时租约剩余不足一半则续期，每LEASE_SECONDS/2秒最多访问一次redis；
+    租约已失效(例如进程长时间空闲)时重新租用，无法获取机器id时抛出WorkerIdUnavailableError，不生成可能重复的id
+    同一进程内的多个线程通过锁共享序列号
+    """
+
+    EPOCH = 1577808000000  # 2020-01-01 00:00:00的毫秒时间戳
+
+    WORKER_BITS = 10
+    SEQUENCE_BITS = 12
+
+    MAX_WORKER = (1 << WORKER_BITS) - 1
+    MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+    WORKER_SHIFT = SEQUENCE_BITS
+    TIMESTAMP_SHIFT = SEQUENCE_BITS + WORKER_BITS
+
+    MAX_BACKWARDS_MS = 5  # 容忍的时钟回拨毫秒数，回拨在此范围内等待时钟追上
+
+    def __init__(self, worker_id=None):
+        if worker_id is None:
+            worker_id = getattr(settings, 'SNOWFLAKE_WORKER_ID', None)
+        self._configured_worker = worker_id
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        """初始化进程相关的状态，fork之后子进程不能沿用父进程的机器id，需要重新租用"""
+        self._pid = os.getpid()
+        self._token = uuid.uuid4().hex
+        self._lease_deadline = 0  # 租约的本地到期时间(time.monotonic)
+        self.worker_id = None
+        if self._configured_worker is not None:
+            if not 0 <= self._configured_worker <= self.MAX_WORKER:
+                raise WorkerIdUnavailableError('SNOWFLAKE_WORKER_ID must be in [0, {}]'.format(self.MAX_WORKER))
+            self.worker_id = self._configured_worker
+        self._last_timestamp = -1
+        self._sequence = 0
+
+    def _ensure_worker(self):
+        """保证持有有效的机器id租约，调用方持有锁"""
+        if self._configured_worker is not None:
+            return
+        now = time.monotonic()
+        if self.worker_id is not None and now < self._lease_deadline - worker_lease.LEASE_SECONDS / 2:
+            return
+        try:
+            if self.worker_id is None or now >= self._lease_deadline or \
+                    not worker_lease.renew(self.worker_id, self._token):
+                self.worker_id = worker_lease.acquire(self._token, self.MAX_WORKER)
+        except RedisError as e:
+            self.worker_id = None
+            raise WorkerIdUnavailableError('failed to lease a snowflake worker id') from e
+        if self.worker_id is None:
+            raise WorkerIdUnavailableError('all {} snowflake worker ids are leased'.format(self.MAX_WORKER + 1))
+        self._lease_deadline = now + worker_lease.LEASE_SECONDS  # 以发出请求前的时间计算，不会晚于redis中的过期时间
+
+    @staticmethod
+    def _timestamp():
+        return int(time.time() * 1000)
+
+    def _wait_next_millis(self, last_timestamp):
+        """等待进入下一毫秒"""
+        timestamp = self._timestamp()
+        while timestamp <= last_timestamp:
+            timestamp = self._timestamp()
+        return timestamp
+
+    def _next_timestamp(self):
+        """获取当前时间戳，处理时钟回拨"""
+        timestamp = self._timestamp()
+        if timestamp < self._last_timestamp:
+            offset = self._last_timestamp - timestamp
+            if offset > self.MAX_BACKWARDS_MS:
+                common_logger.error('clock moved backwards {} ms'.format(offset))
+                raise ClockBackwardsError('clock moved backwards {} ms'.format(offset))
+            timestamp = self._wait_next_millis(self._last_timestamp - 1)
+        return timestamp
+
+    def _next_id(self):
+        """生成一个id，调用方持有锁"""
+        if os.getpid() != self._pid:  # 被fork的子进程
+            self._reset()
+        self._ensure_worker()
+        timestamp = self._next_timestamp()
+        if timestamp == self._last_timestamp:
+            self._sequence = (self._sequence + 1) & self.MAX_SEQUENCE
+            if self._sequence == 0:  # 当前毫秒的序列号已用完
+                timestamp = self._wait_next_millis(self._last_timestamp)
+        else:
+            self._sequence = 0
+        self._last_timestamp = timestamp
+        return ((timestamp - self.EPOCH) << self.TIMESTAMP_SHIFT) | (self.worker_id << self.WORKER_SHIFT) | \
+            self._sequence
+
+    def next_id(self):
+        """生成一个id"""
+        with self._lock:
+            return self._next_id()
+
+    def next_ids(self, counts):
+        """
+        批量生成id，批量创建订单时只需获取一次锁
+        :param counts: 数量
+        :return: list
+        """
+        with self._lock:
+            return [self._next_id() for _ in range(counts)]
+
+
+worker_lease = WorkerIdLease.choice_redis_db('redis')
+
+snowflake = Snowflake()
@@ -12,6 +12,33 @@ from analysis_app.utils.statistic_redis import statistic_redis
 common_logger = Logging.logger('django')
 
 
+@app.task
+def aggregate_analysis_events(count=100, max_batches=20):
+    """
+    定时汇总缓冲写入stream的统计事件，同一时刻只有一个worker汇总
+    汇总失败的消息未ack，下次重新读取
+    :return: int 汇总的事件数量
+    """
+    aggregated = 0
+    with statistic_redis.single_flight(statistic_redis.stream_key, lock_seconds=60) as acquired:
+        if not acquired:
+            return aggregated
+        statistic_redis.create_group()
+        for _ in range(max_batches):
+            try:
+                entry_ids, events = statistic_redis.read_events(count)
+                if not entry_ids:
+                    break
+                statistic_redis.aggregate(entry_ids, events)
+            except Exception as e:
+                common_logger.error(e)
+                break
+            aggregated += len(events)
+            if len(entry_ids) < count:
+                break
+    return aggregated
+
+
 @app.task
 def statistic_login_times():
     """发送统计每日用户活跃量的定时信号"""
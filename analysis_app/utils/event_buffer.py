@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+# @Time  : 2020/11/28 上午10:20
+# @Author : 司云中
+# @File : event_buffer.py
+# @Software: Pycharm
+import atexit
+import os
+import threading
+import time
+from collections import deque
+
+from Emall.loggings import Logging
+
+common_logger = Logging.logger('django')
+
+
+class EventBuffer:
+    """
+    进程内的事件缓冲
+    请求中只把事件追加到deque，不访问redis；后台线程每flush_milliseconds毫秒，
+    或累计max_events个事件时提前，把缓冲的事件整批交给flush函数写出
+
+    uwsgi在fork之后才启动后台线程(需开启threads/enable-threads)，子进程丢弃从父进程继承的事件
+    写出失败的事件放回缓冲等待下次写出，缓冲最多保留max_buffer个事件，超出时(包括放回失败的事件)丢弃最旧的，
+    丢弃的数量累计在dropped中
+    进程退出时写出剩余的事件
+    """
+
+    def __init__(self, flush, max_events=500, flush_milliseconds=200, max_buffer=100000):
+        """
+        :param flush: 写出函数，参数为事件列表
+        """
+        self._flush = flush
+        self.max_events = max_events
+        self.flush_seconds = flush_milliseconds / 1000
+        self.events = deque(maxlen=max_buffer)
+        self.dropped = 0  # 缓冲已满时丢弃的事件数
+        self._pid = None
+        self._lock = threading.Lock()  # 启动后台线程
+        self._flush_lock = threading.Lock()  # 同一时刻只有一个线程写出
+        self._wakeup = threading.Event()
+
+    def append(self, *event):
+        """追加一个事件，只有deque操作，不阻塞请求"""
+        if self._pid != os.getpid():
+            self._start()
+        if len(self.events) == self.events.maxlen:
+            self.dropped += 1  # deque已满时append挤出最旧的事件
+        self.events.append(event)
+        if len(self.events) >= self.max_events:
+            self._wakeup.set()
+
+    def _start(self):
+        """在当前进程中启动后台线程"""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self.events.clear()  # fork前的事件由父进程写出
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name='event-buffer', daemon=True).start()
+            atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_seconds)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """
+        写出缓冲中的全部事件
+        :return: int 写出的数量
+        """
+        with self._flush_lock:
+            batch = []
+            try:
+                while True:
+                    batch.append(self.events.popleft())
+            except IndexError:
+                pass
+            if not batch:
+                return 0
+            start = time.perf_counter()
+            try:
+                self._flush(batch)
+            except Exception as e:  # redis不可用时不影响请求，事件放回缓冲
+                common_logger.error(e)
+                # 放回的事件比缓冲中的更旧，空间不足时丢弃其中最旧的，而不是让extendleft挤掉最新的
+                free = self.events.maxlen - len(self.events)
+                if free < len(batch):
+                    self.dropped += len(batch) - free
+                    common_logger.warning('event buffer full, {} events dropped in total'.format(self.dropped))
+                    batch = batch[len(batch) - free:]
+                self.events.extendleft(reversed(batch))
+                return 0
+            if time.perf_counter() - start > self.flush_seconds:
+                common_logger.warning('flushing {} events took {:.3f}s'.format(len(batch), time.perf_counter() - start))
+            return len(batch)
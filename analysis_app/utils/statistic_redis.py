@@ -7,8 +7,14 @@
 
 
 import datetime
+import json
+from collections import Counter
+
+from redis import ResponseError
+
 from analysis_app.signals import login_user_browser_times, user_browser_times, buy_category, user_recommend
-from Emall.base_redis import BaseRedis, manager_redis
+from analysis_app.utils.event_buffer import EventBuffer
+from Emall.base_redis import BaseRedis
 from Emall.loggings import Logging
 from user_app.models import User
 
@@ -16,10 +22,28 @@ common_logger = Logging.logger('django')
 
 
 class StatisticRedis(BaseRedis):
-    """redis统计类"""
+    """
+    redis统计类
+    请求中只把事件追加到进程内缓冲(EventBuffer)，缓冲整批XADD到stream analysis-events，一批一条消息
+    celery定时任务按消费者组读取，合并相同的计数后用一个管道写入各统计键，再ack并删除消息
+    事件：('browse', 日期)  ('login', 日期, 用户pk)  ('recommend', 用户pk, 种类)  ('buy', 日期, 种类)
+    日期取事件发生时，跨零点的事件计入发生的那一天
+    """
+
+    GROUP = 'aggregate'  # 消费者组
+    CONSUMER = 'aggregator'  # 消费者名称，所有worker共用，宕机后未ack的消息可被其他worker重新读取
+    STREAM_MAXLEN = 100000  # stream最多保留的消息数，消费者长时间停止时丢弃最早的事件
+
+    BATCH_EVENTS = 500  # 每条消息最多包含的事件数，缓冲累计该数量时提前写出
+    FLUSH_MILLISECONDS = 200  # 缓冲的写出间隔
+    RECOMMEND_SECONDS = 259200  # 用户偏好种类保留三天
+
+    EVENT_SIZES = {'browse': 2, 'login': 3, 'recommend': 3, 'buy': 3}  # 各事件的长度，用于丢弃格式错误的事件
 
     def __init__(self, db, redis):
         super().__init__(db, redis)
+        self.buffer = EventBuffer(self.publish, max_events=self.BATCH_EVENTS,
+                                  flush_milliseconds=self.FLUSH_MILLISECONDS)
         self.connect()
 
     def connect(self):
@@ -57,6 +81,11 @@ class StatisticRedis(BaseRedis):
         date_list = date_str.split('-')
         return date_list[0], date_list[1], int(date_list[2])
 
+    @property
+    def stream_key(self):
+        """事件stream的键"""
+        return self.key('analysis', 'events')
+
     def record_login_user_browsing_times(self, sender, instance, **kwargs):
         """
         1.记录当天用户登录的总人数
@@ -69,36 +98,20 @@ class StatisticRedis(BaseRedis):
         :param kwargs:  额外参数
         :return:
         """
-        date = datetime.date.today()  # today
-        with manager_redis(self.db) as redis:
-            pipe = redis.pipeline()
-            date_str = self.trans_date(date)  # offset:user_pk
-            key = self.key('login-day', date_str)
-            pipe.setbit(key, instance.pk, 1)
-
-            year, month, day = self.trans_date_offset(date)  # offset:day
-            key = self.key('login', year, month, instance.pk)
-            pipe.setbit(key, day, 1)  # 尽可能节约内存
-            pipe.execute()
+        self.buffer.append('login', self.trans_date(datetime.date.today()), instance.pk)
 
-    def record_user_browsing_times(self, sender, ip, **kwargs):
+    def record_user_browsing_times(self, sender=None, **kwargs):
         """
         记录每天网站访问量
         :param sender: 发送者
-        :param date:  日期类型
         :param kwargs: 额外参数
         :return:
         """
-
-        date = datetime.date.today()  # today
-        date_str = self.trans_date(date)
-        key = self.key('browser-day', date_str)
-        with manager_redis(self.db) as redis:
-            redis.incrby(key, amount=1)
+        self.buffer.append('browse', self.trans_date(datetime.date.today()))
 
     def record_user_recommendation(self, sender, category, instance, **kwargs):
         """
-        每个用户维护一个hash表，hash表内部填充用户收入收藏夹的商品种类，浏览足迹商品的种类，购买商品的种类的次数
+        每个用户维护一个有序集合，填充用户收入收藏夹的商品种类，浏览足迹商品的种类，购买商品的种类的次数
         生存周期3天，以便实时喂给算法新的数据集,同时避免占用过多内存
         :param sender: 发送者
         :param category: 种类
@@ -106,14 +119,9 @@ class StatisticRedis(BaseRedis):
         :param kwargs: 额外参数
         :return:
         """
-        with manager_redis(self.db) as redis:
-            pipe = redis.pipeline()
-            hash_key = self.key('love-category', instance.pk)
-            pipe.zincrby(hash_key, amount=1, value=category)  # 默认从1开始
-            pipe.expire(hash_key, 259200)  # 活三天
-            pipe.execute()
+        self.buffer.append('recommend', instance.pk, category)
 
-    def record_buy_category(self, sender, category, date, **kwargs):
+    def record_buy_category(self, sender, category, **kwargs):
         """
         当用户购买某一商品后，记录该商品种类被购买+1
         用于每一天哪些类型的商品销售量多---> 每一月 ----> 每一季度 ----> 每一年
@@ -123,11 +131,84 @@ class StatisticRedis(BaseRedis):
         :param kwargs:额外参数
         :return:
         """
-        with manager_redis(self.db) as redis:
-            date = datetime.date.today()  # today
-            date_str = self.trans_date(date)
-            zset_key = self.key('buy-category', date_str)
-            redis.zincrby(zset_key, amount=1, value=category)  # 默认为1,方便排行
+        self.buffer.append('buy', self.trans_date(datetime.date.today()), category)
+
+    def publish(self, events):
+        """缓冲的写出函数，每BATCH_EVENTS个事件一条消息，一次管道写入"""
+        with self.redis.pipeline(transaction=False) as pipe:
+            for i in range(0, len(events), self.BATCH_EVENTS):
+                pipe.xadd(self.stream_key, {'events': json.dumps(events[i:i + self.BATCH_EVENTS])},
+                          maxlen=self.STREAM_MAXLEN, approximate=True)
+            pipe.execute()
+
+    def create_group(self):
+        """创建消费者组，已存在则忽略"""
+        try:
+            self.redis.xgroup_create(self.stream_key, self.GROUP, id='0', mkstream=True)
+        except ResponseError:  # BUSYGROUP,消费者组已存在
+            pass
+
+    def parse_events(self, fields):
+        """
+        消息 -> 事件列表
+        未ack的消息被MAXLEN裁剪后再次读取时fields为None，与格式错误的消息一样返回空列表，随这批消息一起ack
+        格式错误的单个事件丢弃，不影响同一消息中的其他事件
+        """
+        try:
+            events = json.loads(fields[b'events'])
+        except (TypeError, KeyError, ValueError) as e:
+            common_logger.warning('dropping malformed analysis message: {}'.format(e))
+            return []
+        if not isinstance(events, list):
+            return []
+        return [event for event in events
+                if isinstance(event, list) and event and self.EVENT_SIZES.get(event[0]) == len(event)]
+
+    def read_events(self, count=100):
+        """
+        读取一批消息
+        先读取已投递但未ack的消息(上次汇总失败或worker宕机)，没有再读取新消息
+        :return: tuple 消息id列表(包括无法解析的消息，汇总后一并ack), 事件列表
+        """
+        for offset in ('0', '>'):
+            response = self.redis.xreadgroup(self.GROUP, self.CONSUMER, {self.stream_key: offset}, count=count)
+            entries = response[0][1] if response else []
+            if entries:
+                return [entry_id for entry_id, _ in entries], \
+                       [event for _, fields in entries for event in self.parse_events(fields)]
+        return [], []
+
+    def aggregate(self, entry_ids, events):
+        """
+        合并一批事件的计数，和ack一起由一个管道写入
+        写入成功但ack失败时，这批事件会被再次汇总
+        """
+        browse, buy, recommend, logins = Counter(), Counter(), Counter(), set()
+        for event in events:
+            kind, args = event[0], tuple(event[1:])
+            if kind == 'browse':
+                browse[args] += 1
+            elif kind == 'buy':
+                buy[args] += 1
+            elif kind == 'recommend':
+                recommend[args] += 1
+            elif kind == 'login':
+                logins.add(args)
+        with self.redis.pipeline(transaction=False) as pipe:
+            for (date_str,), counts in browse.items():
+                pipe.incrby(self.key('browser-day', date_str), counts)
+            for (date_str, category), counts in buy.items():
+                pipe.zincrby(self.key('buy-category', date_str), counts, category)  # 方便排行
+            for (user_pk, category), counts in recommend.items():
+                pipe.zincrby(self.key('love-category', user_pk), counts, category)
+                pipe.expire(self.key('love-category', user_pk), self.RECOMMEND_SECONDS)
+            for date_str, user_pk in logins:
+                pipe.setbit(self.key('login-day', date_str), user_pk, 1)  # offset:user_pk
+                year, month, day = date_str.split('-')
+                pipe.setbit(self.key('login', year, month, user_pk), int(day), 1)  # offset:day，尽可能节约内存
+            pipe.xack(self.stream_key, self.GROUP, *entry_ids)
+            pipe.xdel(self.stream_key, *entry_ids)
+            pipe.execute()
 
 
 statistic_redis = StatisticRedis.choice_redis_db('analysis')
@@ -122,12 +122,29 @@ HAYSTACK_CONNECTIONS = {
     # }
 }
 
-# 新增的数据自动生成索引
-HAYSTACK_SIGNAL_PROCESSOR = 'haystack.signals.RealtimeSignalProcessor'
+# 商品修改后加入redis队列，由celery定时批量更新索引
+HAYSTACK_SIGNAL_PROCESSOR = 'search_app.utils.signal_processor.QueuedSignalProcessor'
 
 # 设置每页显示的数目，默认为20，可以自己修改
 HAYSTACK_SEARCH_RESULTS_PER_PAGE = 100
 
+# 商品搜索后端，local为内置的SQLite FTS5倒排索引，不依赖外部服务
+SEARCH_BACKEND = {
+    'ENGINE': 'search_app.backends.local.LocalSearchBackend',
+    'OPTIONS': {
+        'PATH': os.path.join(BASE_DIR, 'search_index', 'commodity.sqlite3'),
+    },
+}
+# # elasticsearch，地址和索引默认读取HAYSTACK_CONNECTIONS['default']
+# SEARCH_BACKEND = {
+#     'ENGINE': 'search_app.backends.elastic.ElasticsearchBackend',
+#     'OPTIONS': {
+#         'TIMEOUT': (1, 3),  # (连接超时, 读超时)
+#         'POOL_SIZE': 32,  # 每个进程的最大连接数
+#         'RETRIES': 1,  # 建立连接失败的重试次数
+#     },
+# }
+
 # the config of swagger doc
 
 SWAGGER_SETTINGS = {
@@ -286,6 +303,9 @@ CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIME_ZONE = TIME_ZONE
 
 
+# 雪花算法机器id(0~1023)，只在仅有一个进程生成id时配置，None则每个进程从redis租用不重复的机器id
+SNOWFLAKE_WORKER_ID = None
+
 CELERY_BEAT_SCHEDULE = {
     # 'every-day-statistic-login-times':{
     #     'task':'Anaylsis_app',
@@ -296,6 +316,46 @@ CELERY_BEAT_SCHEDULE = {
         'schedule': crontab(minute=0,hour=0),
         'args':(),
     },
+    'materialize-seckill-orders': {
+        'task': 'order_app.tasks.materialize_seckill_orders',
+        'schedule': 1.0,  # 每秒消费一次秒杀成功者，异步生成订单
+        'args': (),
+    },
+    'cancel-expired-orders': {
+        'task': 'order_app.tasks.cancel_expired_orders',
+        'schedule': 30.0,  # 每30s取消一次超时未付款的订单
+        'args': (),
+    },
+    'flush-shop-carts': {
+        'task': 'user_app.tasks.flush_shop_carts',
+        'schedule': 5.0,  # 每5s将修改过的购物车写回数据库
+        'args': (),
+    },
+    'index-dirty-commodities': {
+        'task': 'search_app.tasks.index_dirty_commodities',
+        'schedule': 2.0,  # 每2s批量更新修改过的商品的索引
+        'args': (),
+    },
+    'rebuild-suggestions': {
+        'task': 'search_app.tasks.rebuild_suggestions',
+        'schedule': crontab(minute='*/10'),  # 每10分钟全量重建搜索联想
+        'args': (),
+    },
+    'refresh-heat-suggestions': {
+        'task': 'search_app.tasks.refresh_heat_suggestions',
+        'schedule': 60.0,  # 每分钟把热搜关键字加入搜索联想
+        'args': (),
+    },
+    'warm-search-cache': {
+        'task': 'search_app.tasks.warm_search_cache',
+        'schedule': 10.0,  # 每10s刷新热搜关键字的搜索结果缓存，有效期不足一半的才重新查询
+        'args': (),
+    },
+    'aggregate-analysis-events': {
+        'task': 'analysis_app.tasks.aggregate_analysis_events',
+        'schedule': 2.0,  # 每2s汇总一次各进程缓冲写入的统计事件
+        'args': (),
+    },
     # 'add-every-monday-morning': {
     #     'task': 'Analysis_app.tasks.add',
     #     'schedule': 5.0,
@@ -316,7 +376,7 @@ CACHES = {
                 'redis://192.168.0.105:6379/2'
             ],
             'OPTIONS': {
-                'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+                'CLIENT_CLASS': 'Emall.redis_shard.ShardClient',  # 按一致性哈希分布到所有节点
             }
         },
     'analysis':    # 用于用户和商家行为分析
@@ -329,7 +389,7 @@ CACHES = {
                 'redis://192.168.0.105:6379/3'
             ],
             'OPTIONS': {
-                'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+                'CLIENT_CLASS': 'Emall.redis_shard.ShardClient',  # 按一致性哈希分布到所有节点
             }
         },
     'remark':    # 用于评论模块的缓存操作
@@ -342,7 +402,19 @@ CACHES = {
                 'redis://192.168.0.105:6379/4'
             ],
             'OPTIONS': {
-                'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+                'CLIENT_CLASS': 'Emall.redis_shard.ShardClient',  # 按一致性哈希分布到所有节点
+            }
+        },
+    'search':    # 用于搜索历史和热搜榜
+        {
+            'BACKEND': 'django_redis.cache.RedisCache',
+            'LOCATION': [
+                'redis://192.168.0.105:6381/5',
+                'redis://192.168.0.105:6380/5',
+                'redis://192.168.0.105:6379/5'
+            ],
+            'OPTIONS': {
+                'CLIENT_CLASS': 'Emall.redis_shard.ShardClient',  # 按一致性哈希分布到所有节点
             }
         },
     'default':
@@ -355,6 +427,33 @@ CACHES = {
         }
 }
 
+# 业务redis连接池参数，见Emall.redis_pool，default对所有别名生效，可按别名覆盖
+REDIS_POOL_OPTIONS = {
+    'default': {
+        'max_connections': 64,  # 每个进程每个库的最大连接数
+        'timeout': 5,  # 连接耗尽时等待空闲连接的秒数
+        'health_check_interval': 30,  # 空闲连接的健康检查间隔
+    },
+    'analysis': {
+        'max_connections': 32,
+    },
+}
+
+# 业务redis分片，见Emall.redis_shard，列出的别名按一致性哈希把键分布到LOCATION的所有节点
+# 需要同时操作的多个键使用哈希标签{...}，保证落在同一节点
+REDIS_SHARDING = {
+    'default': {
+        'failover': True,  # 节点故障时把该节点的键改写到下一个节点
+        'retry_seconds': 30,  # 故障节点的探测间隔
+    },
+    'redis': {
+        'failover': False,  # 购物车、秒杀库存等以redis为准的数据，节点故障时报错而不是写到其他节点
+    },
+    'analysis': {},
+    'remark': {},
+    'search': {},
+}
+
 # 图片等媒体文件的url
 MEDIA_URL = '/media/'  # 方便url使用的目录，与项目中的目录名不一样,同时也用于数据库存储的路径,要加上/来结尾
 
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+# @Time  : 2020/11/16 下午3:12
+# @Author : 司云中
+# @File : order_manager.py
+# @Software: Pycharm
+import datetime
+import operator
+from decimal import Decimal
+from functools import reduce
+
+from django.db import transaction, DatabaseError
+from django.db.models import Manager, Q, F, Case, When, IntegerField, Sum
+
+from shop_app.models.commodity_models import Commodity
+from user_app.models import Address
+
+CENT = Decimal('0.01')
+
+
+class StockShortageError(DatabaseError):
+    """库存不足，事务回滚"""
+
+
+class InvalidCountsError(DatabaseError):
+    """购买数量不是正整数，不扣减库存也不生成订单"""
+
+
+class OrderBasicManager(Manager):
+    """
+    订单管理类
+    默认生成具备默认QuerySet的Manager的实例
+    """
+
+    EXPIRE_SECONDS = 30 * 60  # 订单30min未付款自动取消
+
+    @staticmethod
+    def check_counts(commodity_counts):
+        """
+        校验购买数量，负数会使扣减库存变为增加库存，0会生成数量为0的订单详情
+        立即支付的商品数量来自session，不经过OrderCreateSerializer的校验，在此统一检查
+        :raise InvalidCountsError: 存在小于1或不是整数的数量
+        """
+        for counts in commodity_counts.values():
+            if not isinstance(counts, int) or isinstance(counts, bool) or counts < 1:
+                raise InvalidCountsError('购买数量不合法: {!r}'.format(counts))
+
+    def compute_order_lines(self, commodity_counts):
+        """
+        从商品缓存批量获取价格，计算订单中每种商品的折后单价，使用Decimal避免浮点误差
+        :param commodity_counts: dict  {commodity_pk: counts}
+        :return: tuple  [(commodity_pk, shopper_pk, price, counts), ...], 订单总价, 商品总数
+        :raise Commodity.DoesNotExist: 存在不存在的商品
+        :raise InvalidCountsError: 购买数量不合法
+        """
+        from shop_app.redis.commodity_redis import commodity_redis
+
+        self.check_counts(commodity_counts)
+        commodities = commodity_redis.get_many(commodity_counts.keys())
+        if len(commodities) != len(commodity_counts):
+            raise Commodity.DoesNotExist('订单中存在不存在的商品')
+        lines = []
+        total_price = Decimal(0)
+        for pk, commodity in commodities.items():
+            price = (Decimal(commodity['price']) * commodity['discounts']).quantize(CENT)
+            counts = commodity_counts[pk]
+            lines.append((pk, commodity['shopper_id'], price, counts))
+            total_price += price * counts
+        return lines, total_price, sum(commodity_counts.values())
+
+    @staticmethod
+    def _stock_case(commodity_counts, sign):
+        """按商品pk生成库存增减的CASE表达式"""
+        return Case(*[When(pk=pk, then=F('stock') + sign * counts) for pk, counts in commodity_counts.items()],
+                    output_field=IntegerField())
+
+    def reserve_stock(self, commodity_counts):
+        """
+        扣减库存，一条UPDATE完成所有商品的扣减
+        库存是否充足作为WHERE条件，由数据库行锁保证并发下不会超卖
+        必须在事务中调用，部分商品库存不足时抛出异常回滚整个订单
+        :param commodity_counts: dict  {commodity_pk: counts}
+        :raise StockShortageError: 库存不足
+        :raise InvalidCountsError: 购买数量不合法
+        """
+        self.check_counts(commodity_counts)
+        condition = reduce(operator.or_, (Q(pk=pk, stock__gte=counts) for pk, counts in commodity_counts.items()))
+        rows = Commodity.commodity_.filter(condition).update(stock=self._stock_case(commodity_counts, -1))
+        if rows != len(commodity_counts):
+            raise StockShortageError('库存不足')
+
+    def release_stock(self, commodity_counts):
+        """
+        归还库存
+        :param commodity_counts: dict  {commodity_pk: counts}
+        """
+        if commodity_counts:
+            Commodity.commodity_.filter(pk__in=commodity_counts.keys()).update(
+                stock=self._stock_case(commodity_counts, 1))
+
+    def cancel_unpaid_orders(self, order_pks, release=True):
+        """
+        取消超时未付款的订单，并归还订单锁定的库存
+        只有仍处于代付款状态的订单会被取消，已付款的订单不受影响
+        :param order_pks: 订单pk列表
+        :param release: 是否归还商品库存，秒杀订单没有扣减商品库存，由调用方归还秒杀库存
+        :return: list 取消的订单pk
+        """
+        from order_app.models.order_models import Order_details
+
+        with transaction.atomic():
+            pks = list(self.select_for_update().filter(pk__in=order_pks, status='1').values_list('pk', flat=True))
+            if not pks:
+                return []
+            self.filter(pk__in=pks).update(status='5')
+            if not release:
+                return pks
+            details = Order_details.order_details_.filter(order_basic_id__in=pks).values('commodity_id').annotate(
+                counts=Sum('commodity_counts'))
+            self.release_stock({detail['commodity_id']: detail['counts'] for detail in details})
+        return pks
+
+    def create_order(self, user, address, orderId, payment, commodity_counts, **kwargs):
+        """
+        创建订单以及订单详情，同时锁定库存，下单和立即支付共用
+        订单总价和过期时间在INSERT时一并写入，订单详情一次bulk_create，查询次数与商品种类数无关
+        :param user: 用户instance
+        :param address: 收货地址instance
+        :param orderId: 订单号
+        :param payment: 支付方式
+        :param commodity_counts: dict  {commodity_pk: counts}
+        :return: the instance of Order_basic
+        :raise StockShortageError: 库存不足
+        """
+        from order_app.models.order_models import Order_details
+
+        lines, total_price, total_counts = self.compute_order_lines(commodity_counts)
+        with transaction.atomic():
+            self.reserve_stock(commodity_counts)
+            efficient_time = datetime.datetime.now() + datetime.timedelta(seconds=self.EXPIRE_SECONDS)
+            order_basic = self.create(consumer=user, region=address, orderId=orderId, payment=payment,
+                                      total_price=total_price, commodity_total_counts=total_counts,
+                                      efficient_time=efficient_time, **kwargs)
+            Order_details.order_details_.bulk_create([Order_details(belong_shopper_id=shopper_pk,
+                                                                    commodity_id=commodity_pk,
+                                                                    order_basic=order_basic,
+                                                                    price=price,
+                                                                    commodity_counts=counts)
+                                                      for commodity_pk, shopper_pk, price, counts in lines])
+        return order_basic
+
+    def default_addresses(self, user_pks):
+        """
+        批量获取用户的默认收货地址
+        :param user_pks: 用户pk列表
+        :return: dict  {user_pk: address_pk}
+        """
+        return dict(Address.address_.filter(user_id__in=user_pks, default_address=True).values_list('user_id', 'pk'))
+
+    def _orders_by_order_id(self, order_ids):
+        """按订单号批量查询订单，返回 {orderId: (pk, efficient_time)}"""
+        return {order_id: (pk, efficient_time) for order_id, pk, efficient_time in
+                self.filter(orderId__in=order_ids).values_list('orderId', 'pk', 'efficient_time')}
+
+    def bulk_create_seckill_orders(self, winners, addresses, payment='3'):
+        """
+        为一批秒杀成功者批量生成订单，两次INSERT完成整批订单
+        订单号在抢购时已分配，已存在的订单号跳过，同一批买家重复调用不会重复生成订单
+        :param winners: list [{'user':, 'counts':, 'orderId':, 'commodity':, 'shopper':, 'price':}, ...]
+                        commodity、shopper、price为秒杀商品pk、商家pk、秒杀单价
+        :param addresses: dict  {user_pk: address_pk}，default_addresses的结果，必须包含所有买家
+        :param payment: 支付方式，默认支付宝
+        :return: dict  {orderId: (order_basic_pk, efficient_time)} 包括此前已生成的订单
+        """
+        from order_app.models.order_models import Order_details
+
+        for winner in winners:
+            winner['price'] = Decimal(winner['price']).quantize(CENT)
+        order_ids = [winner['orderId'] for winner in winners]
+        with transaction.atomic():
+            existing = self._orders_by_order_id(order_ids)
+            winners = [winner for winner in winners if winner['orderId'] not in existing]
+            if not winners:
+                return existing
+            efficient_time = datetime.datetime.now() + datetime.timedelta(seconds=self.EXPIRE_SECONDS)
+            self.bulk_create([self.model(consumer_id=winner['user'],
+                                         region_id=addresses[winner['user']],
+                                         orderId=winner['orderId'],
+                                         payment=payment,
+                                         commodity_total_counts=winner['counts'],
+                                         total_price=winner['price'] * winner['counts'],
+                                         efficient_time=efficient_time)
+                              for winner in winners])
+            # mysql的bulk_create不回填主键，按订单号取回
+            orders = self._orders_by_order_id([winner['orderId'] for winner in winners])
+            Order_details.order_details_.bulk_create([Order_details(belong_shopper_id=winner['shopper'],
+                                                                    commodity_id=winner['commodity'],
+                                                                    order_basic_id=orders[winner['orderId']][0],
+                                                                    price=winner['price'],
+                                                                    commodity_counts=winner['counts'])
+                                                      for winner in winners])
+        orders.update(existing)
+        return orders
@@ -0,0 +1,20 @@
+# Generated by Django 2.2.15 on 2020-11-16 15:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop_app', '0001_initial'),
+        ('order_app', '0002_auto_20201020_1927'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='order_details',
+            name='commodity',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='order_details', to='shop_app.Commodity', verbose_name='商品'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.15 on 2020-11-16 16:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('order_app', '0003_order_details_commodity_foreignkey'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='order_basic',
+            name='efficient_time',
+            field=models.DateTimeField(null=True, verbose_name='订单过期时间'),
+        ),
+    ]
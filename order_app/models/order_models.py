@@ -5,6 +5,7 @@ from django.db.models import Manager
 from django.utils.html import format_html
 from django.utils.translation import gettext_lazy as _
 
+from order_app.managers.order_manager import OrderBasicManager
 from shop_app.models.commodity_models import Commodity
 from user_app.models import Address, User
 
@@ -93,10 +94,10 @@ class Order_basic(models.Model):
     # 商家删除订单状态，假删除
     delete_shopper = models.BooleanField(verbose_name=_('商家是否删除订单'), default=False)
 
-    # 订单提交有效时间
-    efficient_time = models.DateTimeField(verbose_name=_('订单过期时间'), null=True, auto_now=True)
+    # 订单提交有效时间，超过该时间未付款自动取消
+    efficient_time = models.DateTimeField(verbose_name=_('订单过期时间'), null=True)
 
-    order_basic_ = Manager()
+    order_basic_ = OrderBasicManager()
 
     class Meta:
         db_table = 'Order_basic'
@@ -117,12 +118,12 @@ class Order_details(models.Model):
                                        on_delete=models.CASCADE,
                                        related_name='order_details',
                                        )
-    # 商品，商品下架，订单详情销毁
-    commodity = models.OneToOneField(Commodity,
-                                     verbose_name=_('商品'),
-                                     related_name='order_details',
-                                     on_delete=models.CASCADE,
-                                     )
+    # 商品，商品下架，订单详情销毁；同一商品可以出现在多个订单中
+    commodity = models.ForeignKey(Commodity,
+                                  verbose_name=_('商品'),
+                                  related_name='order_details',
+                                  on_delete=models.CASCADE,
+                                  )
 
     # 属于哪一个订单，订单号
     order_basic = models.ForeignKey(Order_basic, verbose_name=_('订单号'),
@@ -3,18 +3,113 @@
 # @Author : 司云中
 # @File : order_redis.py
 # @Software: Pycharm
-from order_app.serializers.order_serializers import OrderCreateSerializer
-from Emall.base_redis import BaseRedis, manager_redis
+import time
+
+from Emall.base_redis import BaseRedis
 
 
 class RedisOrderOperation(BaseRedis):
-    """the operation of Shopper about redis"""
+    """
+    the operation of Shopper about redis
+    未付款订单的过期时间保存在一个有序集合中，member为订单pk，score为过期时间戳，由celery定时取出过期订单
+    单个有序集合即可容纳百万级待付款订单，按score范围取出到期订单的复杂度只与取出的数量有关
+    秒杀订单取消时归还的是秒杀库存而不是商品库存，放在单独的有序集合中，member带有归还秒杀库存所需的信息
+    """
+
+    # KEYS[1]:订单过期延迟队列  ARGV[1]:当前时间戳  ARGV[2]:一次领取的最大数量  ARGV[3]:租约到期时间戳
+    # 领取即租用：到期订单的score改为租约到期时间，多个worker同时扫描也不会重复领取同一订单
+    # 领取后worker宕机或事务失败，租约到期后订单重新可被领取
+    CLAIM_SCRIPT = """
+    local pks = redis.call('ZRANGEBYSCORE', KEYS[1], 0, ARGV[1], 'LIMIT', 0, ARGV[2])
+    for _, pk in ipairs(pks) do
+        redis.call('ZADD', KEYS[1], 'XX', ARGV[3], pk)
+    end
+    return pks
+    """
+
+    # KEYS[1]:订单过期延迟队列  ARGV[1]:租约到期时间戳  ARGV[2...]:订单pk
+    # 只删除仍持有该租约的订单，租约期间被重新设置过期时间的订单保留
+    ACK_SCRIPT = """
+    local removed = 0
+    for i = 2, #ARGV do
+        local score = redis.call('ZSCORE', KEYS[1], ARGV[i])
+        if score and tonumber(score) == tonumber(ARGV[1]) then
+            removed = removed + redis.call('ZREM', KEYS[1], ARGV[i])
+        end
+    end
+    return removed
+    """
+
+    RETRY_SECONDS = 60  # 领取的租约时长，处理失败或worker宕机的订单在租约到期后重试
 
     def __init__(self, db, redis):
         super().__init__(db, redis)
+        self.claim_script = self.redis.register_script(self.CLAIM_SCRIPT)
+        self.ack_script = self.redis.register_script(self.ACK_SCRIPT)
+
+    @property
+    def expire_key(self):
+        """订单过期延迟队列的键"""
+        return self.key('order', 'expire')
+
+    @property
+    def seckill_expire_key(self):
+        """秒杀订单过期延迟队列的键，member为 订单pk-秒杀活动pk-用户pk-购买数量"""
+        return self.key('order', 'expire', 'seckill')
+
+    @staticmethod
+    def _deadline(efficient_time):
+        return int(time.mktime(efficient_time.timetuple()))
+
+    def _claim(self, key, count):
+        """领取一批到期的member，返回member列表和租约到期时间戳"""
+        now = int(time.time())
+        lease = now + self.RETRY_SECONDS
+        return self.claim_script(keys=[key], args=[now, count, lease]), lease
+
+    def _finish(self, key, members, lease):
+        if members:
+            self.ack_script(keys=[key], args=[lease] + list(members))
+
+    def set_order_expiration(self, order_basic):
+        """
+        订单加入过期延迟队列
+        :param order_basic: 订单instance，过期时间取efficient_time
+        """
+        self.redis.zadd(self.expire_key, {order_basic.pk: self._deadline(order_basic.efficient_time)})
+
+    def set_seckill_expiration(self, seckill_pk, orders):
+        """
+        秒杀订单加入过期延迟队列，重复加入同一订单只会更新过期时间
+        :param orders: list [(订单pk, 用户pk, 购买数量, efficient_time), ...]
+        """
+        if orders:
+            self.redis.zadd(self.seckill_expire_key, {
+                self.key(order_pk, seckill_pk, user_pk, counts): self._deadline(efficient_time)
+                for order_pk, user_pk, counts, efficient_time in orders})
+
+    def claim_expired_orders(self, count=1000):
+        """
+        领取一批已过期的订单，订单仍留在延迟队列中，租约到期前不会被再次领取
+        处理成功后调用finish_expired_orders移出延迟队列
+        :param count: 一次领取的最大数量
+        :return: tuple 订单pk列表, 租约到期时间戳
+        """
+        pks, lease = self._claim(self.expire_key, count)
+        return [int(pk) for pk in pks], lease
+
+    def finish_expired_orders(self, order_pks, lease):
+        """订单取消的事务提交后，把领取的订单移出延迟队列"""
+        self._finish(self.expire_key, order_pks, lease)
+
+    def claim_expired_seckill_orders(self, count=1000):
+        """
+        领取一批已过期的秒杀订单，租约与claim_expired_orders相同
+        :return: tuple [(订单pk, 秒杀活动pk, 用户pk, 购买数量), ...], 租约到期时间戳
+        """
+        members, lease = self._claim(self.seckill_expire_key, count)
+        return [tuple(int(value) for value in member.decode().split('-')) for member in members], lease
 
-    def set_order_expiration(self, pk):
-        """设置订单过期30min时间"""
-        with manager_redis(self.db) as redis:
-            key = OrderCreateSerializer.generate_orderid(pk)
-            redis.setex(key, 3000, 1)
+    def finish_expired_seckill_orders(self, orders, lease):
+        """秒杀订单取消并归还秒杀库存后，把领取的订单移出延迟队列"""
+        self._finish(self.seckill_expire_key, [self.key(*order) for order in orders], lease)
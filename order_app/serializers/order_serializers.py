@@ -3,12 +3,13 @@
 # @Author : 司云中 
 # @File : order_serializers.py
 # @Software: PyCharm
-import datetime
-
+from Emall.snowflake import snowflake
+from order_app.managers.order_manager import StockShortageError
 from order_app.models.order_models import Order_details, Order_basic
 from shop_app.models.commodity_models import Commodity
 from user_app.models import Address
-from django.db import transaction, DatabaseError
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import DatabaseError
 from Emall.loggings import Logging
 from rest_framework import serializers
 
@@ -82,7 +83,8 @@ class OrderBasicSerializer(serializers.ModelSerializer):
 
 
 class OrderCreateSerializer(serializers.ModelSerializer):
-    commodity_dict = serializers.DictField(child=serializers.IntegerField(max_value=9999), allow_empty=False)  # 商品-数量字典
+    commodity_dict = serializers.DictField(child=serializers.IntegerField(min_value=1, max_value=9999),
+                                            allow_empty=False)  # 商品-数量字典
     payment = serializers.CharField()
 
     def validate_payment(self, value):
@@ -90,67 +92,36 @@ class OrderCreateSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError('付款类型不正确')
         return value
 
-    @staticmethod
-    def compute_order_details(validated_data, order_basic, **kwargs):
-        """计算初始订单的商品价格"""
-
-        total_price = 0  # 订单总价
-        commodity_dict = validated_data['commodity_dict']
+    def validate_commodity_dict(self, value):
+        """商品pk转为整数"""
         try:
-            commodity = Commodity.commodity_.select_related('store', 'shopper').filter(
-                pk__in=[int(pk) for pk in commodity_dict.keys()])  # one hit database
-            for value in commodity:
-                # 创建详细订单表
-                Order_details.order_details_.create(belong_shopper=value.shopper,
-                                                    commodity=value,
-                                                    order_basic=order_basic,
-                                                    price=value.discounts * value.price,
-                                                    commodity_counts=commodity_dict.get(str(value.pk)),
-                                                    )
-                total_price += value.price * value.discounts * commodity_dict.get(str(value.pk))
-        except Exception as e:
-            order_logger.error(e)
-            return 0, 0
-        else:
-            return total_price, sum(value for value in commodity_dict.values())
+            return {int(pk): counts for pk, counts in value.items()}
+        except ValueError:
+            raise serializers.ValidationError('商品不存在')
 
     @staticmethod
-    def generate_orderid(pk):
-        """产生唯一订单号："""
-        now = datetime.datetime.now()
-        return '{third_year}{month}{day}{hour}{pk}{minute}{second}{microsecond}'.format(third_year=str(now.year)[2:],
-                                                                                        month=str(now.month),
-                                                                                        day=str(now.day),
-                                                                                        hour=str(now.hour),
-                                                                                        minute=str(now.minute),
-                                                                                        second=str(now.second),
-                                                                                        microsecond=str(
-                                                                                            now.microsecond),
-                                                                                        pk=str(pk))
+    def generate_orderid():
+        """产生唯一订单号：雪花算法，按时间递增"""
+        return str(snowflake.next_id())
 
     @staticmethod
     def get_address(user):
         return Address.address_.get(user=user, default_address=True)
 
     def create_order(self, validated_data, user, redis):
-        """创建初始订单"""
+        """创建初始订单，锁定库存"""
         try:
-            with transaction.atomic():
-                pk = user.pk
-                orderId = self.generate_orderid(pk)  # 产生订单号
-                address = self.get_address(user)
-                order_basic = Order_basic.order_basic_.create(consumer=user, region=address, orderId=orderId,
-                                                              payment=validated_data.get('payment'))  # 创建初始订单
-                total_price, total_counts = self.compute_order_details(validated_data, order_basic)  # 计算总价和总数量
-                # 重新修改订单表总数量
-                order_basic.total_price = total_price
-                order_basic.total_counts = total_counts
-                order_basic.save(update_fields=['total_price', 'commodity_total_counts'])
-        except DatabaseError as e:  # rollback
+            orderId = self.generate_orderid()  # 产生订单号
+            address = self.get_address(user)
+            order_basic = Order_basic.order_basic_.create_order(user, address, orderId, validated_data.get('payment'),
+                                                                validated_data['commodity_dict'])
+        except StockShortageError:
+            raise serializers.ValidationError('库存不足')
+        except (DatabaseError, ObjectDoesNotExist) as e:  # rollback
             order_logger.error(e)
             return None
         else:
-            redis.set_order_expiration(pk)  # 设置订单过期时间
+            redis.set_order_expiration(order_basic)  # 设置订单过期时间，过期未付款归还库存
             return order_basic
 
     class Meta:
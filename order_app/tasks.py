@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+# @Time  : 2020/11/16 下午3:12
+# @Author : 司云中
+# @File : tasks.py
+# @Software: Pycharm
+from django.db import DatabaseError, DataError, IntegrityError
+
+from Emall import celery_apps as app
+from Emall.loggings import Logging
+from order_app.models.order_models import Order_basic
+from order_app.redis.order_redis import RedisOrderOperation
+from shop_app.redis.seckill_redis import seckill_redis
+
+order_logger = Logging.logger('order_')
+
+order_redis = RedisOrderOperation.choice_redis_db('redis')
+
+
+def parse_winner(entry_id, fields):
+    """stream中的消息 -> 买家，消息已被删除或格式错误时返回None"""
+    try:
+        return dict(user=int(fields['user']), counts=int(fields['counts']), token=fields['token'],
+                    commodity=int(fields['commodity']), shopper=int(fields['shopper']), price=fields['price'],
+                    orderId=fields['orderId'])
+    except (KeyError, ValueError):
+        order_logger.error('dropping malformed seckill entry {}: {}'.format(entry_id, fields))
+        return None
+
+
+def create_seckill_orders(seckill_pk, winners, addresses):
+    """批量生成订单并加入秒杀订单的过期延迟队列"""
+    orders = Order_basic.order_basic_.bulk_create_seckill_orders(winners, addresses)
+    order_redis.set_seckill_expiration(seckill_pk, [
+        (orders[winner['orderId']][0], winner['user'], winner['counts'], orders[winner['orderId']][1])
+        for winner in winners])
+
+
+def create_seckill_orders_one_by_one(seckill_pk, winners, addresses):
+    """
+    逐个生成订单，个别买家的数据导致写入失败(IntegrityError, DataError)时不影响其他买家
+    数据库不可用等与数据无关的错误继续抛出，这批消息不ack，避免把所有买家都当作失败
+    :return: tuple 成功的买家, 失败的买家
+    """
+    created, failed = [], []
+    for winner in winners:
+        try:
+            create_seckill_orders(seckill_pk, [winner], addresses)
+        except (IntegrityError, DataError) as e:
+            order_logger.error('failed to create seckill order {}: {}'.format(winner['orderId'], e))
+            failed.append(winner)
+        else:
+            created.append(winner)
+    return created, failed
+
+
+def materialize_seckill(seckill_pk, batch_size):
+    """
+    消费一个秒杀活动的抢购成功者stream，批量生成订单，并加入秒杀订单的过期延迟队列
+    数据库写入失败时不ack，下次定时任务重新读取这批消息
+    同一批消息投递超过MAX_DELIVERIES次时改为逐个生成，仍然失败的买家归还库存并标记为生成失败，
+    反复失败的一批消息不会阻塞该活动之后的所有买家
+    订单号在抢购时分配，重新读取时已生成的订单不会重复生成，没有默认地址的买家不会重复归还库存
+    :return: int 本次处理的买家数量
+    """
+    entries = seckill_redis.read_winners(seckill_pk, batch_size)
+    if not entries:
+        seckill_redis.deactivate_if_drained(seckill_pk)
+        return 0
+    entry_ids = [entry_id for entry_id, _ in entries]
+    winners = [winner for winner in (parse_winner(entry_id, fields) for entry_id, fields in entries) if winner]
+    addresses = Order_basic.order_basic_.default_addresses([winner['user'] for winner in winners])
+    accepted = [winner for winner in winners if winner['user'] in addresses]
+    rejected = [winner for winner in winners if winner['user'] not in addresses]  # 没有默认地址，无法生成订单
+    deliveries = seckill_redis.delivery_counts(seckill_pk, entry_ids)
+    if accepted and max(deliveries.values(), default=1) > seckill_redis.MAX_DELIVERIES:
+        accepted, failed = create_seckill_orders_one_by_one(seckill_pk, accepted, addresses)
+        rejected += failed
+    elif accepted:
+        create_seckill_orders(seckill_pk, accepted, addresses)
+    for winner in rejected:  # 订单落库成功后再归还库存
+        seckill_redis.release(seckill_pk, winner['user'], winner['counts'], winner['token'])
+    order_status = {winner['token']: (seckill_redis.ORDER_SUCCESS, winner['orderId']) for winner in accepted}
+    order_status.update({winner['token']: (seckill_redis.ORDER_FAILED, None) for winner in rejected})
+    seckill_redis.finish_winners(seckill_pk, entry_ids, order_status)
+    return len(entries)
+
+
+@app.task
+def materialize_seckill_orders(batch_size=500):
+    """定时消费所有秒杀活动的抢购成功者，异步生成订单"""
+    for seckill_pk in seckill_redis.active_seckills():
+        if not seckill_redis.acquire_materialize_lock(seckill_pk):  # 上一次任务仍在处理该活动
+            continue
+        try:
+            while materialize_seckill(seckill_pk, batch_size) == batch_size:  # 积压较多时连续处理
+                pass
+        except DatabaseError as e:
+            order_logger.error(e)
+        finally:
+            seckill_redis.release_materialize_lock(seckill_pk)
+
+
+@app.task
+def cancel_expired_orders(batch_size=1000, max_batches=100):
+    """
+    定时取消超时未付款的订单，归还锁定的库存
+    每批领取batch_size个到期订单，用一次批量UPDATE取消，事务提交后才移出延迟队列
+    积压时连续处理直到清空或达到max_batches
+    :return: int 取消的订单数量
+    """
+    cancelled = 0
+    for _ in range(max_batches):
+        order_pks, lease = order_redis.claim_expired_orders(batch_size)
+        if not order_pks:
+            break
+        try:
+            cancelled += len(Order_basic.order_basic_.cancel_unpaid_orders(order_pks))
+        except DatabaseError as e:  # 不移出延迟队列，租约到期后重试
+            order_logger.error(e)
+            break
+        order_redis.finish_expired_orders(order_pks, lease)
+        if len(order_pks) < batch_size:
+            break
+    return cancelled + cancel_expired_seckill_orders(batch_size, max_batches)
+
+
+def cancel_expired_seckill_orders(batch_size, max_batches):
+    """
+    取消超时未付款的秒杀订单
+    秒杀订单没有扣减商品库存，取消时不归还商品库存，而是归还秒杀库存和限购名额
+    :return: int 取消的订单数量
+    """
+    cancelled = 0
+    for _ in range(max_batches):
+        orders, lease = order_redis.claim_expired_seckill_orders(batch_size)
+        if not orders:
+            break
+        try:
+            order_pks = set(Order_basic.order_basic_.cancel_unpaid_orders([order[0] for order in orders],
+                                                                          release=False))
+        except DatabaseError as e:  # 不移出延迟队列，租约到期后重试
+            order_logger.error(e)
+            break
+        for order_pk, seckill_pk, user_pk, counts in orders:
+            if order_pk in order_pks:
+                seckill_redis.release(seckill_pk, user_pk, counts)
+        order_redis.finish_expired_seckill_orders(orders, lease)
+        cancelled += len(order_pks)
+        if len(orders) < batch_size:
+            break
+    return cancelled
@@ -3,6 +3,8 @@
 # @Author : 司云中
 # @File : order.py
 # @Software: PyCharm
+import datetime
+
 from django.contrib.auth.decorators import login_required
 from django.db import DatabaseError, transaction
 from django.utils.decorators import method_decorator
@@ -35,8 +37,6 @@ class OrderBasicOperation(viewsets.GenericViewSet):
 
     serializer_class = OrderBasicSerializer
 
-    redis = RedisOrderOperation.choice_redis_db('redis')  # 选择redis具体db
-
     def get_queryset(self):
         """默认获取该用户的所有订单"""
         return Order_basic.order_basic_.filter(consumer=self.request.user)
@@ -93,10 +93,11 @@ class OrderBasicOperation(viewsets.GenericViewSet):
         """获取具体的单个订单细节"""
         instance = self.get_object()
         serializer = self.get_serializer(instance=instance)
-        expire = self.redis.get_ttl('order_{pk}_expire'.format(pk=self.kwargs.get(self.lookup_field)))
-        if expire != -1 and expire != -2:
-            serializer.data.update({'order_expire': expire})
-        return Response(serializer.data)
+        data = serializer.data
+        if instance.status == '1' and instance.efficient_time:  # 代付款订单返回剩余付款时间，直接由过期时间计算
+            expire = int((instance.efficient_time - datetime.datetime.now()).total_seconds())
+            data.update({'order_expire': max(expire, 0)})
+        return Response(data)
 
 
 class OrderListOperation(GenericAPIView):
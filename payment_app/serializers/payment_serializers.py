@@ -3,8 +3,7 @@
 # @Author : 司云中 
 # @File : payment_serializers.py
 # @Software: PyCharm
-import time
-
+from Emall.snowflake import snowflake
 from user_app.models import User
 
 from order_app.models.order_models import Order_basic, Order_details
@@ -14,7 +13,8 @@ from user_app.models import Address
 from Emall.loggings import Logging
 from rest_framework import serializers
 
-from django.db import transaction, DatabaseError
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import DatabaseError
 
 common_logger = Logging.logger('django')
 
@@ -79,38 +79,15 @@ class PaymentSerializer(serializers.ModelSerializer):
             return total_price-exist_bonus
 
     @staticmethod
-    def compute_generate_order_details(request, order_basic, **kwargs):
-        """compute the base information of these goods with appointed counts"""
-        commodity_id_counts = {}  # use dict store map between id and counts
-        common_logger.info(type(request.session.get('commodity_list')))
+    def get_commodity_counts(request):
+        """the map between id and counts of these goods which stored in session"""
         session_commodity_list = request.session.get('commodity_list', None)
         session_counts_list = request.session.get('counts_list', None)
 
         # 防止接口攻击
         if session_commodity_list is None or session_counts_list is None:
-            raise Exception
-
-        total_price = 0  # 订单总价
-        try:
-            # generate dict
-            for pk, counts in zip(session_commodity_list, session_counts_list):
-                commodity_id_counts[pk] = counts
-            commodity = Commodity.commodity_.select_related('store', 'shopper').filter(
-                pk__in=session_commodity_list)  # one hit database
-            for value in commodity:
-                order_details = Order_details.order_details_.create(belong_shopper=value.shopper,
-                                                                    commodity=value,
-                                                                    order_basic=order_basic,
-                                                                    price=value.discounts * value.price,
-                                                                    commodity_counts=commodity_id_counts.get(value.pk),
-                                                                    )
-                total_price += value.price * value.discounts * commodity_id_counts.get(value.pk)
-            total_price = PaymentSerializer.compute_total_price(total_price)
-        except Exception as e:
-            order_logger.error(e)
-            return None, 0
-        else:
-            return total_price, sum(session_counts_list)
+            raise Commodity.DoesNotExist('session中不存在商品')
+        return {int(pk): counts for pk, counts in zip(session_commodity_list, session_counts_list)}
 
     @staticmethod
     def get_address(request):
@@ -128,22 +105,14 @@ class PaymentSerializer(serializers.ModelSerializer):
     def create_order(request, user, **data):
         """create new order"""
         try:
-            # 是否需要开启事务提交?
-            with transaction.atomic():
-                orderId = int(round(time.time() * 1000000))
-                address = PaymentSerializer.get_address(request)
-                # 默认支付方式为支付宝
-                payment = PaymentSerializer.choice_payment()
-                order_basic = Order_basic.order_basic_.create(consumer=user, region=address, orderId=orderId,
-                                                              payment=payment, **data)
-                total_price, total_counts = PaymentSerializer.compute_generate_order_details(request, order_basic,
-                                                                                             **data)
-                if total_price is None:
-                    raise DatabaseError
-                # update total_price
-                order_basic.total_price = total_price
-                order_basic.save()
-        except DatabaseError as e:  # rollback
+            orderId = snowflake.next_id()
+            address = PaymentSerializer.get_address(request)
+            # 默认支付方式为支付宝
+            payment = PaymentSerializer.choice_payment()
+            order_basic = Order_basic.order_basic_.create_order(user, address, orderId, payment,
+                                                                PaymentSerializer.get_commodity_counts(request),
+                                                                **data)
+        except (DatabaseError, ObjectDoesNotExist) as e:  # rollback
             common_logger.info(e)
             return None
         else:
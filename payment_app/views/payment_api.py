@@ -3,8 +3,6 @@
 # @Author : 司云中 
 # @File : payment_api.py 
 # @Software: PyCharm
-import time
-
 from alipay import AliPay
 from django.contrib.auth.decorators import login_required
 from django.shortcuts import redirect
@@ -15,8 +13,10 @@ from rest_framework.views import APIView
 
 from Emall import settings
 from Emall.loggings import Logging
+from Emall.snowflake import snowflake
 from Emall.response_code import response_code
 from order_app.models.order_models import Order_basic
+from order_app.redis.order_redis import RedisOrderOperation
 from payment_app.serializers.payment_serializers import PaymentSerializer
 
 common_logger = Logging.logger('django')
@@ -31,6 +31,8 @@ class PaymentOperation(GenericAPIView):
 
     serializer_class = PaymentSerializer
 
+    redis = RedisOrderOperation.choice_redis_db('redis')
+
     app_private_key_string = open(settings.APP_KEY_PRIVATE_PATH).read()
     alipay_public_key_string = open(settings.ALIPAY_PUBLIC_KEY_PATH).read()
 
@@ -71,6 +73,7 @@ class PaymentOperation(GenericAPIView):
         order = self.get_serializer_class().create_order(request, user)
         if order is None:
             return Response(response_code.create_order_error)
+        self.redis.set_order_expiration(order)  # 过期未付款归还库存
         # 创建alipay对象
         alipay = self.get_alipay
         # 调用方法,生成url
@@ -102,7 +105,7 @@ class UpdateOperation(APIView):
     @property
     def generate_trade_num(self):
         """生成交易号成功号"""
-        return int(round(time.time() * 1000000))
+        return snowflake.next_id()
 
     @staticmethod
     def update_order(order_id):
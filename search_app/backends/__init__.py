@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# @Time  : 2020/11/24 上午9:05
+# @Author : 司云中
+# @File : __init__.py
+# @Software: Pycharm
+import threading
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from search_app.backends.base import BaseSearchBackend, SearchBackendError, SearchResult
+
+__all__ = ['BaseSearchBackend', 'SearchBackendError', 'SearchResult', 'get_backend']
+
+DEFAULT_SEARCH_BACKEND = {
+    'ENGINE': 'search_app.backends.local.LocalSearchBackend',
+    'OPTIONS': {},
+}
+
+_backend = None
+_lock = threading.Lock()
+
+
+def get_backend():
+    """
+    按settings.SEARCH_BACKEND创建搜索后端，进程内只创建一次
+    OPTIONS的键转为小写后作为构造参数
+    """
+    global _backend
+    if _backend is None:
+        with _lock:
+            if _backend is None:
+                config = getattr(settings, 'SEARCH_BACKEND', DEFAULT_SEARCH_BACKEND)
+                options = {key.lower(): value for key, value in config.get('OPTIONS', {}).items()}
+                _backend = import_string(config['ENGINE'])(**options)
+    return _backend
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+# @Time  : 2020/11/24 上午9:12
+# @Author : 司云中
+# @File : base.py
+# @Software: Pycharm
+from collections import namedtuple
+
+from Emall.loggings import Logging
+
+search_logger = Logging.logger('django')
+
+# 价格聚合的区间 [from, to)，None表示不限
+PRICE_RANGES = ((0, 100), (100, 500), (500, 1000), (1000, 5000), (5000, None))
+
+
+class SearchResult(namedtuple('SearchResult', ['total', 'hits', 'facets'])):
+    """
+    total: 命中的总数
+    hits: 当前窗口内排好序的索引文档，见BaseSearchBackend.document
+    facets: {'category': [{'value':, 'count':}], 'province': [...], 'price': [{'from':, 'to':, 'count':}]}
+    """
+
+    @property
+    def pks(self):
+        return [hit['pk'] for hit in self.hits]
+
+
+EMPTY_RESULT = SearchResult(0, [], {})
+
+
+class SearchBackendError(Exception):
+    """搜索后端请求失败"""
+
+
+class SearchQuery:
+    """
+    搜索条件
+    text为空时只按过滤条件筛选，关键字和过滤条件都为空时不查询
+    """
+
+    # 排序方式 -> (索引字段, 是否降序)，relevance有关键字时按相关度，否则按上架先后
+    SORTS = {
+        'relevance': None,
+        '-sell_counts': ('sell_counts', True),
+        'price': ('price', False),
+        '-price': ('price', True),
+    }
+
+    def __init__(self, text='', category=None, min_price=None, max_price=None, max_discounts=None,
+                 province=None, city=None, sort='relevance', facets=False):
+        self.text = text
+        self.category = category
+        self.min_price = min_price
+        self.max_price = max_price
+        self.max_discounts = max_discounts
+        self.province = province
+        self.city = city
+        self.sort = sort
+        self.facets = facets  # 是否统计聚合
+
+    @property
+    def terms(self):
+        """精确匹配的过滤条件"""
+        return {field: getattr(self, field) for field in ('category', 'province', 'city') if getattr(self, field)}
+
+    @property
+    def ordering(self):
+        return self.SORTS[self.sort]
+
+    def is_empty(self):
+        return not self.text and not self.terms and self.min_price is None and self.max_price is None and \
+            self.max_discounts is None
+
+
+class BaseSearchBackend:
+    """
+    商品搜索后端接口
+    索引中保存商品卡片所需的全部字段，搜索结果直接返回索引文档，不再查询数据库
+    子类通过settings.SEARCH_BACKEND的ENGINE指定，OPTIONS作为关键字参数传入
+    """
+
+    # 建立索引的文本字段 -> 相关度权重
+    TEXT_FIELDS = (
+        ('commodity_name', 10.0),
+        ('category', 5.0),
+        ('intro', 2.0),
+        ('label', 1.0),
+    )
+
+    # 影响索引文档的模型字段，save(update_fields=...)只修改其他字段时无需重建该商品的索引
+    INDEXED_FIELDS = ('commodity_name', 'category', 'intro', 'label', 'status', 'price', 'discounts',
+                      'sell_counts', 'image', 'store')
+
+    # 影响索引文档的店铺字段
+    STORE_FIELDS = ('store_name', 'province', 'city')
+
+    def __init__(self, silently_fail=True, **options):
+        self.silently_fail = silently_fail
+        self.options = options
+
+    @classmethod
+    def document(cls, commodity):
+        """商品 -> 索引文档，调用方需select_related('store')"""
+        store = commodity.store
+        return {
+            'pk': commodity.pk,
+            'commodity_name': commodity.commodity_name,
+            'category': commodity.category,
+            'intro': commodity.intro or '',
+            'label': commodity.label or '',
+            'price': commodity.price,
+            'discounts': float(commodity.discounts),
+            'sell_counts': commodity.sell_counts,
+            'image': commodity.image.name or '',
+            'store_id': commodity.store_id,
+            'store_name': store.store_name,
+            'province': store.province,
+            'city': store.city,
+        }
+
+    def search(self, query, offset=0, limit=20):
+        """
+        搜索
+        :param query: SearchQuery
+        :return: SearchResult
+        """
+        raise NotImplementedError
+
+    def update(self, commodities):
+        """建立或更新索引，未上架的商品从索引中删除"""
+        raise NotImplementedError
+
+    def remove(self, pks):
+        """从索引中删除商品"""
+        raise NotImplementedError
+
+    def clear(self):
+        """清空索引"""
+        raise NotImplementedError
+
+    def fail(self, error):
+        """请求失败时记录日志，silently_fail为False时抛出SearchBackendError"""
+        search_logger.error('{}: {}'.format(self.__class__.__name__, error))
+        if not self.silently_fail:
+            raise SearchBackendError(error) from error
+        return EMPTY_RESULT
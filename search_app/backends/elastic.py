@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+# @Time  : 2020/11/24 上午9:40
+# @Author : 司云中
+# @File : elastic.py
+# @Software: Pycharm
+import os
+import threading
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+from search_app.backends.base import BaseSearchBackend, EMPTY_RESULT, PRICE_RANGES, SearchResult
+
+
+class ElasticsearchBackend(BaseSearchBackend):
+    """
+    Elasticsearch搜索后端
+    地址和索引默认读取HAYSTACK_CONNECTIONS['default']，索引的建立和更新仍由haystack的CommodityIndex完成
+    每个进程共享一个带连接池的requests.Session，查询使用JSON DSL，不再拼接Lucene查询字符串
+    """
+
+    INDEXED_FIELDS = BaseSearchBackend.INDEXED_FIELDS + ('shopper',)  # CommodityIndex.shopper
+
+    # CommodityIndex中保存的索引文档字段，与BaseSearchBackend.document一致
+    DOCUMENT_FIELDS = ('pk', 'commodity_name', 'category', 'intro', 'label', 'price', 'discounts', 'sell_counts',
+                       'image', 'store_id', 'store_name', 'province', 'city')
+
+    @classmethod
+    def document(cls, commodity):
+        document = super().document(commodity)
+        document['shopper_id'] = commodity.shopper_id
+        return document
+
+    def __init__(self, url=None, index_name=None, timeout=(1, 3), pool_size=32, retries=1, **options):
+        super().__init__(**options)
+        connection = settings.HAYSTACK_CONNECTIONS['default']
+        self.url = (url or connection['URL']).rstrip('/')
+        self.index_name = index_name or connection['INDEX_NAME']
+        self.timeout = tuple(timeout) if isinstance(timeout, (list, tuple)) else timeout  # (连接超时, 读超时)
+        self.pool_size = pool_size
+        self.retries = retries  # 只对建立连接失败重试，读超时不重试
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        """进程内共享的Session，fork之后子进程重新创建，避免共用父进程的socket"""
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size,
+                                          max_retries=self.retries, pool_block=True)
+                    session.mount('http://', adapter)
+                    session.mount('https://', adapter)
+                    self._session, self._pid = session, os.getpid()
+        return self._session
+
+    def build_query(self, query, offset, limit):
+        """
+        搜索条件 -> DSL
+        过滤条件放在bool.filter中不参与评分，精确匹配使用haystack为faceted字段生成的*_exact字段
+        """
+        filters = [{'term': {'{}_exact'.format(field): value}} for field, value in query.terms.items()]
+        for field, operator, value in (('price', 'gte', query.min_price), ('price', 'lte', query.max_price),
+                                       ('discounts', 'lte', query.max_discounts)):
+            if value is not None:
+                filters.append({'range': {field: {operator: float(value)}}})
+        body = {
+            'query': {'bool': {
+                'must': {'match': {'text': {'query': query.text, 'operator': 'and'}}} if query.text else
+                {'match_all': {}},
+                'filter': filters,
+            }},
+            'from': offset,
+            'size': limit,
+            '_source': ['django_id'] + [field for field in self.DOCUMENT_FIELDS if field != 'pk'],
+        }
+        ordering = query.ordering
+        if ordering is not None:
+            body['sort'] = [{ordering[0]: 'desc' if ordering[1] else 'asc'}, '_score']
+        if query.facets:
+            body['aggs'] = {
+                'category': {'terms': {'field': 'category_exact', 'size': 50}},
+                'province': {'terms': {'field': 'province_exact', 'size': 50}},
+                'price': {'range': {'field': 'price', 'ranges': [
+                    dict((key, value) for key, value in (('from', low), ('to', high)) if value is not None)
+                    for low, high in PRICE_RANGES]}},
+            }
+        return body
+
+    @staticmethod
+    def parse_facets(aggregations):
+        """聚合结果 -> 与其他后端一致的facets格式"""
+        if not aggregations:
+            return {}
+        facets = {field: [{'value': bucket['key'], 'count': bucket['doc_count']}
+                          for bucket in aggregations[field]['buckets'] if bucket['key']]
+                  for field in ('category', 'province')}
+        facets['price'] = [{'from': low, 'to': high, 'count': bucket['doc_count']}
+                           for (low, high), bucket in zip(PRICE_RANGES, aggregations['price']['buckets'])]
+        return facets
+
+    def search(self, query, offset=0, limit=20):
+        if query.is_empty():
+            return EMPTY_RESULT
+        try:
+            response = self.session.post('{}/{}/_search'.format(self.url, self.index_name),
+                                         json=self.build_query(query, offset, limit), timeout=self.timeout)
+            response.raise_for_status()
+            data = response.json()
+            hits = data['hits']
+        except (requests.RequestException, ValueError, KeyError) as e:
+            return self.fail(e)
+        total = hits['total']
+        if isinstance(total, dict):  # 7.x: {'value': , 'relation': }
+            total = total['value']
+        documents = []
+        for hit in hits['hits']:
+            source = hit['_source']
+            document = {field: source.get(field) for field in self.DOCUMENT_FIELDS if field != 'pk'}
+            document['pk'] = int(source['django_id'])
+            documents.append(document)
+        return SearchResult(total, documents, self.parse_facets(data.get('aggregations')))
+
+    @staticmethod
+    def haystack():
+        """haystack的后端和商品索引"""
+        from haystack import connections
+        from shop_app.models.commodity_models import Commodity
+        connection = connections['default']
+        return connection.get_backend(), connection.get_unified_index().get_index(Commodity)
+
+    def update(self, commodities):
+        backend, index = self.haystack()
+        commodities = list(commodities)
+        backend.update(index, [commodity for commodity in commodities if commodity.status])
+        for commodity in commodities:
+            if not commodity.status:
+                backend.remove(commodity)
+
+    def remove(self, pks):
+        backend, index = self.haystack()
+        model = index.get_model()
+        for pk in pks:
+            backend.remove('{}.{}.{}'.format(model._meta.app_label, model._meta.model_name, pk))
+
+    def clear(self):
+        backend, index = self.haystack()
+        backend.clear(models=[index.get_model()])
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+# @Time  : 2020/11/24 上午10:25
+# @Author : 司云中
+# @File : local.py
+# @Software: Pycharm
+import json
+import os
+import re
+import sqlite3
+import threading
+
+from django.conf import settings
+
+from search_app.backends.base import BaseSearchBackend, EMPTY_RESULT, PRICE_RANGES, SearchResult
+
+# 连续的汉字 / 连续的字母数字
+TOKEN_RE = re.compile(r'[一-鿿]+|[0-9a-z]+')
+
+MAX_QUERY_TOKENS = 32  # 查询最多使用的词数，防止超长输入拖慢查询
+
+
+def tokenize(text, query=False):
+    """
+    分词：字母数字按单词，汉字按二元组(bigram)
+    建索引时额外保留单字，使"衣"和"衣服"都能命中
+    查询时只取不重叠的二元组(奇数长度补上最后一个)，"红色衣服"拆为"红色"和"衣服"，两个词出现在不同字段也能命中
+    """
+    tokens = []
+    for word in TOKEN_RE.findall((text or '').lower()):
+        if word[0] < '一' or len(word) == 1:
+            tokens.append(word)
+        elif query:
+            tokens.extend(word[i:i + 2] for i in range(0, len(word) - 1, 2))
+            if len(word) % 2:
+                tokens.append(word[-2:])
+        else:
+            tokens.extend(word)
+            tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+    return tokens
+
+
+class LocalSearchBackend(BaseSearchBackend):
+    """
+    内置的SQLite FTS5倒排索引，不依赖外部服务，用于开发和压测
+    全文表commodity的rowid即商品pk，文本在写入前按tokenize分词，FTS5只按空格切分，相关度按bm25加权排序
+    文档表commodity_doc保存过滤、排序、聚合用的列和JSON格式的索引文档，搜索结果直接取自该表
+    索引由search_app.utils.signal_processor.QueuedSignalProcessor异步批量更新
+    每个线程一个连接，开启WAL使读写互不阻塞
+    """
+
+    # 文档表中可过滤、排序、聚合的列
+    COLUMNS = ('category', 'province', 'city', 'price', 'discounts', 'sell_counts')
+
+    def __init__(self, path=None, **options):
+        super().__init__(**options)
+        self.path = path or os.path.join(settings.BASE_DIR, 'search_index', 'commodity.sqlite3')
+        self.table = 'commodity'
+        self.doc_table = 'commodity_doc'
+        self.weights = ', '.join(str(weight) for _, weight in self.TEXT_FIELDS)
+        self._local = threading.local()
+        self._created = False
+
+    def create_tables(self, connection):
+        connection.execute('CREATE VIRTUAL TABLE IF NOT EXISTS {} USING fts5({}, tokenize="unicode61")'.format(
+            self.table, ', '.join(field for field, _ in self.TEXT_FIELDS)))
+        connection.execute('CREATE TABLE IF NOT EXISTS {} (pk INTEGER PRIMARY KEY, category TEXT, province TEXT, '
+                           'city TEXT, price INTEGER, discounts REAL, sell_counts INTEGER, document TEXT)'.format(
+                            self.doc_table))
+        for columns in ('category', 'province, city', 'price', 'sell_counts'):
+            connection.execute('CREATE INDEX IF NOT EXISTS {0}_{1} ON {0} ({2})'.format(
+                self.doc_table, columns.replace(', ', '_'), columns))
+
+    @property
+    def connection(self):
+        """当前线程的连接，fork之后子进程重新连接"""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            if not self._created:
+                self.create_tables(connection)
+                self._created = True
+            self._local.connection, self._local.pid = connection, os.getpid()
+        return connection
+
+    @staticmethod
+    def match_expression(text):
+        """关键字 -> FTS5的MATCH表达式，每个词加引号转义后取交集"""
+        tokens = list(dict.fromkeys(tokenize(text, query=True)))[:MAX_QUERY_TOKENS]
+        return ' AND '.join('"{}"'.format(token.replace('"', '""')) for token in tokens)
+
+    def where(self, query):
+        """
+        搜索条件 -> (FROM子句, WHERE子句, 参数)
+        有关键字时连接全文表，关键字分词后为空(如只有标点)返回None
+        """
+        tables, clauses, params = ['{} AS d'.format(self.doc_table)], [], []
+        if query.text:
+            expression = self.match_expression(query.text)
+            if not expression:
+                return None
+            tables.append('JOIN {0} ON {0}.rowid = d.pk'.format(self.table))
+            clauses.append('{0} MATCH ?'.format(self.table))
+            params.append(expression)
+        for column, value in query.terms.items():
+            clauses.append('d.{} = ?'.format(column))
+            params.append(value)
+        for column, operator, value in (('price', '>=', query.min_price), ('price', '<=', query.max_price),
+                                        ('discounts', '<=', query.max_discounts)):
+            if value is not None:
+                clauses.append('d.{} {} ?'.format(column, operator))
+                params.append(float(value))
+        return ' '.join(tables), ' AND '.join(clauses) or '1', params
+
+    def order_by(self, query):
+        ordering = query.ordering
+        if ordering is not None:
+            return 'd.{} {}, d.pk DESC'.format(ordering[0], 'DESC' if ordering[1] else 'ASC')
+        if query.text:
+            return 'bm25({}, {})'.format(self.table, self.weights)
+        return 'd.pk DESC'
+
+    def facets(self, tables, where, params):
+        """在搜索条件内统计分类、省份和价格区间的数量"""
+        result = {}
+        for column in ('category', 'province'):
+            rows = self.connection.execute(
+                'SELECT d.{0}, count(*) AS counts FROM {1} WHERE {2} GROUP BY d.{0} ORDER BY counts DESC'.format(
+                    column, tables, where), params).fetchall()
+            result[column] = [{'value': value, 'count': counts} for value, counts in rows if value]
+        cases = ' '.join('WHEN d.price < {} THEN {}'.format(high, i) for i, (_, high) in enumerate(PRICE_RANGES)
+                         if high is not None)
+        rows = dict(self.connection.execute(
+            'SELECT CASE {} ELSE {} END AS bucket, count(*) FROM {} WHERE {} GROUP BY bucket'.format(
+                cases, len(PRICE_RANGES) - 1, tables, where), params).fetchall())
+        result['price'] = [{'from': low, 'to': high, 'count': rows.get(i, 0)}
+                           for i, (low, high) in enumerate(PRICE_RANGES)]
+        return result
+
+    def search(self, query, offset=0, limit=20):
+        if query.is_empty():
+            return EMPTY_RESULT
+        sql = self.where(query)
+        if sql is None:
+            return EMPTY_RESULT
+        tables, where, params = sql
+        try:
+            total = self.connection.execute('SELECT count(*) FROM {} WHERE {}'.format(tables, where),
+                                            params).fetchone()[0]
+            rows = self.connection.execute('SELECT d.document FROM {} WHERE {} ORDER BY {} LIMIT ? OFFSET ?'.format(
+                tables, where, self.order_by(query)), params + [limit, offset]).fetchall() if total > offset else []
+            facets = self.facets(tables, where, params) if query.facets else {}
+        except sqlite3.Error as e:
+            return self.fail(e)
+        return SearchResult(total, [json.loads(row[0]) for row in rows], facets)
+
+    def update(self, commodities):
+        commodities = list(commodities)
+        if not commodities:
+            return
+        texts, docs = [], []
+        for commodity in commodities:
+            if not commodity.status:
+                continue
+            document = self.document(commodity)
+            texts.append([commodity.pk] + [' '.join(tokenize(document[field])) for field, _ in self.TEXT_FIELDS])
+            docs.append([commodity.pk] + [document[column] for column in self.COLUMNS] +
+                        [json.dumps(document, ensure_ascii=False)])
+        connection = self.connection
+        with connection:  # 一个事务内先删后插
+            connection.execute('BEGIN')
+            self._delete(connection, [commodity.pk for commodity in commodities])
+            connection.executemany('INSERT INTO {} (rowid, {}) VALUES (?, {})'.format(
+                self.table, ', '.join(field for field, _ in self.TEXT_FIELDS),
+                ', '.join('?' * len(self.TEXT_FIELDS))), texts)
+            connection.executemany('INSERT INTO {} (pk, {}, document) VALUES (?, {}, ?)'.format(
+                self.doc_table, ', '.join(self.COLUMNS), ', '.join('?' * len(self.COLUMNS))), docs)
+
+    def _delete(self, connection, pks):
+        for table, column in ((self.table, 'rowid'), (self.doc_table, 'pk')):
+            connection.executemany('DELETE FROM {} WHERE {} = ?'.format(table, column), [(pk,) for pk in pks])
+
+    def remove(self, pks):
+        connection = self.connection
+        with connection:
+            connection.execute('BEGIN')
+            self._delete(connection, pks)
+
+    def clear(self):
+        connection = self.connection
+        with connection:
+            connection.execute('BEGIN')
+            connection.execute('DELETE FROM {}'.format(self.table))
+            connection.execute('DELETE FROM {}'.format(self.doc_table))
+
+    def optimize(self):
+        """合并FTS5的段，全量重建之后执行一次"""
+        self.connection.execute("INSERT INTO {0} ({0}) VALUES ('optimize')".format(self.table))
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+# @Time  : 2020/11/24 下午2:12
+# @Author : 司云中
+# @File : rebuild_search_index.py
+# @Software: Pycharm
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.models import Max, Min
+
+from search_app.backends import get_backend
+from search_app.redis.index_redis import index_redis
+from search_app.redis.search_cache_redis import search_cache
+from search_app.utils.indexing import index_commodities
+from shop_app.models.commodity_models import Commodity
+
+
+class Command(BaseCommand):
+    """
+    按settings.SEARCH_BACKEND清空并重建商品索引，只索引已上架的商品
+    按pk区间切分为多个批次，由多个线程并行读取数据库并写入索引，每个线程使用各自的数据库连接
+    重建期间被修改的商品仍由索引队列处理，重建完成后最多延迟一个定时任务周期
+    """
+
+    help = 'Rebuild the commodity search index of the configured search backend'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch', type=int, default=1000, help='每批的pk区间长度')
+        parser.add_argument('--workers', type=int, default=4, help='并行的线程数')
+        parser.add_argument('--no-clear', action='store_true', help='不清空索引，只覆盖写入')
+
+    def handle(self, *args, **options):
+        backend = get_backend()
+        queryset = Commodity.commodity_.filter(status=True)
+        bounds = queryset.aggregate(low=Min('pk'), high=Max('pk'))
+        total = queryset.count()
+        if not options['no_clear']:
+            backend.clear()
+            index_redis.clear_fingerprints()
+            search_cache.invalidate_all()
+        if not total:
+            self.stdout.write(self.style.SUCCESS('no commodity to index'))
+            return
+        ranges = [(low, low + options['batch']) for low in range(bounds['low'], bounds['high'] + 1, options['batch'])]
+        indexed, start, reported = 0, time.time(), 0
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            futures = [executor.submit(self.index_range, backend, queryset, low, high) for low, high in ranges]
+            for future in as_completed(futures):
+                indexed += future.result()
+                if time.time() - reported >= 1 or indexed == total:  # 每秒最多输出一次进度
+                    reported = time.time()
+                    elapsed = reported - start
+                    self.stdout.write('{}/{} ({:.1%}) {:.0f} commodities/s'.format(
+                        indexed, total, indexed / total, indexed / elapsed if elapsed else 0))
+        if hasattr(backend, 'optimize'):
+            backend.optimize()
+        search_cache.invalidate_all()
+        self.stdout.write(self.style.SUCCESS('indexed {} commodities in {:.1f}s'.format(indexed, time.time() - start)))
+
+    @staticmethod
+    def index_range(backend, queryset, low, high):
+        """索引pk在[low, high)内的商品"""
+        try:
+            return index_commodities(queryset.filter(pk__gte=low, pk__lt=high).select_related('store'), backend)
+        finally:
+            connections.close_all()  # 关闭本线程的数据库连接
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+# @Time  : 2020/11/27 上午11:20
+# @Author : 司云中
+# @File : search_cache_stats.py
+# @Software: Pycharm
+from django.core.management.base import BaseCommand
+
+from search_app.redis.search_cache_redis import search_cache
+
+
+class Command(BaseCommand):
+    """输出所有进程累计的搜索结果缓存命中统计，各进程的计数最多延迟GENERATION_CHECK_SECONDS秒同步"""
+
+    help = 'Show the hit rate of the search result cache'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='输出后清零统计')
+
+    def handle(self, *args, **options):
+        stats = search_cache.stats()
+        self.stdout.write('hit: {hit}  miss: {miss}  hit rate: {hit_rate:.2%}'.format(
+            hit=stats.get('hit', 0), miss=stats.get('miss', 0), hit_rate=stats['hit_rate']))
+        if options['reset']:
+            search_cache.redis.delete(search_cache.stats_key)
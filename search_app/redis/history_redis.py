@@ -6,97 +6,145 @@
 import datetime
 from time import time
 
-from Emall.base_redis import BaseRedis, manager_redis
+from Emall.base_redis import BaseRedis
 from search_app import signals
-from user_app.redis.favorites_redis import RedisFavoritesOperation
+
 
 def client_key(func):
-    """获取client的key装饰器"""
+    """获取client的key装饰器，未登录用户以客户端IP区分"""
     def decorate(self, sender, request, **kwargs):
         if sender is None:  # 如果用户未登录
             sender = BaseRedis.get_client_ip(request=request)  # 获取客户端IP
-            func(self, sender, request, **kwargs)
+        return func(self, sender, request, **kwargs)
     return decorate
 
 
-
 class HistoryRedisOperation(BaseRedis):
+    """
+    搜索历史和热搜
+    搜索历史：每个用户一个zset user-{identity}，member为关键字，score为毫秒时间戳
+    写入、截断到MAX_HISTORY条、续期由lua脚本一次完成
+
+    热搜：每小时一个zset heat-{heat}-YYYYmmddHH，只保留最近WINDOW_HOURS小时，过期自动删除
+    热搜榜由各小时的zset按时间衰减加权ZUNIONSTORE合并，结果缓存HOT_SECONDS秒，多个进程同时只有一个重建
+    所有小时zset使用相同的哈希标签{heat}，分片时落在同一节点以便合并
+    """
 
     DB = 'search'
 
+    MAX_HISTORY = 20  # 每个用户最多保留的搜索记录
+    HISTORY_SECONDS = 60 * 60 * 24 * 30  # 搜索记录30天未更新则过期
+    MAX_KEYWORD_LENGTH = 50  # 记录的关键字最大长度
+
+    WINDOW_HOURS = 24  # 热搜统计的小时数
+    HEAT_DECAY = 0.9  # 每早一个小时，权重乘以该值
+    MAX_BUCKET_SIZE = 10000  # 每小时最多保留的关键字，重建热搜榜时截断
+    HOT_SIZE = 100  # 缓存的热搜榜长度，搜索结果缓存预热其中的全部关键字
+    HOT_SECONDS = 5  # 热搜榜缓存时间
+
+    # KEYS[1]:搜索历史zset
+    # ARGV[1]:关键字  ARGV[2]:毫秒时间戳  ARGV[3]:最多保留的数量  ARGV[4]:过期秒数
+    SAVE_SCRIPT = """
+    redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+    redis.call('ZREMRANGEBYRANK', KEYS[1], 0, -tonumber(ARGV[3]) - 1)
+    redis.call('EXPIRE', KEYS[1], ARGV[4])
+    return 1
+    """
+
     def __init__(self, db, redis):
         super().__init__(db, redis)
+        self.save_script = self.redis.register_script(self.SAVE_SCRIPT)
         self.connect()
 
     def connect(self):
         signals.record_search.connect(self.save_search, sender=None)
-        signals.del_search_single.connect(self.delete_search_single,sender=None)
+        signals.del_search_single.connect(self.delete_search_single, sender=None)
         signals.del_search_all.connect(self.delete_search_all, sender=None)
 
     @property
     def score(self):
-        return int(time())
-
+        return int(time() * 1000)
 
     def user_key(self, key):
         return f'user-{key}'
 
     def heat_key(self, date):
-        return f'heat-{date.strftime("%Y-%m-%d")}'
+        """date所在小时的热搜zset"""
+        return self.key('heat', self.tag('heat'), date.strftime('%Y%m%d%H'))
+
+    @property
+    def trending_key(self):
+        """合并后的热搜zset，与各小时zset在同一节点"""
+        return self.key('heat', self.tag('heat'), 'trending')
+
+    @property
+    def hot_key(self):
+        """热搜榜缓存"""
+        return self.key('heat', 'top')
+
+    @classmethod
+    def normalize(cls, key):
+        """去掉首尾空白并截断，空关键字返回None"""
+        key = (key or '').strip()[:cls.MAX_KEYWORD_LENGTH]
+        return key or None
 
     @client_key
     def save_search(self, sender, request, key, **kwargs):
         """
-        记录某用户的浏览记录
+        记录某用户的搜索记录，并计入当前小时的热搜
         有效时间1个月
         """
-
-        with manager_redis(self.DB, type(self)) as redis:
-            # 为每个用户维护一个搜索有序集合
-            with redis.pipeline() as pipe:
-                pipe.zadd(self.user_key(sender), {key:self.score})
-                # 60*60*24*30 = 25920000 30天存活
-                pipe.expire(sender, 25920000)
-                pipe.zincrby(self.heat_key(datetime.datetime.today()), 1, key) # 将该关键字添加到热搜有序集合中,如果存在key,则+1,不存在设置为1
-                pipe.execute()
+        key = self.normalize(key)
+        if key is None:
+            return
+        now = datetime.datetime.now()
+        with self.redis.pipeline(transaction=False) as pipe:
+            self.save_script(keys=[self.user_key(sender)],
+                             args=[key, self.score, self.MAX_HISTORY, self.HISTORY_SECONDS], client=pipe)
+            pipe.zincrby(self.heat_key(now), 1, key)  # 将该关键字添加到热搜有序集合中,如果存在key,则+1,不存在设置为1
+            pipe.expire(self.heat_key(now), (self.WINDOW_HOURS + 1) * 3600)
+            pipe.execute()
 
     @client_key
     def delete_search_single(self, sender, request, key, **kwargs):
         """
         单删某条搜索历史记录
         """
-        with manager_redis(self.DB, type(self)) as redis:
-            redis.zrem(self.user_key(sender), key)
+        self.redis.zrem(self.user_key(sender), key)
 
     @client_key
     def delete_search_all(self, sender, request, **kwargs):
         """
         群删所有搜索历史记录
         """
-        with manager_redis(self.DB, type(self)) as redis:
-            print(sender)
-            redis.delete(self.user_key(sender))
+        self.redis.delete(self.user_key(sender))
 
     @client_key
-    def retrieve_last_ten(self, sender, request, key, **kwargs):
-        """获取最新的10条搜索记录"""
+    def retrieve_last_ten(self, sender, request, count=10, **kwargs):
+        """获取最新的count条搜索记录"""
+        return [key.decode() for key in self.redis.zrevrange(self.user_key(sender), 0, count - 1)]
 
-        # with 生存周期持续到函数结束
-        with manager_redis(self.DB, type(self)) as redis:
-            page = kwargs.get('page')
-            count = kwargs.get('count')
-            result = redis.zrevrange(self.user_key(sender), page*count, (page+1)*count) # 返回分数从高到低的前十个(时间最近的前十个)
-            return result
-
-    def heat_search(self, sender, request, key, **kwargs):
+    def compute_trending(self):
+        """
+        合并最近WINDOW_HOURS小时的热搜，越早的小时权重越低
+        :return: list  [[关键字, 热度], ...]
+        """
+        now = datetime.datetime.now()
+        weights = {self.heat_key(now - datetime.timedelta(hours=hours)): self.HEAT_DECAY ** hours
+                   for hours in range(self.WINDOW_HOURS)}
+        with self.redis.pipeline(transaction=False) as pipe:
+            pipe.zremrangebyrank(self.heat_key(now), 0, -self.MAX_BUCKET_SIZE - 1)
+            pipe.zunionstore(self.trending_key, weights)
+            pipe.zrevrange(self.trending_key, 0, self.HOT_SIZE - 1, withscores=True)
+            result = pipe.execute()[-1]
+        return [[key.decode(), round(score, 2)] for key, score in result]
+
+    def heat_search(self, count=10):
         """
-        每日热搜
-        动态更新每日的前十位
+        热搜榜前count位
+        读取缓存，缓存每HOT_SECONDS秒由一个请求重建
         """
-        with manager_redis(self.DB, type(self)) as redis:
-            date = datetime.datetime.today()
-            result = redis.zrevrange(self.heat_key(date), 0, 10)  # 前十大热搜
-            return result
+        return self.get_or_compute(self.hot_key, self.compute_trending, self.HOT_SECONDS)[:count]
 
 
-history_redis = HistoryRedisOperation.choice_redis_db('search')
\ No newline at end of file
+history_redis = HistoryRedisOperation.choice_redis_db('search')
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+# @Time  : 2020/11/25 上午9:20
+# @Author : 司云中
+# @File : index_redis.py
+# @Software: Pycharm
+from Emall.base_redis import BaseRedis
+
+
+class IndexRedisOperation(BaseRedis):
+    """
+    搜索索引的异步更新队列
+    商品保存或删除后把pk加入脏集合search-index-dirty，由celery定时批量取出更新索引，同一商品多次修改只索引一次
+    每个已索引商品保存被索引字段的指纹，指纹不变说明只修改了未索引的字段，跳过索引
+    指纹按pk分桶保存在多个hash中，避免单个hash过大，分片时各桶分散到不同节点
+    """
+
+    BUCKET_SIZE = 1024  # 每个指纹hash保存的商品数量
+
+    @property
+    def dirty_key(self):
+        """待更新索引的商品集合"""
+        return self.key('search-index', 'dirty')
+
+    def fingerprint_key(self, pk):
+        """商品所在的指纹hash"""
+        return self.key('search-index', 'fingerprint', int(pk) // self.BUCKET_SIZE)
+
+    def mark_dirty(self, *pks):
+        """标记为待更新索引，更新失败时重新标记"""
+        if pks:
+            self.redis.sadd(self.dirty_key, *pks)
+
+    def pop_dirty(self, count=500):
+        """取出一批待更新索引的商品"""
+        return [int(pk) for pk in self.redis.spop(self.dirty_key, count)]
+
+    def get_fingerprints(self, pks):
+        """
+        批量获取指纹
+        :return: dict  {pk: str}，没有指纹的商品不在其中
+        """
+        with self.redis.pipeline(transaction=False) as pipe:
+            for pk in pks:
+                pipe.hget(self.fingerprint_key(pk), pk)
+            values = pipe.execute()
+        return {pk: value.decode() for pk, value in zip(pks, values) if value is not None}
+
+    def set_fingerprints(self, mapping=None, removed=()):
+        """
+        写入新的指纹，删除已移出索引的商品的指纹
+        :param mapping: dict  {pk: str}
+        :param removed: 移出索引的商品pk
+        """
+        if not mapping and not removed:
+            return
+        with self.redis.pipeline(transaction=False) as pipe:
+            for pk, fingerprint in (mapping or {}).items():
+                pipe.hset(self.fingerprint_key(pk), pk, fingerprint)
+            for pk in removed:
+                pipe.hdel(self.fingerprint_key(pk), pk)
+            pipe.execute()
+
+    def clear_fingerprints(self, batch=500):
+        """删除所有指纹，全量重建索引前使用"""
+        keys = []
+        for key in self.redis.scan_iter(match=self.key('search-index', 'fingerprint', '*'), count=batch):
+            keys.append(key)
+            if len(keys) >= batch:
+                self.redis.delete(*keys)
+                keys = []
+        if keys:
+            self.redis.delete(*keys)
+
+
+index_redis = IndexRedisOperation.choice_redis_db('search')
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+# @Time  : 2020/11/27 上午9:40
+# @Author : 司云中
+# @File : search_cache_redis.py
+# @Software: Pycharm
+import hashlib
+import json
+import threading
+import time
+
+from Emall.base_redis import BaseRedis
+from search_app.backends.base import SearchQuery, SearchResult, EMPTY_RESULT
+from search_app.redis.history_redis import history_redis
+
+
+class SearchCacheRedis(BaseRedis):
+    """
+    搜索结果缓存
+    键为规范化后的搜索条件和结果窗口(offset, limit)的摘要：search-cache-{版本号}-{摘要}，值为SearchResult
+    关键字小写并合并空白，未指定的条件不参与计算，"手机"、" 手机 "、"手机"+sort=relevance命中同一个缓存
+    缓存读取由get_or_compute防击穿，同一个条件同时只有一个请求查询搜索后端
+
+    失效按标签：写入缓存时把键加入结果中每个商品的标签集合search-cache-tag-{pk}，
+    商品的索引被修改或删除后删除其标签集合中的所有缓存；新上架的商品最多延迟TTL秒出现在缓存的结果中
+    重建索引时递增版本号search-cache-generation使所有缓存失效，旧版本的缓存不再被读取，随TTL过期
+    每个进程最多每GENERATION_CHECK_SECONDS秒读取一次版本号，顺带同步命中计数
+    预热：定时任务为热搜榜的关键字刷新第一页的缓存，热门搜索不经过搜索后端
+    """
+
+    TTL = 30  # 缓存秒数
+    EMPTY_TTL = 10  # 没有任何命中(total为0)的结果的缓存秒数，缓存为空列表
+    GENERATION_CHECK_SECONDS = 1  # 检查版本号的间隔
+    WARM_SIZE = 100  # 预热的热搜关键字数量
+    WARM_PAGE_SIZE = 5  # 预热的每页数量，与CommodityResultsSetPagination.page_size一致
+
+    def __init__(self, db, redis):
+        super().__init__(db, redis)
+        self._generation = None
+        self._generation_checked = 0
+        self._stats = {'hit': 0, 'miss': 0}  # 上次同步到redis之后的本进程计数
+        self._stats_lock = threading.Lock()
+
+    @property
+    def generation_key(self):
+        """版本号的键"""
+        return self.key('search', 'cache', 'generation')
+
+    @property
+    def stats_key(self):
+        """命中率统计hash的键"""
+        return self.key('search', 'cache', 'stats')
+
+    def result_key(self, generation, digest):
+        return self.key('search', 'cache', generation, digest)
+
+    def tag_key(self, pk):
+        """商品的标签集合，保存包含该商品的缓存的键"""
+        return self.key('search', 'cache', 'tag', pk)
+
+    @staticmethod
+    def digest(query, offset, limit):
+        """规范化的搜索条件和结果窗口的摘要"""
+        params = {name: str(value) for name, value in vars(query).items() if value not in (None, '')}
+        params['text'] = ' '.join(query.text.lower().split())
+        params['window'] = '{}:{}'.format(offset, limit)
+        values = json.dumps(params, sort_keys=True, ensure_ascii=False)
+        return hashlib.blake2b(values.encode(), digest_size=16).hexdigest()
+
+    def _count(self, **counts):
+        with self._stats_lock:
+            for name, value in counts.items():
+                self._stats[name] += value
+
+    @property
+    def generation(self):
+        """
+        当前版本号，最多每GENERATION_CHECK_SECONDS秒从redis读取一次
+        顺带把本进程的命中计数同步到redis
+        """
+        now = time.time()
+        if self._generation is not None and now - self._generation_checked < self.GENERATION_CHECK_SECONDS:
+            return self._generation
+        self._generation_checked = now
+        with self._stats_lock:
+            stats, self._stats = self._stats, dict.fromkeys(self._stats, 0)
+        with self.redis.pipeline(transaction=False) as pipe:
+            pipe.get(self.generation_key)
+            for name, value in stats.items():
+                if value:
+                    pipe.hincrby(self.stats_key, name, value)
+            generation = pipe.execute()[0]
+        self._generation = int(generation or 0)
+        return self._generation
+
+    def search(self, backend, query, offset, limit):
+        """
+        读取缓存的搜索结果，未命中则查询搜索后端并写入缓存
+        :return: SearchResult
+        """
+        key = self.result_key(self.generation, self.digest(query, offset, limit))
+        computed = []
+
+        def compute():
+            computed.append(True)
+            return self.compute(backend, query, offset, limit, key)
+
+        value = self.get_or_compute(key, compute, self.TTL, self.EMPTY_TTL)
+        self._count(**({'miss': 1} if computed else {'hit': 1}))
+        return SearchResult(*value) if value else EMPTY_RESULT
+
+    def compute(self, backend, query, offset, limit, key):
+        """
+        查询搜索后端，并把缓存的键加入结果中每个商品的标签集合
+        :return: list SearchResult的字段，没有任何命中时返回空列表，按EMPTY_TTL缓存
+        """
+        result = backend.search(query, offset, limit)
+        if result.hits:
+            with self.redis.pipeline(transaction=False) as pipe:
+                for pk in result.pks:
+                    pipe.sadd(self.tag_key(pk), key)
+                    pipe.expire(self.tag_key(pk), self.TTL)
+                pipe.execute()
+        return list(result) if result.total else []
+
+    def warm(self, backend, queries, limit=WARM_PAGE_SIZE):
+        """
+        刷新一批搜索条件第一页的缓存，缓存不存在或剩余有效期不足一半时重新查询
+        :return: int 重新查询的数量
+        """
+        keys = [self.result_key(self.generation, self.digest(query, 0, limit)) for query in queries]
+        with self.redis.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.pttl(key)
+            ttls = pipe.execute()
+        refreshed = 0
+        for query, key, ttl_ms in zip(queries, keys, ttls):
+            if ttl_ms is not None and ttl_ms > self.TTL * 1000 / 2:
+                continue
+            with self.single_flight(key) as acquired:
+                if acquired:
+                    self._set_flight_value(key, lambda: self.compute(backend, query, 0, limit, key),
+                                           self.TTL, self.EMPTY_TTL)
+                    refreshed += 1
+        return refreshed
+
+    def hot_queries(self):
+        """热搜榜前WARM_SIZE个关键字的默认搜索条件，与搜索接口的默认条件一致"""
+        return [SearchQuery(text=keyword, facets=True) for keyword, _ in history_redis.heat_search(self.WARM_SIZE)]
+
+    def invalidate(self, pks):
+        """商品的索引被修改或删除后，删除包含这些商品的缓存"""
+        if not pks:
+            return
+        with self.redis.pipeline(transaction=False) as pipe:
+            for pk in pks:
+                pipe.smembers(self.tag_key(pk))
+            keys = set().union(*pipe.execute())
+        with self.redis.pipeline(transaction=False) as pipe:
+            for key in keys:  # 分片时各缓存可能在不同节点，逐个删除
+                pipe.delete(key)
+            for pk in pks:
+                pipe.delete(self.tag_key(pk))
+            pipe.execute()
+
+    def invalidate_all(self):
+        """重建索引后使所有缓存失效，各进程在GENERATION_CHECK_SECONDS内生效"""
+        self.redis.incr(self.generation_key)
+
+    def stats(self):
+        """
+        所有进程累计的命中统计
+        :return: dict  {'hit':, 'miss':, 'hit_rate':}
+        """
+        stats = {key.decode(): int(value) for key, value in self.redis.hgetall(self.stats_key).items()}
+        for name, value in self._stats.items():  # 尚未同步的本进程计数
+            stats[name] = stats.get(name, 0) + value
+        total = sum(stats.values())
+        stats['hit_rate'] = round(stats.get('hit', 0) / total, 4) if total else 0
+        return stats
+
+
+search_cache = SearchCacheRedis.choice_redis_db('search')
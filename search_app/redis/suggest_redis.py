@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+# @Time  : 2020/11/26 上午10:15
+# @Author : 司云中
+# @File : suggest_redis.py
+# @Software: Pycharm
+import heapq
+import json
+import re
+from collections import Counter
+
+from django.db.models import Sum
+
+from Emall.base_redis import BaseRedis
+from search_app.redis.history_redis import history_redis
+from shop_app.models.commodity_models import Commodity
+
+try:
+    from pypinyin import Style, lazy_pinyin
+except ImportError:  # 未安装pypinyin时不支持拼音匹配
+    lazy_pinyin = None
+
+CHINESE_RE = re.compile(r'[一-鿿]')
+
+
+class SuggestRedisOperation(BaseRedis):
+    """
+    搜索联想(输入即搜索)
+    前缀索引：zset suggest-{suggest}-lex，score全为0，member为"匹配键\\0展示词"，按ZRANGEBYLEX前缀查询
+    匹配键为展示词的小写形式，含汉字的词再加上全拼和拼音首字母，"连衣裙"可由"lian"、"lyq"匹配
+    热度：zset suggest-{suggest}-score，member为展示词
+
+    长度不超过SHORT_PREFIX的前缀，以及匹配项超过SCAN_LIMIT的更长前缀，重建时预先计算前TOP_SIZE名
+    存入hash suggest-{suggest}-top；其余前缀的匹配项不超过SCAN_LIMIT，由lua脚本全部取出按热度排序，一次调用完成
+    两次重建之间新增的词可能使某个前缀的匹配项超过SCAN_LIMIT，此时该前缀只按字典序前SCAN_LIMIT个匹配项排序，
+    直到下次重建
+
+    词来源：上架商品名称(热度为销量)、商品分类(热度为分类总销量)、热搜关键字(热度为热搜榜分数乘HEAT_WEIGHT)
+    celery定时全量重建，写入临时键后RENAME替换；热搜关键字另有更频繁的增量更新
+    """
+
+    SHORT_PREFIX = 2  # 不超过该长度的前缀使用预先计算的结果
+    TOP_SIZE = 10  # 预先计算的每个短前缀的结果数量
+    SCAN_LIMIT = 200  # 长前缀最多扫描的匹配项
+    MAX_COUNT = 10  # 每次最多返回的联想词
+    HEAT_WEIGHT = 100  # 热搜关键字的热度权重
+    BATCH_SIZE = 2000  # 重建时每批写入的数量
+
+    # KEYS[1]:前缀索引  KEYS[2]:热度  KEYS[3]:预先计算的结果
+    # ARGV[1]:前缀  ARGV[2]:最多扫描的匹配项  ARGV[3]:返回的数量
+    SUGGEST_SCRIPT = """
+    local top = redis.call('HGET', KEYS[3], ARGV[1])
+    if top then
+        local terms = cjson.decode(top)
+        local result = {}
+        for i = 1, math.min(tonumber(ARGV[3]), #terms) do
+            result[i] = terms[i]
+        end
+        return result
+    end
+    local entries = redis.call('ZRANGEBYLEX', KEYS[1], '[' .. ARGV[1], '[' .. ARGV[1] .. '\\255',
+                               'LIMIT', 0, tonumber(ARGV[2]))
+    local seen, terms = {}, {}
+    for _, entry in ipairs(entries) do
+        local term = string.sub(entry, string.find(entry, '\\0', 1, true) + 1)
+        if not seen[term] then
+            seen[term] = true
+            terms[#terms + 1] = {term, tonumber(redis.call('ZSCORE', KEYS[2], term) or 0)}
+        end
+    end
+    table.sort(terms, function(a, b) return a[2] > b[2] end)
+    local result = {}
+    for i = 1, math.min(tonumber(ARGV[3]), #terms) do
+        result[i] = terms[i][1]
+    end
+    return result
+    """
+
+    def __init__(self, db, redis):
+        super().__init__(db, redis)
+        self.suggest_script = self.redis.register_script(self.SUGGEST_SCRIPT)
+
+    def lex_key(self, suffix=None):
+        return self.key('suggest', self.tag('suggest'), 'lex', *([suffix] if suffix else []))
+
+    def score_key(self, suffix=None):
+        return self.key('suggest', self.tag('suggest'), 'score', *([suffix] if suffix else []))
+
+    def top_key(self, suffix=None):
+        return self.key('suggest', self.tag('suggest'), 'top', *([suffix] if suffix else []))
+
+    @staticmethod
+    def normalize(text):
+        """小写并合并空白"""
+        return ' '.join((text or '').lower().split())
+
+    @classmethod
+    def match_keys(cls, term):
+        """展示词的所有匹配键"""
+        keys = {cls.normalize(term)}
+        if lazy_pinyin is not None and CHINESE_RE.search(term):
+            keys.add(''.join(lazy_pinyin(term)).lower().replace(' ', ''))
+            keys.add(''.join(lazy_pinyin(term, style=Style.FIRST_LETTER)).lower().replace(' ', ''))
+        keys.discard('')
+        return keys
+
+    def suggest(self, prefix, count=MAX_COUNT):
+        """
+        按热度返回以prefix开头的联想词
+        :return: list
+        """
+        prefix = self.normalize(prefix)
+        if not prefix:
+            return []
+        count = min(count, self.MAX_COUNT)
+        if len(prefix) <= self.SHORT_PREFIX:
+            value = self.redis.hget(self.top_key(), prefix)
+            return json.loads(value)[:count] if value else []
+        return [term.decode() for term in self.suggest_script(
+            keys=[self.lex_key(), self.score_key(), self.top_key()], args=[prefix, self.SCAN_LIMIT, count])]
+
+    @staticmethod
+    def collect_terms():
+        """
+        收集所有词及热度，同一个词取各来源的最大热度
+        :return: dict  {展示词: 热度}
+        """
+        terms = {}
+        queryset = Commodity.commodity_.filter(status=True).values_list('commodity_name', 'sell_counts')
+        for name, sell_counts in queryset.iterator(chunk_size=SuggestRedisOperation.BATCH_SIZE):
+            name = name.strip()
+            if name:
+                terms[name] = terms.get(name, 0) + sell_counts
+        categories = dict(Commodity.commodity_.filter(status=True).values('category').annotate(
+            counts=Sum('sell_counts')).values_list('category', 'counts'))
+        for category, _ in Commodity.commodity_choice:
+            terms[category] = max(terms.get(category, 0), categories.get(category) or 0)
+        for keyword, score in history_redis.heat_search(history_redis.HOT_SIZE):
+            terms[keyword] = max(terms.get(keyword, 0), score * SuggestRedisOperation.HEAT_WEIGHT)
+        return terms
+
+    def top_prefixes(self, terms):
+        """
+        计算需要预先计算的前缀热度前TOP_SIZE的词：长度不超过SHORT_PREFIX的前缀，以及匹配项超过SCAN_LIMIT的更长前缀
+        按长度逐层计算，只有上一层匹配项超过SCAN_LIMIT的前缀才继续向下一层展开
+        :return: dict  {前缀: [展示词, ...]}
+        """
+        entries = [(key, term, score) for term, score in terms.items() for key in self.match_keys(term)]
+        tops = {}
+        parents = None  # 上一层需要展开的前缀，None表示不限制
+        length = 1
+        while entries:
+            entries = [entry for entry in entries if len(entry[0]) >= length and
+                       (parents is None or entry[0][:length - 1] in parents)]
+            counts = Counter(key[:length] for key, _, _ in entries)  # 前缀索引中的匹配项数量
+            crowded = {prefix for prefix, count in counts.items() if count > self.SCAN_LIMIT}
+            wanted = set(counts) if length <= self.SHORT_PREFIX else crowded
+            heaps = {}
+            for key, term, score in entries:
+                prefix = key[:length]
+                if prefix not in wanted:
+                    continue
+                heap = heaps.setdefault(prefix, [])
+                if (score, term) in heap:  # 同一个词的多个匹配键有相同的前缀
+                    continue
+                if len(heap) < self.TOP_SIZE:
+                    heapq.heappush(heap, (score, term))
+                elif (score, term) > heap[0]:
+                    heapq.heapreplace(heap, (score, term))
+            tops.update({prefix: [term for _, term in sorted(heap, reverse=True)] for prefix, heap in heaps.items()})
+            parents = None if length < self.SHORT_PREFIX else crowded
+            length += 1
+        return tops
+
+    def write_terms(self, terms, lex_key, score_key, pipe):
+        """分批写入前缀索引和热度"""
+        items = list(terms.items())
+        for i in range(0, len(items), self.BATCH_SIZE):
+            batch = items[i:i + self.BATCH_SIZE]
+            pipe.zadd(lex_key, {'{}\0{}'.format(key, term): 0 for term, _ in batch for key in self.match_keys(term)})
+            pipe.zadd(score_key, dict(batch))
+            pipe.execute()
+
+    def rebuild(self):
+        """
+        全量重建，写入临时键后一次RENAME替换，重建期间联想不受影响
+        :return: int 词的数量
+        """
+        terms = self.collect_terms()
+        lex_key, score_key, top_key = self.lex_key('new'), self.score_key('new'), self.top_key('new')
+        self.redis.delete(lex_key, score_key, top_key)
+        if not terms:
+            self.redis.delete(self.lex_key(), self.score_key(), self.top_key())
+            return 0
+        with self.redis.pipeline(transaction=False) as pipe:
+            self.write_terms(terms, lex_key, score_key, pipe)
+            tops = list(self.top_prefixes(terms).items())
+            for i in range(0, len(tops), self.BATCH_SIZE):
+                pipe.hset(top_key, mapping={prefix: json.dumps(top, ensure_ascii=False)
+                                            for prefix, top in tops[i:i + self.BATCH_SIZE]})
+                pipe.execute()
+        with self.redis.pipeline() as pipe:
+            pipe.rename(lex_key, self.lex_key())
+            pipe.rename(score_key, self.score_key())
+            pipe.rename(top_key, self.top_key())
+            pipe.execute()
+        return len(terms)
+
+    def refresh_heat(self):
+        """
+        热搜关键字增量加入联想，并合并到已预先计算的前缀(以及所有短前缀)的结果中
+        与全量重建一致，同一个词取最大热度：先读取当前热度，不会用较低的热搜分数覆盖商品销量等来源的热度
+        (ZADD GT需要redis 6.2，这里不依赖)
+        :return: int 关键字的数量
+        """
+        terms = {keyword: score * self.HEAT_WEIGHT
+                 for keyword, score in history_redis.heat_search(history_redis.HOT_SIZE)}
+        if not terms:
+            return 0
+        with self.redis.pipeline(transaction=False) as pipe:
+            for term in terms:
+                pipe.zscore(self.score_key(), term)
+            current = pipe.execute()
+        terms = {term: max(score, current_score or 0) for (term, score), current_score in zip(terms.items(), current)}
+        with self.redis.pipeline(transaction=False) as pipe:
+            self.write_terms(terms, self.lex_key(), self.score_key(), pipe)
+        matches = {}  # 关键字的所有前缀 -> 匹配的关键字
+        for term in terms:
+            for key in self.match_keys(term):
+                for length in range(1, len(key) + 1):
+                    matches.setdefault(key[:length], set()).add(term)
+        prefixes = list(matches)
+        candidates = {}
+        for prefix, value in zip(prefixes, self.redis.hmget(self.top_key(), prefixes)):
+            if value is None and len(prefix) > self.SHORT_PREFIX:  # 未预先计算的长前缀由脚本实时排序
+                continue
+            top = json.loads(value) if value else []
+            candidates[prefix] = top + [term for term in matches[prefix] if term not in top]
+        words = list({term for terms_ in candidates.values() for term in terms_})
+        with self.redis.pipeline(transaction=False) as pipe:
+            for term in words:
+                pipe.zscore(self.score_key(), term)
+            scores = dict(zip(words, (score or 0 for score in pipe.execute())))
+        self.redis.hset(self.top_key(), mapping={
+            prefix: json.dumps(sorted(terms_, key=scores.get, reverse=True)[:self.TOP_SIZE], ensure_ascii=False)
+            for prefix, terms_ in candidates.items()})
+        return len(terms)
+
+
+suggest_redis = SuggestRedisOperation.choice_redis_db('search')
@@ -5,15 +5,35 @@
 # @Software: Pycharm
 from rest_framework import serializers
 
+from search_app.backends.base import SearchQuery
 from shop_app.models.commodity_models import Commodity
 
 
-class CommoditySerializer(serializers.ModelSerializer):
-    """商品序列化器"""
+class CommoditySearchQuerySerializer(serializers.Serializer):
+    """搜索条件的校验，取自查询参数"""
 
-    class Meta:
-        model = Commodity
-        fields = '__all__'
+    text = serializers.CharField(required=False, allow_blank=True, max_length=50, default='')
+    category = serializers.ChoiceField(choices=Commodity.commodity_choice, required=False)
+    min_price = serializers.IntegerField(min_value=0, required=False)
+    max_price = serializers.IntegerField(min_value=0, required=False)
+    max_discounts = serializers.DecimalField(max_digits=2, decimal_places=1, min_value=0, max_value=1,
+                                             required=False)
+    province = serializers.CharField(max_length=10, required=False)
+    city = serializers.CharField(max_length=10, required=False)
+    sort = serializers.ChoiceField(choices=list(SearchQuery.SORTS), default='relevance')
+
+    def validate_text(self, value):
+        return value.strip()
+
+    def validate(self, attrs):
+        if attrs.get('min_price') is not None and attrs.get('max_price') is not None and \
+                attrs['min_price'] > attrs['max_price']:
+            raise serializers.ValidationError('min_price不能大于max_price')
+        return attrs
+
+    def get_query(self, facets=True):
+        """校验后的条件 -> SearchQuery"""
+        return SearchQuery(facets=facets, **self.validated_data)
 
 
 # class ShopSearchSerializer(HaystackSerializer):
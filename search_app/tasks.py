@@ -3,16 +3,59 @@
 # @Author : 司云中
 # @File : tasks.py
 # @Software: Pycharm
-import datetime
-
-from Emall import manager_redis
-from search_app.redis.history_redis import history_redis
+from Emall.loggings import Logging
+from search_app.backends import get_backend
+from search_app.redis.index_redis import index_redis
+from search_app.redis.search_cache_redis import search_cache
+from search_app.redis.suggest_redis import suggest_redis
+from search_app.utils.indexing import update_index
 from Emall import celery_apps as app
 
+search_logger = Logging.logger('django')
+
+
+@app.task
+def index_dirty_commodities(batch_size=500, max_batches=20):
+    """
+    定时批量更新被修改过的商品的索引
+    更新失败的商品重新加入脏集合，下次重试；索引有变化时删除包含这些商品的搜索结果缓存
+    :return: dict 写入、移出和跳过的数量
+    """
+    backend = get_backend()
+    counts = {'indexed': 0, 'removed': 0, 'skipped': 0}
+    for _ in range(max_batches):
+        pks = index_redis.pop_dirty(batch_size)
+        if not pks:
+            break
+        try:
+            indexed, removed, skipped = update_index(pks, backend)
+        except Exception as e:  # 数据库或搜索后端异常，各后端的异常类型不同
+            search_logger.error(e)
+            index_redis.mark_dirty(*pks)
+            break
+        if indexed or removed:
+            search_cache.invalidate(pks)
+        counts['indexed'] += indexed
+        counts['removed'] += removed
+        counts['skipped'] += skipped
+        if len(pks) < batch_size:
+            break
+    return counts
+
+
+@app.task
+def warm_search_cache():
+    """定时为热搜关键字刷新搜索结果第一页的缓存"""
+    return search_cache.warm(get_backend(), search_cache.hot_queries())
+
+
+@app.task
+def rebuild_suggestions():
+    """定时全量重建搜索联想的前缀索引"""
+    return suggest_redis.rebuild()
+
 
 @app.task
-def timer_eliminate_heat():
-    """定时清除每日的热搜榜"""
-    with manager_redis('search', type(history_redis)) as redis:
-        date = datetime.datetime.today() - datetime.timedelta(1)
-        redis.delete(history_redis.heat_key(date))
\ No newline at end of file
+def refresh_heat_suggestions():
+    """定时把热搜关键字加入搜索联想"""
+    return suggest_redis.refresh_heat()
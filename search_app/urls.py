@@ -6,12 +6,15 @@
 from django.urls import path
 from rest_framework.routers import DefaultRouter
 
-from search_app.views.search_api import CommoditySearchOperation
+from search_app.views.search_api import CommoditySearchOperation, HotSearchOperation, \
+    SuggestOperation
 
 app_name = 'search_app'
 
 urlpatterns = [
     path('search-chsc-api/', CommoditySearchOperation.as_view(), name='search-chsc-search'),
+    path('heat-chsc-api/', HotSearchOperation.as_view(), name='heat-chsc-search'),
+    path('suggest-chsc-api/', SuggestOperation.as_view(), name='suggest-chsc-search'),
 ]
 #
 # router = DefaultRouter()
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+# @Time  : 2020/11/25 上午10:05
+# @Author : 司云中
+# @File : indexing.py
+# @Software: Pycharm
+import hashlib
+
+from search_app.backends import get_backend
+from search_app.redis.index_redis import index_redis
+from shop_app.models.commodity_models import Commodity
+
+
+def fingerprint(backend, commodity):
+    """索引文档的指纹，只修改库存、运费等未索引字段时指纹不变"""
+    values = repr(sorted(backend.document(commodity).items()))
+    return hashlib.blake2b(values.encode(), digest_size=8).hexdigest()
+
+
+def index_commodities(commodities, backend=None):
+    """
+    索引一批商品并记录指纹，未上架的商品从索引中删除
+    :return: int 写入索引的数量
+    """
+    backend = backend or get_backend()
+    commodities = list(commodities)
+    if not commodities:
+        return 0
+    backend.update(commodities)
+    index_redis.set_fingerprints({commodity.pk: fingerprint(backend, commodity)
+                                  for commodity in commodities if commodity.status},
+                                 [commodity.pk for commodity in commodities if not commodity.status])
+    return sum(1 for commodity in commodities if commodity.status)
+
+
+def update_index(pks, backend=None):
+    """
+    更新一批被修改过的商品的索引
+    已删除或下架的商品移出索引，指纹未变化的商品跳过
+    :return: tuple 写入索引的数量, 移出索引的数量, 跳过的数量
+    """
+    backend = backend or get_backend()
+    commodities = Commodity.commodity_.select_related('store').in_bulk(pks)
+    fingerprints = index_redis.get_fingerprints(pks)
+    changed, removed = [], []
+    for pk in pks:
+        commodity = commodities.get(pk)
+        if commodity is None or not commodity.status:
+            removed.append(pk)
+        elif fingerprints.get(pk) != fingerprint(backend, commodity):
+            changed.append(commodity)
+    if removed:
+        backend.remove(removed)
+        index_redis.set_fingerprints(removed=removed)
+    indexed = index_commodities(changed, backend)
+    return indexed, len(removed), len(pks) - indexed - len(removed)
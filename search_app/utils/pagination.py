@@ -24,5 +24,6 @@ class CommodityResultsSetPagination(PageNumberPagination):
                 'previous': self.get_previous_link()
             },
             'count': self.page.paginator.count,  # 当前页数的数量
+            'facets': getattr(self.page.paginator.object_list, 'facets', {}),  # 搜索结果的聚合统计
             'data': data
         })
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+# @Time  : 2020/11/24 上午11:30
+# @Author : 司云中
+# @File : search.py
+# @Software: Pycharm
+from search_app.backends import get_backend
+
+
+class SearchResultSet:
+    """
+    搜索结果的惰性序列，供分页器使用，元素为索引文档(dict)
+    分页器先调用count()再切片，两者都只触发一次后端查询：先按预取窗口查询并缓存，
+    切片落在缓存的窗口内直接使用，否则按切片重新查询
+    指定cache时每个窗口的查询结果先读取redis缓存，见SearchCacheRedis
+    """
+
+    def __init__(self, backend, query, offset=0, limit=20, cache=None):
+        self.backend = backend
+        self.query = query
+        self.cache = cache
+        self.offset = offset
+        self.limit = limit
+        self._window = None  # (offset, SearchResult)
+
+    def fetch(self, offset, limit):
+        """查询[offset, offset + limit)的结果，命中缓存的窗口则直接返回"""
+        if self._window is not None:
+            cached_offset, result = self._window
+            stop = min(offset + limit, result.total)
+            if cached_offset <= offset and stop <= cached_offset + len(result.hits):
+                return result._replace(hits=result.hits[offset - cached_offset:stop - cached_offset])
+        if self.cache is not None:
+            result = self.cache.search(self.backend, self.query, offset, limit)
+        else:
+            result = self.backend.search(self.query, offset, limit)
+        if self._window is not None and not result.facets:
+            result = result._replace(facets=self._window[1].facets)
+        self._window = (offset, result)
+        return result
+
+    @property
+    def facets(self):
+        """预取窗口的聚合统计"""
+        return self.fetch(self.offset, self.limit).facets
+
+    def count(self):
+        return self.fetch(self.offset, self.limit).total
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice):
+            return self[item:item + 1][0]
+        start = item.start or 0
+        stop = self.count() if item.stop is None else item.stop
+        return self.fetch(start, max(stop - start, 0)).hits
+
+
+class CommoditySearch:
+    """商品搜索，后端由settings.SEARCH_BACKEND指定"""
+
+    def __init__(self, query, backend=None, cache=None):
+        """
+        :param query: SearchQuery
+        :param cache: 搜索结果缓存，None表示每次都查询搜索后端
+        """
+        self.query = query
+        self.backend = backend or get_backend()
+        self.cache = cache
+
+    def get_queryset(self, offset=0, limit=20):
+        """
+        :param offset, limit: 预取窗口，传入当前页可使分页只查询一次后端
+        :return: SearchResultSet
+        """
+        return SearchResultSet(self.backend, self.query, offset, limit, self.cache)
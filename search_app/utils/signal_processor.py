@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+# @Time  : 2020/11/25 上午9:50
+# @Author : 司云中
+# @File : signal_processor.py
+# @Software: Pycharm
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from haystack.signals import BaseSignalProcessor
+from redis import RedisError
+
+from Emall.loggings import Logging
+from search_app.backends import get_backend
+from search_app.redis.index_redis import index_redis
+from shop_app.models.commodity_models import Commodity
+from user_app.model.seller_models import Store
+
+search_logger = Logging.logger('django')
+
+
+class QueuedSignalProcessor(BaseSignalProcessor):
+    """
+    异步的索引信号处理器，替代RealtimeSignalProcessor
+    商品保存或删除时只把pk加入redis脏集合，由celery任务index_dirty_commodities批量更新索引
+    save(update_fields=...)只修改了未索引的字段时不入队，事务提交后才入队，回滚的修改不会被索引
+    update()不触发信号，批量update商品后需手动调用index_redis.mark_dirty
+    索引文档包含店铺名称和所在地，店铺修改后其上架商品全部入队
+    """
+
+    def setup(self):
+        post_save.connect(self.handle_save, sender=Commodity)
+        post_delete.connect(self.handle_delete, sender=Commodity)
+        post_save.connect(self.handle_store_save, sender=Store)
+
+    def teardown(self):
+        post_save.disconnect(self.handle_save, sender=Commodity)
+        post_delete.disconnect(self.handle_delete, sender=Commodity)
+        post_save.disconnect(self.handle_store_save, sender=Store)
+
+    def handle_save(self, sender, instance, update_fields=None, **kwargs):
+        if update_fields is not None and not set(update_fields) & set(get_backend().INDEXED_FIELDS):
+            return
+        self.enqueue(instance.pk)
+
+    def handle_delete(self, sender, instance, **kwargs):
+        self.enqueue(instance.pk)
+
+    def handle_store_save(self, sender, instance, created=False, update_fields=None, **kwargs):
+        if created or update_fields is not None and not set(update_fields) & set(get_backend().STORE_FIELDS):
+            return
+        pks = list(Commodity.commodity_.filter(store=instance, status=True).values_list('pk', flat=True))
+        if pks:
+            self.enqueue(*pks)
+
+    @staticmethod
+    def enqueue(*pks):
+        """事务提交后标记为待更新索引"""
+
+        def mark_dirty():
+            try:
+                index_redis.mark_dirty(*pks)
+            except RedisError as e:
+                search_logger.error(e)
+
+        transaction.on_commit(mark_dirty)
@@ -7,14 +7,20 @@ from rest_framework import status
 from rest_framework.decorators import action
 from rest_framework.generics import GenericAPIView
 from rest_framework.response import Response
+from rest_framework.views import APIView
 
 from Emall.loggings import Logging
 from search_app import signals
-from search_app.serailaizers.shop_search_serializers import CommoditySerializer
+from search_app.redis.history_redis import history_redis
+from search_app.redis.search_cache_redis import search_cache
+from search_app.redis.suggest_redis import suggest_redis
+from search_app.serailaizers.shop_search_serializers import CommoditySearchQuerySerializer
 from shop_app.models.commodity_models import Commodity
-from search_app.utils.elasticsearch import ElasticSearchOperation
+from shop_app.serializers.commodity_card_serializers import CommodityCardSerializer
+from search_app.utils.search import CommoditySearch
 from search_app.utils.pagination import CommodityResultsSetPagination
 from rest_framework.viewsets import GenericViewSet
+from user_app.redis.foot_redis import FootRedisOperation
 
 common_logger = Logging.logger('django')
 
@@ -26,57 +32,89 @@ def is_login(func):
             identity = request.user.pk
         else:
             identity = None
-        func(self, request, identity, *args, **kwargs)
+        return func(self, request, identity, *args, **kwargs)
 
     return decorate
 
 class CommoditySearchOperation(GenericAPIView):
-    """ES搜索操作"""
+    """商品搜索操作"""
 
     # 索引库表
     index_models = [Commodity]
 
-    serializer_class = CommoditySerializer
+    serializer_class = CommodityCardSerializer  # 索引文档直接构造商品卡片
+
+    # 搜索条件校验
+    query_serializer_class = CommoditySearchQuerySerializer
 
     pagination_class = CommodityResultsSetPagination
 
-    # es操作类
-    elastic_class = ElasticSearchOperation
+    # 搜索操作类
+    search_class = CommoditySearch
+
+    # 搜索结果缓存，None表示不缓存
+    search_cache = search_cache
 
-    def get_elastic_class(self):
-        return self.elastic_class
+    foot_redis = FootRedisOperation.choice_redis_db('redis')
 
-    def get_elastic(self, *args, **kwargs):
-        if getattr(self, 'elastic', None):
-            return getattr(self, 'elastic')
-        elastic_ = self.get_elastic_class()
-        setattr(self, 'elastic', elastic_(*args, **kwargs))
-        return getattr(self, 'elastic')
+    def get_search_class(self):
+        return self.search_class
+
+    def get_search(self):
+        """校验查询参数中的搜索条件，创建搜索操作类"""
+        if getattr(self, 'search', None):
+            return getattr(self, 'search')
+        serializer = self.query_serializer_class(data=self.request.query_params)
+        serializer.is_valid(raise_exception=True)
+        search_ = self.get_search_class()
+        setattr(self, 'search', search_(serializer.get_query(), cache=self.search_cache))
+        return getattr(self, 'search')
 
     def get_queryset(self):
-        elastic = self.get_elastic(request=self.request)
-        return elastic.get_queryset()
+        """按当前页预取搜索结果，分页只查询一次搜索后端"""
+        search = self.get_search()
+        page_size = self.paginator.get_page_size(self.request)
+        try:
+            page = max(int(self.request.query_params.get(self.paginator.page_query_param, 1)), 1)
+        except ValueError:
+            page = 1
+        return search.get_queryset((page - 1) * page_size, page_size)
 
     def post(self, request):
+        """
+        搜索商品，查询参数：text, category, min_price, max_price, max_discounts, province, city,
+        sort(relevance, -sell_counts, price, -price), page, page_size
+        结果和聚合统计都来自搜索引擎，不查询数据库
+        """
         queryset = self.get_queryset()
+        if self.search.query.text and request.query_params.get(self.paginator.page_query_param, '1') == '1':
+            self.send_record_signal(request)  # 发送消息,记录搜索历史和热搜，翻页不重复记录
         page = self.paginate_queryset(queryset)  # 返回一个list页对象,默认返回第一页的page对象
         if page is not None:
+            self.record_views(request, page)
             serializer = self.get_serializer(page, many=True)
             return self.get_paginated_response(serializer.data)
+        queryset = queryset[:]
+        self.record_views(request, queryset)
         serializer = self.get_serializer(queryset, many=True)
-        self.send_record_signal(request)  # 发送消息,记录用户浏览记录
         return Response(serializer.data)
 
+    def record_views(self, request, documents):
+        """登录用户看到的搜索结果批量记入足迹"""
+        if request.user.is_authenticated:
+            self.foot_redis.record_views(request.user.pk, [document['pk'] for document in documents])
+
     def get(self, request):
-        """test"""
-        self.send_record_signal(request)
-        return Response(status=status.HTTP_204_NO_CONTENT)
+        """最近的搜索记录，未登录用户按IP记录"""
+        return Response({'history': self.get_history(request)})
 
+    @is_login
+    def get_history(self, request, identity=None):
+        return history_redis.retrieve_last_ten(identity, request)
 
     def delete(self, request):
-        """单删"""
+        """单删，many=true时群删"""
         if request.GET.get('many') == 'true':
-            print(2222)
             self.send_delete_signal(request, many=True)
         else:
             self.send_delete_signal(request)
@@ -94,8 +132,30 @@ class CommoditySearchOperation(GenericAPIView):
     @is_login
     def send_record_signal(self, request, identity=None):
         """发送记录历史记录信号"""
-        query = self.request.query_params.copy()
-        signals.record_search.send(sender=identity, request=request, key=query.get('text'))
+        signals.record_search.send(sender=identity, request=request, key=self.search.query.text)
+
+
+class HotSearchOperation(APIView):
+    """热搜榜，读取每几秒重建一次的缓存"""
+
+    def get(self, request):
+        try:
+            count = min(max(int(request.query_params.get('count', 10)), 1), history_redis.HOT_SIZE)
+        except ValueError:
+            count = 10
+        return Response({'heat': history_redis.heat_search(count)})
+
+
+class SuggestOperation(APIView):
+    """搜索联想，text为已输入的前缀，只读redis，不访问搜索引擎和数据库"""
+
+    def get(self, request):
+        try:
+            count = min(max(int(request.query_params.get('count', 10)), 1), suggest_redis.MAX_COUNT)
+        except ValueError:
+            count = 10
+        return Response({'suggestions': suggest_redis.suggest(request.query_params.get('text', ''), count)})
+
 
     # pagination_class = CommodityResultsSetPagination
 
@@ -5,6 +5,8 @@ from django.contrib import admin, messages
 from django.utils.translation import gettext_lazy as _
 
 from shop_app.models.commodity_models import Commodity
+from search_app.redis.index_redis import index_redis
+from shop_app.redis.commodity_redis import commodity_redis
 
 
 class Putaway_status(admin.SimpleListFilter):
@@ -77,8 +79,10 @@ class CommodityAdmin(admin.ModelAdmin):
     def make_shelve(self, request, queryset):
         """更新上架动作"""
         try:
-            result = queryset.update(status='1')
-            queryset.update(onshelve_time=datetime.now())
+            pks = list(queryset.values_list('pk', flat=True))  # 按状态过滤时，update之后queryset不再包含这些商品
+            result = queryset.update(status='1', onshelve_time=datetime.now())
+            commodity_redis.invalidate(*pks)  # update不触发信号，手动使缓存失效
+            index_redis.mark_dirty(*pks)  # 手动加入索引队列
             if result == 1:
                 message_shorthand = _('一个商品已经上架')
             else:
@@ -97,8 +101,10 @@ class CommodityAdmin(admin.ModelAdmin):
     def make_unshelve(self, request, queryset):
         """更新上架动作"""
         try:
-            result = queryset.update(status='0')
-            queryset.update(unshelve_time=datetime.now())
+            pks = list(queryset.values_list('pk', flat=True))  # 按状态过滤时，update之后queryset不再包含这些商品
+            result = queryset.update(status='0', unshelve_time=datetime.now())
+            commodity_redis.invalidate(*pks)  # update不触发信号，手动使缓存失效
+            index_redis.mark_dirty(*pks)  # 手动加入索引队列
             if result == 1:
                 message_shorthand = _('一个商品已经下架')
             else:
@@ -3,3 +3,8 @@ from django.apps import AppConfig
 
 class ShopAppConfig(AppConfig):
     name = 'shop_app'
+
+    def ready(self):
+        import shop_app.redis.seckill_redis
+        import shop_app.redis.commodity_redis
+        import shop_app.redis.details_redis
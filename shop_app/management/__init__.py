@@ -0,0 +1,5 @@
+# -*- coding: utf-8 -*-
+# @Time  : 2020/11/29 上午10:05
+# @Author : 司云中
+# @File : __init__.py
+# @Software: Pycharm
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# @Time  : 2020/11/29 上午10:05
+# @Author : 司云中
+# @File : commodity_cache_stats.py
+# @Software: Pycharm
+from django.core.management.base import BaseCommand
+
+from shop_app.redis.commodity_redis import commodity_redis
+
+
+class Command(BaseCommand):
+    """输出所有进程累计的商品缓存命中统计，各进程的计数最多延迟GENERATION_CHECK_SECONDS秒同步"""
+
+    help = 'Show the hit rate of the commodity cache'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='输出后清零统计')
+
+    def handle(self, *args, **options):
+        stats = commodity_redis.stats()
+        self.stdout.write('local hit: {local_hit}  redis hit: {redis_hit}  miss: {miss}  hit rate: {hit_rate:.2%}'
+                          .format(local_hit=stats.get('local_hit', 0), redis_hit=stats.get('redis_hit', 0),
+                                  miss=stats.get('miss', 0), hit_rate=stats['hit_rate']))
+        if options['reset']:
+            commodity_redis.redis.delete(commodity_redis.stats_key)
@@ -0,0 +1,30 @@
+# Generated by Django 2.2.15 on 2020-11-10 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop_app', '0002_auto_20201020_1927'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SeckKill',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start_time', models.DateTimeField(verbose_name='秒杀开始时间')),
+                ('end_time', models.DateTimeField(verbose_name='秒杀结束时间')),
+                ('seck_stock', models.PositiveIntegerField(default=0, verbose_name='秒杀库存')),
+                ('limit_counts', models.PositiveIntegerField(default=1, verbose_name='每人限购')),
+                ('is_expired', models.BooleanField(default=True)),
+                ('seck_commodity', models.OneToOneField(on_delete=True, to='shop_app.Commodity')),
+            ],
+            options={
+                'verbose_name': '秒杀商品',
+                'verbose_name_plural': '秒杀商品',
+                'db_table': 'SeckKill',
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.15 on 2020-11-29 11:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop_app', '0003_seckkill'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='seckkill',
+            name='is_expired',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -227,13 +227,19 @@ class SeckKill(models.Model):
     seck_commodity = models.OneToOneField(Commodity, on_delete=True)
 
     # 秒杀开始时间
-    start_time = models.DateTimeField(auto_now=True)
+    start_time = models.DateTimeField(verbose_name=_('秒杀开始时间'))
 
     # 秒杀结束时间
-    end_time = models.DateTimeField(auto_now=True)
+    end_time = models.DateTimeField(verbose_name=_('秒杀结束时间'))
 
-    # 是否过期
-    is_expired = models.BooleanField(default=True)
+    # 参与秒杀的库存,活动保存后预热到redis
+    seck_stock = models.PositiveIntegerField(verbose_name=_('秒杀库存'), default=0)
+
+    # 每个用户限购数量,0表示不限购
+    limit_counts = models.PositiveIntegerField(verbose_name=_('每人限购'), default=1)
+
+    # 是否已手动结束，新建的活动默认未结束，到达结束时间后无论该字段如何都视为已结束
+    is_expired = models.BooleanField(default=False)
 
     seck_kill_ = Manager()
 
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+# @Time  : 2020/11/20 下午4:18
+# @Author : 司云中
+# @File : commodity_redis.py
+# @Software: Pycharm
+import threading
+import time
+from collections import OrderedDict
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+
+from Emall.base_redis import BaseRedis
+from Emall.loggings import Logging
+from shop_app.models.commodity_models import Commodity
+
+commodity_logger = Logging.logger('commodity_')
+
+
+class LocalLRUCache:
+    """进程内的LRU缓存，每个条目带有过期时间，线程安全"""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """获取缓存，不存在或已过期返回None"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires < time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.time() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class CommodityRedis(BaseRedis):
+    """
+    商品读缓存
+    进程内LRU -> redis hash(commodity-{pk}) -> 数据库，逐级回源，批量接口get_many未命中部分只查询一次数据库
+
+    失效：商品保存或删除后删除redis中的hash，递增商品的版本号commodity-{pk}-version和全局版本号commodity-generation
+    每个uwsgi进程最多每GENERATION_CHECK_SECONDS秒检查一次全局版本号，版本变化则清空本地缓存
+    回源时先读取商品的版本号再查询数据库，由lua脚本在版本号未变时才写入redis，
+    避免查询期间商品被修改，旧数据在失效之后写入redis并保留REDIS_TTL秒
+    库存和销量频繁由UPDATE直接修改，不经过信号，因此不缓存
+    """
+
+    # 缓存的字段 -> 从redis读出后的类型转换
+    FIELDS = OrderedDict([
+        ('pk', int),
+        ('commodity_name', str),
+        ('price', int),
+        ('discounts', Decimal),
+        ('status', lambda value: value == '1'),
+        ('store_id', int),
+        ('shopper_id', int),
+        ('category', str),
+        ('intro', str),
+        ('image', str),
+        ('label', str),
+        ('freight', int),
+        ('discounts_intro', str),
+    ])
+
+    LOCAL_MAXSIZE = 2048  # 本地缓存最多保存的商品数量
+    LOCAL_TTL = 10  # 本地缓存有效期
+    REDIS_TTL = 60 * 60  # redis缓存有效期
+    GENERATION_CHECK_SECONDS = 1  # 检查全局版本号的间隔
+    VERSION_TTL = 60 * 60 * 24  # 商品版本号的有效期，远大于一次回源的耗时
+
+    # KEYS[1]:商品缓存hash  KEYS[2]:商品版本号  ARGV[1]:查询数据库之前读取的版本号，不存在为空串  ARGV[2]:有效期
+    # ARGV[3...]:field, value
+    # 版本号变化说明查询期间商品被修改，不写入
+    SET_SCRIPT = """
+    if (redis.call('GET', KEYS[2]) or '') ~= ARGV[1] then
+        return 0
+    end
+    redis.call('HMSET', KEYS[1], unpack(ARGV, 3))
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+    return 1
+    """
+
+    def __init__(self, db, redis):
+        super().__init__(db, redis)
+        self.set_script = self.redis.register_script(self.SET_SCRIPT)
+        self.local = LocalLRUCache(self.LOCAL_MAXSIZE, self.LOCAL_TTL)
+        self._generation = None
+        self._generation_checked = 0
+        self._stats = {'local_hit': 0, 'redis_hit': 0, 'miss': 0}  # 上次同步到redis之后的本进程计数
+        self._stats_lock = threading.Lock()
+        self.connect()
+
+    def connect(self):
+        """注册商品的信号，商品修改或删除后缓存失效"""
+        post_save.connect(self.invalidate_callback, sender=Commodity)
+        post_delete.connect(self.invalidate_callback, sender=Commodity)
+
+    def hash_key(self, pk):
+        """商品缓存hash的键，与版本号使用相同的哈希标签"""
+        return self.key('commodity', self.tag(pk))
+
+    def version_key(self, pk):
+        """商品版本号的键，每次失效递增"""
+        return self.key('commodity', self.tag(pk), 'version')
+
+    @property
+    def generation_key(self):
+        """全局版本号的键"""
+        return self.key('commodity', 'generation')
+
+    @property
+    def stats_key(self):
+        """命中率统计hash的键"""
+        return self.key('commodity', 'cache', 'stats')
+
+    def _count(self, **counts):
+        with self._stats_lock:
+            for name, value in counts.items():
+                self._stats[name] += value
+
+    def _check_generation(self):
+        """
+        定期检查全局版本号，版本变化说明有商品被修改，清空本地缓存
+        顺带把本进程的命中计数同步到redis
+        """
+        now = time.time()
+        if now - self._generation_checked < self.GENERATION_CHECK_SECONDS:
+            return
+        self._generation_checked = now
+        with self._stats_lock:
+            stats, self._stats = self._stats, dict.fromkeys(self._stats, 0)
+        with self.redis.pipeline(transaction=False) as pipe:
+            pipe.get(self.generation_key)
+            for name, value in stats.items():
+                if value:
+                    pipe.hincrby(self.stats_key, name, value)
+            generation = pipe.execute()[0]
+        if generation != self._generation:
+            self.local.clear()
+            self._generation = generation
+
+    @classmethod
+    def to_hash(cls, values):
+        """数据库的values() -> redis hash"""
+        return {field: int(values[field]) if isinstance(values[field], bool) else
+                ('' if values[field] is None else values[field]) for field in cls.FIELDS}
+
+    @classmethod
+    def from_hash(cls, mapping):
+        """redis hash -> dict"""
+        return {field: convert(mapping[field.encode()].decode()) for field, convert in cls.FIELDS.items()}
+
+    def get_many(self, pks):
+        """
+        批量获取商品
+        :param pks: 商品pk列表
+        :return: dict  {pk: dict}，不存在的商品不在其中
+        """
+        self._check_generation()
+        result = {}
+        missing = []
+        for pk in set(int(pk) for pk in pks):
+            value = self.local.get(pk)
+            if value is None:
+                missing.append(pk)
+            else:
+                result[pk] = value
+        local_hit = len(result)
+        if missing:
+            with self.redis.pipeline(transaction=False) as pipe:
+                for pk in missing:
+                    pipe.hgetall(self.hash_key(pk))
+                    pipe.get(self.version_key(pk))  # 未命中时回源需要
+                replies = pipe.execute()
+            db_missing = {}
+            for pk, mapping, version in zip(missing, replies[::2], replies[1::2]):
+                if mapping:
+                    result[pk] = self.from_hash(mapping)
+                    self.local.set(pk, result[pk])
+                else:
+                    db_missing[pk] = version
+            if db_missing:
+                self._load_from_db(db_missing, result)
+            self._count(redis_hit=len(missing) - len(db_missing), miss=len(db_missing))
+        self._count(local_hit=local_hit)
+        return result
+
+    def get(self, pk):
+        """获取单个商品，不存在返回None"""
+        return self.get_many([pk]).get(int(pk))
+
+    def _load_from_db(self, versions, result):
+        """
+        未命中的商品一次查询回源，版本号未变的写入redis和本地缓存
+        查询期间被修改的商品只返回给本次调用，不写入缓存
+        :param versions: dict  {pk: 查询数据库之前读取的版本号}
+        """
+        rows = list(Commodity.commodity_.filter(pk__in=versions.keys()).values(*self.FIELDS))
+        with self.redis.pipeline(transaction=False) as pipe:
+            for row in rows:
+                mapping = self.to_hash(row)
+                version = versions[row['pk']]
+                args = [version.decode() if version is not None else '', self.REDIS_TTL]
+                for field, value in mapping.items():
+                    args.extend((field, str(value)))  # Decimal等类型redis客户端无法编码
+                self.set_script(keys=[self.hash_key(row['pk']), self.version_key(row['pk'])], args=args,
+                                client=pipe)
+                result[row['pk']] = self.from_hash({key.encode(): str(value).encode()
+                                                    for key, value in mapping.items()})
+            written = pipe.execute()
+        for row, ok in zip(rows, written):
+            if ok:
+                self.local.set(row['pk'], result[row['pk']])
+
+    def invalidate(self, *pks):
+        """使商品缓存失效，所有进程的本地缓存在GENERATION_CHECK_SECONDS内失效"""
+        if not pks:
+            return
+        with self.redis.pipeline(transaction=False) as pipe:
+            for pk in pks:  # 分片时各商品可能在不同节点，逐个处理
+                pipe.delete(self.hash_key(pk))
+                pipe.incr(self.version_key(pk))
+                pipe.expire(self.version_key(pk), self.VERSION_TTL)
+            pipe.incr(self.generation_key)
+            pipe.execute()
+        for pk in pks:
+            self.local.delete(int(pk))
+
+    def invalidate_callback(self, sender, instance, **kwargs):
+        """
+        Commodity保存或删除后的信号回调
+        事务提交后才失效，提交前回源读到的旧数据因版本号变化不会写入缓存
+        """
+        transaction.on_commit(lambda: self._invalidate_quietly(instance.pk))
+
+    def _invalidate_quietly(self, pk):
+        try:
+            self.invalidate(pk)
+        except Exception as e:
+            commodity_logger.error(e)
+
+    def stats(self):
+        """
+        所有进程累计的命中统计
+        :return: dict  {'local_hit':, 'redis_hit':, 'miss':, 'hit_rate':}
+        """
+        stats = {key.decode(): int(value) for key, value in self.redis.hgetall(self.stats_key).items()}
+        for name, value in self._stats.items():  # 尚未同步的本进程计数
+            stats[name] = stats.get(name, 0) + value
+        total = sum(stats.values())
+        stats['hit_rate'] = round((stats.get('local_hit', 0) + stats.get('redis_hit', 0)) / total, 4) if total else 0
+        return stats
+
+
+commodity_redis = CommodityRedis.choice_redis_db('redis')
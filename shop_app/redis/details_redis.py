@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+# @Time  : 2020/11/21 上午10:32
+# @Author : 司云中
+# @File : details_redis.py
+# @Software: Pycharm
+from django.db import transaction
+from django.db.models.signals import post_save
+
+from Emall.base_redis import BaseRedis
+from Emall.loggings import Logging
+from shop_app.models.commodity_models import Commodity
+from shop_app.utils.markdown_render import render_details, details_digest
+
+commodity_logger = Logging.logger('commodity_')
+
+
+class CommodityDetailsRedis(BaseRedis):
+    """
+    商品详情页渲染结果缓存
+    键为 commodity-{pk}-details-{sha1(details)}，详情内容变化后自然落到新的键，旧键过期淘汰
+    商品保存后由celery异步预渲染，未命中时同步渲染并写入
+    """
+
+    TTL = 60 * 60 * 24 * 7  # 渲染结果保留一周
+
+    def __init__(self, db, redis):
+        super().__init__(db, redis)
+        self.connect()
+
+    def connect(self):
+        """注册商品保存的信号，保存后异步预渲染详情"""
+        post_save.connect(self.prerender_callback, sender=Commodity)
+
+    def details_key(self, pk, digest):
+        """渲染结果的键"""
+        return self.key('commodity', pk, 'details', digest)
+
+    def store(self, pk, text):
+        """渲染并缓存"""
+        html = render_details(text)
+        self.redis.set(self.details_key(pk, details_digest(text)), html, ex=self.TTL)
+        return html
+
+    def get_or_render(self, pk, text):
+        """
+        获取渲染后的商品详情，未命中时渲染并写入
+        :param pk: 商品pk
+        :param text: 商品详情markdown
+        :return: str html
+        """
+        html = self.redis.get(self.details_key(pk, details_digest(text)))
+        if html is not None:
+            return html.decode()
+        return self.store(pk, text)
+
+    def prerender_callback(self, sender, instance, **kwargs):
+        """Commodity保存后的信号回调，事务提交后再投递任务，避免任务读到旧数据"""
+        from shop_app.tasks import render_commodity_details
+
+        try:
+            transaction.on_commit(lambda: render_commodity_details.delay(instance.pk))
+        except Exception as e:
+            commodity_logger.error(e)
+
+
+details_redis = CommodityDetailsRedis.choice_redis_db('redis')
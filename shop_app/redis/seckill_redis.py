@@ -3,75 +3,294 @@
 # @Author : 司云中
 # @File : seckill_redis.py
 # @Software: Pycharm
-import math
+import datetime
 import time
 import uuid
 
+from django.db.models.signals import post_save, post_delete
+
 from Emall.base_redis import BaseRedis
+from Emall.loggings import Logging
+from Emall.snowflake import snowflake
+from redis import ResponseError
+from shop_app.models.commodity_models import SeckKill
+
+common_logger = Logging.logger('django')
+
+commodity_logger = Logging.logger('commodity_')
 
 
 class Seckill(BaseRedis):
-    """秒杀操作"""
+    """
+    秒杀操作
+    库存预热到redis的hash中，由一个lua脚本在服务端原子地完成
+    校验活动时间 -> 校验限购 -> 校验库存 -> 扣减库存 -> 记录买家购买数量
+    不再需要全局锁，不同商品之间互不阻塞
+    抢购成功的买家写入该活动的stream，由celery异步批量生成订单，客户端凭token轮询订单状态
+    stream的消息中带有生成订单所需的商品、商家、单价，活动信息被清除后已抢购成功的买家仍能生成订单
+    订单号在抢购时分配并写入消息，重复消费同一条消息不会重复生成订单
+    lua脚本涉及的键都以活动pk作为哈希标签，分片时落在同一节点
+    """
+
+    # 预扣结果
+    RESERVE_SUCCESS = 1  # 抢购成功
+    RESERVE_SOLD_OUT = 0  # 库存不足
+    RESERVE_LIMIT = -1  # 超出限购数量
+    RESERVE_NOT_EXIST = -2  # 活动不存在或尚未预热
+    RESERVE_NOT_IN_TIME = -3  # 不在活动时间内
+
+    # KEYS[1]:活动信息hash  KEYS[2]:买家购买数量hash  KEYS[3]:抢购成功者stream  KEYS[4]:订单状态hash
+    # ARGV[1]:用户id  ARGV[2]:购买数量  ARGV[3]:当前时间戳  ARGV[4]:订单凭证token  ARGV[5]:订单状态存活时间
+    # ARGV[6]:订单号
+    RESERVE_SCRIPT = """
+    local info = redis.call('HMGET', KEYS[1], 'stock', 'limit', 'start', 'end', 'commodity', 'shopper', 'price')
+    if not info[1] then
+        return -2
+    end
+    local now = tonumber(ARGV[3])
+    if now < tonumber(info[3]) or now > tonumber(info[4]) then
+        return -3
+    end
+    local counts = tonumber(ARGV[2])
+    local limit = tonumber(info[2])
+    local bought = tonumber(redis.call('HGET', KEYS[2], ARGV[1]) or '0')
+    if limit > 0 and bought + counts > limit then
+        return -1
+    end
+    if tonumber(info[1]) < counts then
+        return 0
+    end
+    redis.call('HINCRBY', KEYS[1], 'stock', -counts)
+    redis.call('HINCRBY', KEYS[2], ARGV[1], counts)
+    redis.call('XADD', KEYS[3], '*', 'user', ARGV[1], 'counts', ARGV[2], 'token', ARGV[4],
+               'commodity', info[5], 'shopper', info[6], 'price', info[7], 'orderId', ARGV[6])
+    redis.call('HMSET', KEYS[4], 'user', ARGV[1], 'status', 'pending')
+    redis.call('EXPIRE', KEYS[4], ARGV[5])
+    return 1
+    """
+
+    # KEYS[1]:活动信息hash  KEYS[2]:买家购买数量hash  KEYS[3](可选):订单状态hash  ARGV[1]:用户id  ARGV[2]:归还数量
+    # 活动信息已被清除时不归还，避免HINCRBY重建出只有stock且没有过期时间的活动信息
+    # 传入订单状态时，只有仍在排队的订单归还一次，同时标记为生成失败，重复消费同一条消息不会重复归还
+    RELEASE_SCRIPT = """
+    if KEYS[3] then
+        if redis.call('HGET', KEYS[3], 'status') ~= 'pending' then
+            return 0
+        end
+        redis.call('HSET', KEYS[3], 'status', 'failed')
+    end
+    if redis.call('EXISTS', KEYS[1]) == 0 then
+        return 0
+    end
+    redis.call('HINCRBY', KEYS[1], 'stock', ARGV[2])
+    redis.call('HINCRBY', KEYS[2], ARGV[1], -tonumber(ARGV[2]))
+    return 1
+    """
+
+    # 订单状态
+    ORDER_PENDING = 'pending'  # 排队生成订单中
+    ORDER_SUCCESS = 'success'  # 订单已生成
+    ORDER_FAILED = 'failed'  # 订单生成失败，库存已归还
+
+    ORDER_STATUS_SECONDS = 60 * 60 * 24  # 订单状态保留一天
+
+    MAX_DELIVERIES = 3  # 一批消息投递超过该次数仍未ack，说明整批写入反复失败，改为逐个生成订单
+    GROUP = 'materialize'  # 消费者组
+    CONSUMER = 'materializer'  # 消费者名称，所有worker共用，宕机后未ack的消息可被其他worker重新读取
+
+    # 活动结束后信息继续保留一天，方便对账
+    RETAIN_SECONDS = 60 * 60 * 24
 
     def __init__(self, db, redis):
         super().__init__(db, redis)
+        self.reserve_script = self.redis.register_script(self.RESERVE_SCRIPT)  # 只在首次调用时传输脚本，之后走evalsha
+        self.release_script = self.redis.register_script(self.RELEASE_SCRIPT)
+        self.connect()
 
-    def acquire_lock_with_timeout(self, conn, lock_name, acquire_timeout=3, lock_timeout=3, **kwargs):
+    def connect(self):
+        """注册秒杀活动的信号，活动保存后自动预热库存"""
+        post_save.connect(self.preload_stock_callback, sender=SeckKill)
+        post_delete.connect(self.clear_stock_callback, sender=SeckKill)
+
+    def info_key(self, seckill_pk):
+        """秒杀活动信息hash的键：stock,limit,start,end,commodity,shopper,price"""
+        return self.key('seckill', self.tag(seckill_pk), 'info')
+
+    def buyers_key(self, seckill_pk):
+        """秒杀活动买家hash的键：user_pk -> 已抢购数量"""
+        return self.key('seckill', self.tag(seckill_pk), 'buyers')
+
+    def orders_key(self, seckill_pk):
+        """抢购成功者stream的键"""
+        return self.key('seckill', self.tag(seckill_pk), 'orders')
+
+    def order_key(self, token):
+        """订单状态hash的键：user,status,orderId，token以活动pk开头"""
+        seckill_pk, _, suffix = token.partition('-')
+        return self.key('seckill', 'order', self.tag(seckill_pk), suffix)
+
+    @property
+    def active_key(self):
+        """存在待生成订单的秒杀活动集合"""
+        return self.key('seckill', 'active')
+
+    def materialize_lock_key(self, seckill_pk):
+        """生成订单时的互斥锁，防止两个定时任务重复消费同一个活动"""
+        return self.key('seckill', seckill_pk, 'materialize', 'lock')
+
+    def preload_stock(self, instance):
         """
-        基于 Redis 实现的单点分布式锁
+        预热秒杀库存
+        库存只在首次预热时写入(HSETNX)，避免活动进行中修改活动信息把已扣减的库存覆盖掉
+        :param instance: SeckKill实例
+        :return: bool
+        """
+        info_key = self.info_key(instance.pk)
+        start = int(time.mktime(instance.start_time.timetuple()))
+        end = int(time.mktime(instance.end_time.timetuple()))
+        commodity = instance.seck_commodity
+        with self.redis.pipeline() as pipe:
+            pipe.hsetnx(info_key, 'stock', instance.seck_stock)
+            pipe.hmset(info_key, {
+                'limit': instance.limit_counts,
+                'start': start,
+                'end': end,
+                'commodity': commodity.pk,  # 以下字段随抢购成功的消息写入stream，供异步生成订单使用
+                'shopper': commodity.shopper_id,
+                'price': str(commodity.price * commodity.discounts),
+            })
+            pipe.expireat(info_key, end + self.RETAIN_SECONDS)
+            pipe.expireat(self.buyers_key(instance.pk), end + self.RETAIN_SECONDS)
+            pipe.sadd(self.active_key, instance.pk)
+            pipe.execute()
+        try:
+            self.redis.xgroup_create(self.orders_key(instance.pk), self.GROUP, id='0', mkstream=True)
+        except ResponseError:  # BUSYGROUP,消费者组已存在
+            pass
+        return True
 
-        :param conn: Redis 连接
-        :param lock_name: 锁的名称
-        :param acquire_timeout: 获取锁的超时时间，默认 3 秒
-        :param lock_timeout: 锁的超时时间，默认 2 秒
-        :return:
+    def clear_stock(self, seckill_pk):
+        """
+        清除秒杀活动的库存以及买家记录
+        stream保留，已抢购成功的买家仍需生成订单
         """
+        self.redis.delete(self.info_key(seckill_pk), self.buyers_key(seckill_pk))
 
-        identifier = str(uuid.uuid4())
-        lock_name = f'redis-lock:{lock_name}'
-        lock_timeout = int(math.ceil(lock_timeout))
+    def preload_stock_callback(self, sender, instance, **kwargs):
+        """
+        SeckKill保存后的信号回调，手动结束或已过结束时间的活动直接清除，其余的预热
+        预热使用HSETNX写入库存，活动进行中修改seck_stock不会生效
+        """
+        try:
+            if instance.is_expired or instance.end_time <= datetime.datetime.now():
+                self.clear_stock(instance.pk)
+            else:
+                self.preload_stock(instance)
+        except Exception as e:
+            commodity_logger.error(e)
+
+    def clear_stock_callback(self, sender, instance, **kwargs):
+        """SeckKill删除后的信号回调"""
+        try:
+            self.clear_stock(instance.pk)
+        except Exception as e:
+            commodity_logger.error(e)
+
+    def get_stock(self, seckill_pk):
+        """获取剩余秒杀库存，未预热返回None"""
+        stock = self.redis.hget(self.info_key(seckill_pk), 'stock')
+        return int(stock) if stock is not None else None
+
+    def reserve(self, seckill_pk, user_pk, counts=1):
+        """
+        预扣秒杀库存，一次网络往返完成全部校验、扣减以及入队
+        :param seckill_pk: 秒杀活动pk
+        :param user_pk: 用户pk
+        :param counts: 购买数量
+        :return: tuple 预扣结果, 订单凭证token(失败为None)
+        """
+        token = '{}-{}'.format(seckill_pk, uuid.uuid4().hex)
+        keys = [self.info_key(seckill_pk), self.buyers_key(seckill_pk), self.orders_key(seckill_pk),
+                self.order_key(token)]
+        args = [user_pk, counts, int(time.time()), token, self.ORDER_STATUS_SECONDS, snowflake.next_id()]
+        result = int(self.reserve_script(keys=keys, args=args))
+        return result, token if result == self.RESERVE_SUCCESS else None
+
+    def release(self, seckill_pk, user_pk, counts, token=None):
+        """
+        订单生成失败或超时取消，归还库存和限购名额，活动已被清除时不归还
+        :param token: 订单凭证，传入时只有仍在排队的订单会归还，并标记为生成失败
+        :return: bool 是否归还
+        """
+        keys = [self.info_key(seckill_pk), self.buyers_key(seckill_pk)]
+        if token is not None:
+            keys.append(self.order_key(token))
+        return bool(self.release_script(keys=keys, args=[user_pk, counts]))
 
-        end = time.time() + acquire_timeout
-        commodity_id = kwargs.pop('pk')  # 弹出商品id
-        key = self.key('rob-lock',commodity_id)
+    def get_order_status(self, token):
+        """
+        获取订单状态
+        :return: dict  {'user':, 'status':, 'orderId':} 不存在返回{}
+        """
+        return {key.decode(): value.decode() for key, value in self.redis.hgetall(self.order_key(token)).items()}
 
-        while time.time() < end:
-            # 如果不存在这个锁则加锁并设置过期时间，避免死锁
+    def get_info(self, seckill_pk):
+        """获取秒杀活动信息"""
+        return {key.decode(): value.decode() for key, value in self.redis.hgetall(self.info_key(seckill_pk)).items()}
 
-            if conn.set(lock_name, identifier, ex=lock_timeout, nx=True):  # 如果拿到锁
-                conn.decr(key)  # 减去一
-                return identifier  # 返回唯一标识
+    def active_seckills(self):
+        """存在待生成订单的秒杀活动pk列表"""
+        return [int(value) for value in self.redis.smembers(self.active_key)]
 
-        return False
+    def acquire_materialize_lock(self, seckill_pk, timeout=30):
+        """获取生成订单的锁"""
+        return self.redis.set(self.materialize_lock_key(seckill_pk), 1, ex=timeout, nx=True)
 
-    def release_lock(conn, lock_name, identifier):
+    def release_materialize_lock(self, seckill_pk):
+        self.redis.delete(self.materialize_lock_key(seckill_pk))
+
+    def read_winners(self, seckill_pk, count=500):
+        """
+        读取一批抢购成功者
+        先读取已投递但未ack的消息(上次生成订单失败或worker宕机)，没有再读取新消息
+        :return: list [(entry_id, {'user':, 'counts':, 'token':, 'commodity':, 'shopper':, 'price':, 'orderId':}), ...]
         """
-        释放锁
+        stream = self.orders_key(seckill_pk)
+        for offset in ('0', '>'):
+            response = self.redis.xreadgroup(self.GROUP, self.CONSUMER, {stream: offset}, count=count)
+            entries = response[0][1] if response else []
+            if entries:
+                return [(entry_id.decode(), {key.decode(): value.decode() for key, value in (fields or {}).items()})
+                        for entry_id, fields in entries]  # 已被删除的未ack消息fields为None
+        return []
 
-        :param conn: Redis 连接
-        :param lockname: 锁的名称
-        :param identifier: 锁的标识
-        :return:
+    def delivery_counts(self, seckill_pk, entry_ids):
+        """
+        一批消息(read_winners返回的顺序)各自被投递的次数
+        :return: dict  {entry_id: 投递次数}
+        """
+        pending = self.redis.xpending_range(self.orders_key(seckill_pk), self.GROUP, entry_ids[0], entry_ids[-1],
+                                            len(entry_ids))
+        return {item['message_id'].decode(): item['times_delivered'] for item in pending}
+
+    def finish_winners(self, seckill_pk, entry_ids, order_status):
+        """
+        批量确认已处理的抢购成功者，并写入订单状态
+        :param entry_ids: stream中的消息id列表
+        :param order_status: {token: (status, orderId)}
         """
-        # python中redis事务是通过pipeline的封装实现的
-        with conn.pipeline() as pipe:
-            lock_name = 'lock:' + lock_name
+        stream = self.orders_key(seckill_pk)
+        with self.redis.pipeline() as pipe:
+            pipe.xack(stream, self.GROUP, *entry_ids)
+            pipe.xdel(stream, *entry_ids)
+            for token, (status, order_id) in order_status.items():
+                pipe.hmset(self.order_key(token), {'status': status, 'orderId': order_id or ''})
+            pipe.execute()
 
-            while True:
-                try:
-                    # watch 锁,监听该锁, multi 后如果该 key 被其他客户端改变, 事务操作会抛出 WatchError 异常,使得当前客户端不会误删了别人的锁
-                    pipe.watch(lock_name)
-                    ident = pipe.get(lock_name)
-                    if ident and ident.decode('utf-8') == identifier:
-                        # 事务开始
+    def deactivate_if_drained(self, seckill_pk):
+        """活动已结束且stream中的买家全部处理完毕，移出活动集合"""
+        if not self.redis.exists(self.info_key(seckill_pk)) and not self.redis.xlen(self.orders_key(seckill_pk)):
+            self.redis.srem(self.active_key, seckill_pk)
 
-                        pipe.multi()
-                        pipe.delete(lock_name)
-                        pipe.execute()
-                        return True
 
-                    pipe.unwatch()
-                    break
-                except WatchError:
-                    pass
-            return False
+seckill_redis = Seckill.choice_redis_db('redis')
@@ -10,6 +10,8 @@ from haystack import indexes
 class CommodityIndex(indexes.SearchIndex, indexes.Indexable):
     """
     定义关于Note的haystack搜索引擎
+    除全文检索字段外，保存商品卡片所需的全部字段，搜索结果直接取自索引，不再查询数据库
+    faceted=True的字段额外生成不分词的*_exact字段，用于精确过滤和聚合
     """
 
     # document 表示该字段主要用于关键字查询的主要字段
@@ -18,11 +20,25 @@ class CommodityIndex(indexes.SearchIndex, indexes.Indexable):
     # model_attr表明能让搜索引擎识别的额外字段，用来检索参照数据表中的字段值，保存在索引苦衷的字段
     commodity_name = indexes.CharField(model_attr='commodity_name')
     shopper = indexes.CharField(model_attr='shopper')
+    category = indexes.CharField(model_attr='category', faceted=True)
+    intro = indexes.CharField(model_attr='intro', indexed=False)
+    label = indexes.CharField(model_attr='label', indexed=False)
+    price = indexes.IntegerField(model_attr='price')
+    discounts = indexes.FloatField(model_attr='discounts')
+    sell_counts = indexes.IntegerField(model_attr='sell_counts')
+    image = indexes.CharField(indexed=False)
+    store_id = indexes.IntegerField(model_attr='store_id')
+    store_name = indexes.CharField(model_attr='store__store_name', indexed=False)
+    province = indexes.CharField(model_attr='store__province', faceted=True)
+    city = indexes.CharField(model_attr='store__city', faceted=True)
 
     def get_model(self):
         # 返回建立索引的模型类
         return Commodity
 
+    def prepare_image(self, obj):
+        return obj.image.name or ''
+
     def index_queryset(self, using=None):
         # 返回建立索引的数据查询集
-        return self.get_model().commodity_.filter(status=True)
+        return self.get_model().commodity_.filter(status=True).select_related('store')
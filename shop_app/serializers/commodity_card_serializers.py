@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+# @Time  : 2020/11/27 下午3:05
+# @Author : 司云中
+# @File : commodity_card_serializers.py
+# @Software: Pycharm
+from decimal import Decimal
+
+from django.core.files.storage import default_storage
+from django.db.models import F
+
+from shop_app.models.commodity_models import Commodity
+
+
+class CommodityCardSerializer:
+    """
+    商品卡片，搜索结果、收藏夹、足迹、购物车等列表页共用
+    卡片字段：pk, commodity_name, price(折后价), image, sell_counts, store_id, store_name
+
+    列表页每页可能有上百个商品，不使用DRF的字段：数据由values()/only()查询得到扁平的dict(row)，
+    按dict直接构造卡片。row可以JSON序列化，缓存row而不是卡片，图片的完整地址在返回时按请求生成
+    接口与DRF序列化器一致，可直接作为GenericAPIView.serializer_class：CommodityCardSerializer(rows, many=True).data
+    """
+
+    # row的字段，索引文档中同样包含这些字段，见BaseSearchBackend.document
+    ROW_FIELDS = ('pk', 'commodity_name', 'price', 'discounts', 'image', 'sell_counts', 'store_id', 'store_name')
+
+    # only()加载的字段
+    ONLY_FIELDS = ('commodity_name', 'price', 'discounts', 'image', 'sell_counts', 'store', 'store__store_name')
+
+    def __init__(self, instance=None, many=False, context=None, **kwargs):
+        self.instance = instance
+        self.many = many
+        self.context = context or {}
+
+    @property
+    def data(self):
+        if self.many:
+            return [self.to_representation(row) for row in self.instance]
+        return self.to_representation(self.instance)
+
+    def get_image(self, name):
+        """与ImageField一致，有请求时返回完整的图片地址"""
+        if not name:
+            return None
+        url = default_storage.url(name)
+        request = self.context.get('request')
+        return request.build_absolute_uri(url) if request is not None else url
+
+    @staticmethod
+    def get_price(row):
+        """折后价，保留两位小数"""
+        return float(round(row['price'] * Decimal(str(row['discounts'])), 2))
+
+    def to_representation(self, row):
+        return {
+            'pk': row['pk'],
+            'commodity_name': row['commodity_name'],
+            'price': self.get_price(row),
+            'image': self.get_image(row['image']),
+            'sell_counts': row['sell_counts'],
+            'store_id': row['store_id'],
+            'store_name': row['store_name'],
+        }
+
+    @classmethod
+    def only(cls, queryset, prefix='', fields=()):
+        """
+        只加载卡片需要的字段的查询集
+        :param prefix: 通过外键查询商品时的前缀，例如收藏记录的'commodity__'
+        :param fields: 同时加载的其他字段，only()会覆盖之前的only()，需一并传入
+        """
+        return queryset.select_related(prefix + 'store').only(*fields, *(prefix + field for field in cls.ONLY_FIELDS))
+
+    @staticmethod
+    def row(commodity):
+        """only()得到的商品实例 -> row"""
+        return {
+            'pk': commodity.pk,
+            'commodity_name': commodity.commodity_name,
+            'price': commodity.price,
+            'discounts': commodity.discounts,
+            'image': commodity.image.name or '',
+            'sell_counts': commodity.sell_counts,
+            'store_id': commodity.store_id,
+            'store_name': commodity.store.store_name if commodity.store_id else '',
+        }
+
+    @classmethod
+    def rows(cls, queryset):
+        """商品查询集 -> row列表，一次values()查询，不构造模型实例"""
+        return list(queryset.values(*cls.ROW_FIELDS[:-1], store_name=F('store__store_name')))
+
+    @classmethod
+    def rows_in_order(cls, pks):
+        """
+        按给定的pk顺序查询商品的row
+        :return: list 已删除的商品不在其中
+        """
+        pks = [int(pk) for pk in pks]
+        rows = {row['pk']: row for row in cls.rows(Commodity.commodity_.filter(pk__in=pks))}
+        return [rows[pk] for pk in pks if pk in rows]
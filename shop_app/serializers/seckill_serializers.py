@@ -11,15 +11,20 @@ from rest_framework import serializers
 class SecKillSerializer(serializers.Serializer):
     """
     秒杀序列化器
-    生成订单并加锁，完成交易解锁
-    DRF限流
+    只做参数校验，库存校验和扣减全部交给redis中的lua脚本，热路径上不访问数据库
     """
-    pass
-
-
-
-
-
 
+    pk = serializers.IntegerField(min_value=1)  # 秒杀活动pk
 
+    counts = serializers.IntegerField(min_value=1, max_value=99, default=1)  # 抢购数量
 
+    @staticmethod
+    def reserve(validated_data, user, redis):
+        """
+        预扣秒杀库存
+        :param validated_data: 验证后的数据
+        :param user: 当前用户
+        :param redis: 秒杀redis操作实例
+        :return: tuple 预扣结果, 订单凭证token
+        """
+        return redis.reserve(validated_data['pk'], user.pk, validated_data['counts'])
@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+# @Time  : 2020/11/21 上午10:32
+# @Author : 司云中
+# @File : tasks.py
+# @Software: Pycharm
+from Emall import celery_apps as app
+from shop_app.models.commodity_models import Commodity
+from shop_app.redis.details_redis import details_redis
+
+
+@app.task
+def render_commodity_details(pk):
+    """商品保存后预渲染商品详情页"""
+    details = Commodity.commodity_.filter(pk=pk).values_list('details', flat=True).first()
+    if details is not None:
+        details_redis.store(pk, details)
@@ -1,6 +1,7 @@
 from rest_framework import routers
 
 from shop_app.views.shop import enter_introduction_page
+from shop_app.views.seckill import SecKillOperation, SecKillOrderOperation
 from shop_app.views.shop_api import AddShopCartOperation, AddFavoritesOperation
 from django.urls import path, include
 
@@ -10,6 +11,8 @@ urlpatterns = [
     path('introduce/<int:pk>', enter_introduction_page, name='introduce'),
     path('add-into-shop-cart/', AddShopCartOperation.as_view(), name='add-into-shop-cart'),
     path('add-into-favorites-chsc-api/', AddFavoritesOperation.as_view(), name='add-into-favorites-chsc-api'),
+    path('seckill-chsc-api/', SecKillOperation.as_view(), name='seckill-chsc-api'),
+    path('seckill-order-chsc-api/<str:token>/', SecKillOrderOperation.as_view(), name='seckill-order-chsc-api'),
 ]
 
 # DRF视图集注册
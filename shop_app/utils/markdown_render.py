@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# @Time  : 2020/11/21 上午10:32
+# @Author : 司云中
+# @File : markdown_render.py
+# @Software: Pycharm
+import hashlib
+
+import markdown
+
+# 商品详情渲染使用的拓展
+EXTENSIONS = [
+    'markdown.extensions.extra',
+    'markdown.extensions.attr_list',
+    'markdown.extensions.smarty',
+    'markdown.extensions.codehilite',  # 语法高亮拓展
+    'markdown.extensions.toc',  # 自动生成目录
+]
+
+
+def render_details(text):
+    """将商品详情的markdown渲染为html"""
+    return markdown.markdown(text, extensions=EXTENSIONS, safe_mode=True)
+
+
+def details_digest(text):
+    """商品详情内容的sha1，内容变化后缓存的键随之变化"""
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
@@ -3,13 +3,67 @@
 # @Author : 司云中
 # @File : seckill.py
 # @Software: Pycharm
-import uuid
-
+from rest_framework import status
 from rest_framework.generics import GenericAPIView
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+
+from Emall.loggings import Logging
+from Emall.response_code import response_code
+from shop_app.redis.seckill_redis import seckill_redis, Seckill
+from shop_app.serializers.seckill_serializers import SecKillSerializer
+
+common_logger = Logging.logger('django')
 
 
 class SecKillOperation(GenericAPIView):
     """秒杀活动"""
 
-    # serializer_class = SecKillSerializer
+    permission_classes = [IsAuthenticated]
+
+    serializer_class = SecKillSerializer
+
+    redis = seckill_redis
+
+    # 预扣结果 -> 响应
+    result_response = {
+        Seckill.RESERVE_SUCCESS: ('seckill_success', status.HTTP_200_OK),
+        Seckill.RESERVE_SOLD_OUT: ('seckill_sold_out', status.HTTP_200_OK),
+        Seckill.RESERVE_LIMIT: ('seckill_limit_error', status.HTTP_200_OK),
+        Seckill.RESERVE_NOT_EXIST: ('seckill_not_exist', status.HTTP_404_NOT_FOUND),
+        Seckill.RESERVE_NOT_IN_TIME: ('seckill_not_in_time', status.HTTP_200_OK),
+    }
+
+    def post(self, request):
+        """
+        抢购
+        抢购成功立即返回订单凭证token，订单由后台异步生成，凭token轮询订单状态
+        """
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        result, token = serializer.reserve(serializer.validated_data, request.user, self.redis)
+        code, status_ = self.result_response.get(result, ('server_error', status.HTTP_500_INTERNAL_SERVER_ERROR))
+        return Response(dict(getattr(response_code, code), data={'token': token}), status=status_)
+
+
+class SecKillOrderOperation(GenericAPIView):
+    """秒杀订单状态轮询"""
+
+    permission_classes = [IsAuthenticated]
+
+    redis = seckill_redis
+
+    # 订单状态 -> 响应
+    status_response = {
+        Seckill.ORDER_PENDING: 'seckill_order_pending',
+        Seckill.ORDER_SUCCESS: 'seckill_order_success',
+        Seckill.ORDER_FAILED: 'seckill_order_failed',
+    }
 
+    def get(self, request, token):
+        """获取订单生成状态，成功时返回订单号"""
+        order_status = self.redis.get_order_status(token)
+        if not order_status or order_status.get('user') != str(request.user.pk):  # 只能查询自己的凭证
+            return Response(response_code.seckill_order_not_exist, status=status.HTTP_404_NOT_FOUND)
+        code = self.status_response.get(order_status['status'], 'server_error')
+        return Response(dict(getattr(response_code, code), data={'orderId': order_status.get('orderId') or None}))
@@ -4,11 +4,11 @@
 # @File : shop.py 
 # @Software: PyCharm
 from shop_app.models.commodity_models import Commodity
+from shop_app.redis.details_redis import details_redis
 from user_app.redis.foot_redis import FootRedisOperation
 from django.contrib.auth.decorators import login_required
 from django.shortcuts import render
 from Emall.loggings import Logging
-import markdown
 
 
 login_required(login_url='consumer/login/')
@@ -24,18 +24,12 @@ def enter_introduction_page(request, pk):
     if request.user.is_authenticated:
         user = request.user
         # 增加足迹
-        is_success = redis.add_foot_commodity_id(user.pk, commodity_id=pk)
+        is_success = redis.record_views(user.pk, [pk])
         if not is_success:
             consumer_logger.error('添加足迹失败')
     goods = Commodity.commodity_.select_related('store').get(pk=pk)
 
-    goods.details = markdown.markdown(goods.details, extensions=[
-        'markdown.extensions.extra',
-        'markdown.extensions.attr_list',
-        'markdown.extensions.smarty',
-        'markdown.extensions.codehilite',  # 语法高亮拓展
-        'markdown.extensions.toc',  # 自动生成目录
-    ], safe_mode=True)  # 修改notes.note_contents内容为html
+    goods.details = details_redis.get_or_render(goods.pk, goods.details)  # 修改为渲染后的html，命中缓存时不再渲染
     price_now = goods.price * goods.discounts
     data = {
         'goods': goods,
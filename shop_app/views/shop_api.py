@@ -6,7 +6,6 @@ from shop_app.redis.shop_favorites_redis import ShopRedisFavoritesOperation
 from django.contrib.auth.decorators import login_required
 from django.utils.decorators import method_decorator
 
-from search_app.serailaizers.shop_search_serializers import CommoditySerializer
 from Emall.loggings import Logging
 from Emall.response_code import response_code
 from shop_app.models.commodity_models import Commodity
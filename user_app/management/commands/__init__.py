@@ -0,0 +1,5 @@
+# -*- coding: utf-8 -*-
+# @Time  : 2020/11/18 下午2:40
+# @Author : 司云中
+# @File : __init__.py
+# @Software: Pycharm
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+# @Time  : 2020/11/18 下午2:40
+# @Author : 司云中
+# @File : migrate_shop_cart.py
+# @Software: Pycharm
+from django.core.management.base import BaseCommand
+
+from user_app.redis.shopcart_redis import ShopCartRedisOperation
+
+
+class Command(BaseCommand):
+    """
+    将旧的购物车结构迁移为每个用户一个hash
+    旧结构：Cart-{user}-store(list) + Cart-{user}-{store}-counts(zset) + Cart-{user}-{store}-price(zset)
+    新结构：Cart-{user}(hash)  store:commodity -> counts|label
+    已存在于新购物车中的商品保留新购物车中的数量
+    迁移的用户加入待写回集合，由flush_shop_carts写回Trolley表，不必等到用户下次修改购物车
+    """
+
+    help = 'Migrate shopping carts from list + zsets to one hash per user'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='只统计，不写入')
+        parser.add_argument('--keep-old', action='store_true', help='迁移后保留旧的键')
+        parser.add_argument('--batch', type=int, default=500, help='每次SCAN的数量')
+
+    def handle(self, *args, **options):
+        operation = ShopCartRedisOperation.choice_redis_db('redis')
+        redis = operation.redis
+        users = commodities = 0
+        for store_key in redis.scan_iter(match=operation.key('Cart', '*', 'store'), count=options['batch']):
+            user_id = store_key.decode().split('-')[1]
+            stores = [int(store) for store in redis.lrange(store_key, 0, -1)]
+            with redis.pipeline(transaction=False) as pipe:
+                for store in stores:
+                    pipe.zrange(operation.key('Cart', user_id, store, 'counts'), 0, -1, withscores=True)
+                counts_list = pipe.execute()
+            mapping = {operation.field(store, int(commodity)): '{}|无'.format(max(int(counts), 1))
+                       for store, items in zip(stores, counts_list) for commodity, counts in items}
+            users += 1
+            commodities += len(mapping)
+            if options['dry_run']:
+                continue
+            old_keys = [store_key] + [operation.key('Cart', user_id, store, suffix)
+                                      for store in stores for suffix in ('counts', 'price')]
+            with redis.pipeline() as pipe:
+                for field, value in mapping.items():
+                    pipe.hsetnx(operation.cart_key(user_id), field, value)
+                if not options['keep_old']:
+                    pipe.delete(*old_keys)
+                pipe.execute()
+            if mapping:  # 待写回集合与购物车不在同一节点，写入购物车之后再标记，见ShopCartRedisOperation.dirty_key
+                operation.mark_dirty(user_id)
+        self.stdout.write(self.style.SUCCESS('migrated {} carts, {} commodities{}'.format(
+            users, commodities, ' (dry run)' if options['dry_run'] else '')))
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+# @Time  : 2020/11/23 下午2:16
+# @Author : 司云中
+# @File : reshard_redis.py
+# @Software: Pycharm
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from redis import ResponseError
+
+from Emall.redis_pool import connection_manager
+from Emall.redis_shard import ShardedRedis, hash_tag
+
+
+class Command(BaseCommand):
+    """
+    把键迁移到哈希环上所属的节点
+    开启分片前所有键都写在LOCATION的第一个节点，开启分片或增减节点后执行一次
+    逐个节点SCAN，不属于该节点的键以DUMP/RESTORE迁移并保留过期时间
+    所属节点上已存在的同名键是分片之后写入的，保留新值，丢弃旧值
+    """
+
+    help = 'Move redis keys to the node that owns them after enabling sharding or changing nodes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('aliases', nargs='*', help='CACHES中的别名，默认为REDIS_SHARDING中的所有别名')
+        parser.add_argument('--dry-run', action='store_true', help='只统计，不迁移')
+        parser.add_argument('--batch', type=int, default=500, help='每次SCAN和迁移的数量')
+
+    def handle(self, *args, **options):
+        aliases = options['aliases'] or [alias for alias in getattr(settings, 'REDIS_SHARDING', {})
+                                         if alias != 'default']
+        for alias in aliases:
+            client = connection_manager.get_client(alias)
+            if not isinstance(client, ShardedRedis):
+                self.stdout.write(self.style.WARNING('{} is not sharded, skipped'.format(alias)))
+                continue
+            moved = kept = 0
+            for node, node_client in client.nodes.items():
+                batch = []
+                for key in node_client.scan_iter(count=options['batch']):
+                    owner = client.ring.get_node(hash_tag(key))
+                    if owner != node:
+                        batch.append((key, owner))
+                    if len(batch) >= options['batch']:
+                        result = self.move(client, node, batch, options['dry_run'])
+                        moved, kept, batch = moved + result[0], kept + result[1], []
+                result = self.move(client, node, batch, options['dry_run'])
+                moved, kept = moved + result[0], kept + result[1]
+            self.stdout.write(self.style.SUCCESS('{}: moved {} keys, kept {} newer keys on owner{}'.format(
+                alias, moved, kept, ' (dry run)' if options['dry_run'] else '')))
+
+    @staticmethod
+    def move(client, node, batch, dry_run=False):
+        """
+        迁移一批键
+        :param batch: [(key, 所属节点), ...]
+        :return: tuple 迁移的数量, 所属节点已存在而丢弃的数量
+        """
+        if dry_run or not batch:
+            return len(batch), 0
+        source = client.nodes[node]
+        with source.pipeline(transaction=False) as pipe:
+            for key, _ in batch:
+                pipe.dump(key)
+                pipe.pttl(key)
+            values = pipe.execute()
+        targets = {}
+        for (key, owner), value, ttl in zip(batch, values[::2], values[1::2]):
+            if value is not None:  # 扫描之后已过期或被删除
+                targets.setdefault(owner, []).append((key, value, max(ttl, 0)))
+        moved = kept = 0
+        for owner, items in targets.items():
+            with client.nodes[owner].pipeline(transaction=False) as pipe:
+                for key, value, ttl in items:
+                    pipe.restore(key, ttl, value)
+                for result in pipe.execute(raise_on_error=False):
+                    if isinstance(result, ResponseError):  # BUSYKEY
+                        kept += 1
+                    else:
+                        moved += 1
+        source.delete(*[key for key, _ in batch])
+        return moved, kept
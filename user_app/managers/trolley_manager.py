@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+# @Time  : 2020/11/19 上午11:05
+# @Author : 司云中
+# @File : trolley_manager.py
+# @Software: Pycharm
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Manager
+
+from shop_app.models.commodity_models import Commodity
+
+
+class TrolleyManager(Manager):
+    """
+    购物车管理类
+    默认生成具备默认QuerySet的Manager的实例
+    """
+
+    def sync_carts(self, carts):
+        """
+        将redis中的购物车批量写回数据库，整批用户只需一次查询和三次批量写
+        :param carts: dict  {user_id: {(store_id, commodity_id): (counts, label)}}
+        :return: tuple  新增数量, 修改数量, 删除数量
+        """
+        commodity_ids = {commodity_id for cart in carts.values() for _, commodity_id in cart}
+        prices = {commodity.pk: commodity.price * commodity.discounts for commodity in
+                  Commodity.commodity_.filter(pk__in=commodity_ids).only('pk', 'price', 'discounts')}
+
+        existing, to_delete = {}, []
+        for row in self.filter(user_id__in=carts.keys()):
+            key = (row.user_id, row.store_id, row.commodity_id)
+            if key in existing:  # 重复的记录
+                to_delete.append(row.pk)
+            else:
+                existing[key] = row
+
+        to_create, to_update = [], []
+        for user_id, cart in carts.items():
+            for (store_id, commodity_id), (counts, label) in cart.items():
+                if commodity_id not in prices:  # 商品已删除
+                    continue
+                price = (prices[commodity_id] * counts).quantize(Decimal('0.01'))
+                row = existing.pop((user_id, store_id, commodity_id), None)
+                if row is None:
+                    to_create.append(self.model(user_id=user_id, store_id=store_id, commodity_id=commodity_id,
+                                                count=counts, label=label, price=price))
+                elif row.count != counts or row.label != label or row.price != price:
+                    row.count, row.label, row.price = counts, label, price
+                    to_update.append(row)
+        to_delete.extend(row.pk for row in existing.values())  # redis中已删除的商品
+
+        with transaction.atomic():
+            self.bulk_create(to_create)
+            self.bulk_update(to_update, ['count', 'label', 'price'])
+            self.filter(pk__in=to_delete).delete()
+        return len(to_create), len(to_update), len(to_delete)
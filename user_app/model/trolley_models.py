@@ -5,10 +5,10 @@
 # @Software: Pycharm
 from user_app.models import User
 from django.db import models
-from django.db.models import Manager
 from django.utils.translation import gettext_lazy as _
 
 from shop_app.models.commodity_models import Commodity
+from user_app.managers.trolley_manager import TrolleyManager
 from user_app.model.seller_models import Store
 
 
@@ -35,7 +35,7 @@ class Trolley(models.Model):
     # 商品类型选择标签
     label = models.TextField(verbose_name=_('标签'))
 
-    trolley_ = Manager()
+    trolley_ = TrolleyManager()
 
     class Meta:
         db_table = 'Trolley'
@@ -6,8 +6,7 @@
 import json
 import time
 
-from django.core import serializers
-
+from shop_app.serializers.commodity_card_serializers import CommodityCardSerializer
 from user_app import signals
 from user_app.models import Collection
 from Emall.base_redis import BaseRedis, manager_redis
@@ -20,111 +19,175 @@ consumer_logger = Logging.logger('consumer_')
 
 
 class RedisFavoritesOperation(BaseRedis):
-    """the operation of Favorites about redis"""
+    """
+    the operation of Favorites about redis
+    每个用户一个zset保存收藏记录的顺序，一个hash保存收藏记录的数据，field为收藏记录pk，value为商品卡片row的JSON
+    读取一页只需一次lua脚本调用，反序列化每条记录只需一次json.loads
+    缓存和数据库返回相同格式的列表：[{'pk': 收藏记录pk, 'commodity': 商品卡片row}]，见CommodityCardSerializer
+    同一用户的zset和hash以用户pk作为哈希标签，分片时落在同一节点
+
+    zset总是缓存收藏夹的一个前缀(最新的若干条)，而不是零散的页：未命中时从第一条查询到请求的页为止，整体替换缓存
+    新增收藏加在最前，删除收藏只移除一条，都保持前缀不变；缓存到收藏夹末尾时额外写入结束标记(member 0, score 0)
+    请求的页全部在前缀内，或前缀已到末尾时命中，前缀较短时不会把未缓存的位置误当作命中
+    """
+
+    CACHE_SECONDS = 30  # 收藏夹缓存时间
+    EMPTY_SECONDS = 6  # 空收藏夹的缓存时间，防止缓存击穿
+    LOCK_SECONDS = 5  # 重建缓存的锁超时时间
+    WAIT_SECONDS = 1  # 未拿到锁的请求等待缓存写入的最长时间
+
+    END_MARK = 0  # 结束标记，收藏记录的pk从1开始
+
+    # KEYS[1]:收藏记录zset  KEYS[2]:收藏数据hash  KEYS[3]:上次重建耗时
+    # ARGV[1]:起始位置  ARGV[2]:结束位置
+    # 返回 {收藏记录pk列表, 数据列表, zset剩余毫秒数, 上次重建耗时}
+    # 该页超出前缀时返回score最低的成员，为结束标记说明该页超出收藏夹的范围
+    PAGE_SCRIPT = """
+    local ids = redis.call('ZREVRANGE', KEYS[1], ARGV[1], ARGV[2])
+    local ttl = redis.call('PTTL', KEYS[1])
+    local delta = redis.call('GET', KEYS[3])
+    if #ids == 0 then
+        local last = redis.call('ZRANGE', KEYS[1], 0, 0)
+        if last[1] == '0' then
+            return {last, {}, ttl, delta}
+        end
+        return {{}, {}, ttl, delta}
+    end
+    return {ids, redis.call('HMGET', KEYS[2], unpack(ids)), ttl, delta}
+    """
 
     def __init__(self, db, redis):
         self.connect()
         super().__init__(db, redis)
+        self.page_script = self.redis.register_script(self.PAGE_SCRIPT)
 
     def zset_key_store(self, user_pk):
         """收藏夹zset的键"""
-        return self.key('favorites', user_pk, 'store')
+        return self.key('favorites', self.tag(user_pk), 'store')
 
     def zset_key_commodity(self, user_pk):
-        return self.key('favorites', user_pk, 'commodity')
+        return self.key('favorites', self.tag(user_pk), 'commodity')
+
+    def data_key_store(self, user_pk):
+        """收藏夹中店铺数据hash的键"""
+        return self.key('favorites', self.tag(user_pk), 'store', 'data')
 
-    def hash_key_store(self, user_pk, collection_pk):
-        """收藏夹中店铺的hash键"""
-        return self.key('favorites', user_pk, 'store', collection_pk)
+    def data_key_commodity(self, user_pk):
+        """收藏夹中商品卡片row hash的键"""
+        return self.key('favorites', self.tag(user_pk), 'commodity', 'cards')
 
-    def hash_key_commodity(self, user_pk, collection_pk):
-        """收藏夹中商品的hash键"""
-        return self.key('favorites', user_pk, 'commodity', collection_pk)
+    def delta_key_commodity(self, user_pk):
+        """上次重建收藏夹缓存的耗时(毫秒)"""
+        return self.key('favorites', self.tag(user_pk), 'commodity', 'delta')
 
     def connect(self):
         signals.add_favorites.connect(self.sync_favorites_add_callback, sender=Collection)
         signals.delete_favorites.connect(self.sync_favorites_delete_callback, sender=Collection)
 
+    def read_page(self, user_pk, page, page_size):
+        """
+        读取一页缓存
+        :return: tuple 是否命中, 结果('null'表示空收藏夹), 剩余毫秒数, 上次重建耗时
+        """
+        keys = [self.zset_key_commodity(user_pk), self.data_key_commodity(user_pk), self.delta_key_commodity(user_pk)]
+        ids, rows, ttl, delta = self.page_script(keys=keys, args=[(page - 1) * page_size, page * page_size - 1])
+        delta = int(delta or 0)
+        end = str(self.END_MARK).encode()
+        if end in ids:  # 前缀已到收藏夹末尾，结束标记之前的记录即为该页的全部记录
+            index = ids.index(end)
+            ids, rows = ids[:index], rows[:index]
+        elif len(ids) < page_size:  # 该页超出已缓存的前缀
+            return False, None, ttl, delta
+        if not all(rows):
+            return False, None, ttl, delta
+        if not ids:
+            return True, 'null' if page == 1 else [], ttl, delta
+        return True, self.deserializer_commodity_data(ids, rows), ttl, delta
+
     def get_resultSet(self, user, page, page_size, **kwargs):
         """
         考虑缓存击穿：即使空结果集也放到缓存中去
-        redis使用有序集合+hash表+List实现数据存储和获取
+        考虑缓存雪崩：同一用户同一时刻只有一个请求回源，其余请求等待回源结果或继续使用旧缓存
+        缓存临近过期时按XFetch概率由一个请求提前重建
+        redis使用有序集合+hash表实现数据存储和获取
         确保有序，使用有序集合，在redis层面提升排序性能
-        :return: list（读取redis)， 查询集（读取mysql）
+        :return: list 收藏记录，'null'表示空收藏夹
+        """
+        user_pk = user.pk
+        hit, result, ttl, delta = self.read_page(user_pk, page, page_size)
+        if hit and not self.xfetch(ttl, delta):
+            return result
+        with self.single_flight(self.zset_key_commodity(user_pk), self.LOCK_SECONDS) as acquired:
+            if acquired:
+                return self.refill_page(user, page, page_size)
+        if hit:  # 其他请求正在提前重建，继续使用旧缓存
+            return result
+        deadline = time.time() + self.WAIT_SECONDS
+        while time.time() < deadline:  # 等待持有锁的请求写入缓存
+            time.sleep(self.FLIGHT_WAIT_INTERVAL)
+            hit, result, _, _ = self.read_page(user_pk, page, page_size)
+            if hit:
+                return result
+        return self.query_page(user, page, page_size)  # 等待超时，直接查询数据库且不写缓存
+
+    @staticmethod
+    def query(user, start, stop):
+        """
+        按收藏时间倒序查询[start, stop)范围内收藏的商品，只加载商品卡片的字段
+        :return: list  [{'pk': 收藏记录pk, 'datetime': 收藏时间, 'commodity': 商品卡片row}]
+        """
+        queryset = CommodityCardSerializer.only(Collection.collection_.filter(
+            user=user, commodity__isnull=False).order_by('-datetime'), prefix='commodity__', fields=('datetime',))
+        return [{'pk': collection.pk, 'datetime': collection.datetime,
+                 'commodity': CommodityCardSerializer.row(collection.commodity)}
+                for collection in queryset[start:stop]]
+
+    def query_page(self, user, page, page_size):
+        """查询一页收藏的商品，不写缓存"""
+        items = self.query(user, (page - 1) * page_size, page * page_size)
+        for item in items:
+            item.pop('datetime')
+        return items
+
+    def refill_page(self, user, page, page_size):
+        """
+        查询从第一条到请求的页为止的收藏记录，整体替换缓存，返回该页的收藏记录列表
+        查询到的记录不足时说明已到收藏夹末尾，写入结束标记，空收藏夹只有结束标记
         """
         with manager_redis(self.db) as redis:
             user_pk = user.pk
             zset_key = self.zset_key_commodity(user_pk)
-            collection_dict = {int(key.decode()): value for key, value in
-                               redis.zrevrange(zset_key, (page - 1) * page_size, page * page_size, withscores=True)}
-
-            if 0 in collection_dict:  # 如果数据库未命中，缓存中的0代表空数据
-                return 'null'
-            if collection_dict:  # 缓存命中,寻找对应的商品hash表
-                list_resultSet = []
-
-                for key in collection_dict:
-                    hash_key = self.hash_key_commodity(user_pk, key)
-                    # 会不会内存泄漏?
-                    offset, hresult = redis.hscan(hash_key)  # hscan扫描获取数据
-                    while offset != 0:
-                        hresult.update(redis.hscan(hash_key, cursor=offset))  # 从上一次的offset中读取,防止hscan一次性没读完
-                    list_resultSet.append(hresult)
-                # list扔到任务队列中去将字典中的bytes-->str,解析，转换成我需要的数据格式
-                # list_result_format = format_data.apply_async(args=(list_resultSet,))  # 异步任务反而变慢了，不接受byte数据
-                list_result_format = self.deserializer_commodity_data(list_resultSet)  # 反序列化
-                return list_result_format
-
-            # 未命中缓存
-            queryset = Collection.collection_.select_related('commodity').filter(user=user)[(page - 1) * page_size : page * page_size]
-
-            pipe_two = redis.pipeline()  # 建立管道
-
-            if queryset:
-
-                commodity_list = [query.commodity for query in queryset]  # 商品查询集
-                serializer_commodity = serializers.serialize('python', commodity_list)  # 对商品集序列化
-                for serializer, query in zip(serializer_commodity, queryset):  # 将同迭代次数的可迭代元素打包程元祖
-                    commodity_pk = serializer.get('pk')  # 获取每个商品的pk
-                    commodity_fields = serializer.get('fields')  # 获取每个商品的fields
-                    commodity_fields.update({'pk': commodity_pk})  # 将pk添加进fields字典中
-                    collection_pk = query.pk  # 收藏记录的pk
-                    pipe_two.zadd(zset_key, {collection_pk: time.time()})  # 添加到有序集合中
-                    pipe_two.expire(zset_key, 30)  # 设置15sTTL
-                    hash_value_commodity = self.hash_key_commodity(user_pk, collection_pk)
-                    pipe_two.hmset(hash_value_commodity, self.serializer_commodity_data(commodity_fields))  # 将商品信息添加到hash表中
-                    pipe_two.expire(hash_value_commodity, 30)
-            else:
-                pipe_two.zadd(zset_key, {0:0})   # 防止缓存击穿
-                pipe_two.expire(zset_key,6)      # TTL为6
+            data_key = self.data_key_commodity(user_pk)
+            delta_key = self.delta_key_commodity(user_pk)
+            start = time.perf_counter()
+            items = self.query(user, 0, page * page_size)
+            complete = len(items) < page * page_size
+            seconds = self.CACHE_SECONDS if items else self.EMPTY_SECONDS  # 空收藏夹也缓存，防止缓存击穿
+            pipe_two = redis.pipeline()  # 建立管道，同一用户的键在同一节点，事务中整体替换
+
+            pipe_two.delete(zset_key, data_key)
+            if items:
+                pipe_two.zadd(zset_key, {item['pk']: item.pop('datetime').timestamp() for item in items})
+                pipe_two.hset(data_key, mapping={item['pk']: self.serializer_commodity_data(item['commodity'])
+                                                 for item in items})
+                pipe_two.expire(data_key, seconds)
+            if complete:  # 空收藏夹一定是complete
+                pipe_two.zadd(zset_key, {self.END_MARK: 0})
+            pipe_two.expire(zset_key, seconds)
+            pipe_two.set(delta_key, int((time.perf_counter() - start) * 1000), ex=seconds)
             pipe_two.execute()
-            return queryset  # 返回商品查询集
-
-
-    def serializer_commodity_data(self, data):
-        """
-        序列化数据
-        将model序列化后的数据格式化成合格的json格式，以便添加到redis中的hash
-        """
-        result = json.loads(json.dumps(data, cls=JsonCustomEncoder))
-        for key, value in result.items():
-            if result[key] is None:  # 因为redis不接受null，必须化成0/1, 商品上架状态
-                result[key] = 'null'
-            elif result[key] == True:  # 因为redis不接受bool，必须化成0/1, 商品上架状态
-                result[key] = 1
-            elif result[key] == False:
-                result[key] = 0
-        return result
+            items = items[(page - 1) * page_size:]
+            return items if items or page > 1 else 'null'
 
     @staticmethod
-    def deserializer_commodity_data(data):
-        """反序列化"""
-        if isinstance(data, list):
-            data = [{key.decode(): value.decode() for key, value in orderdict.items() if key.decode() not in ['store','shopper','onshelve_time', 'unshelve_time']} for
-                    orderdict in data]
-        # TODO 将redis中的数据序列化为分页器格式
+    def serializer_commodity_data(row):
+        """商品卡片row -> hash中的JSON字符串"""
+        return json.dumps(row, cls=JsonCustomEncoder)
 
-        return data
+    @staticmethod
+    def deserializer_commodity_data(ids, data):
+        """反序列化，每条记录一次json.loads"""
+        return [{'pk': int(pk), 'commodity': json.loads(value)} for pk, value in zip(ids, data)]
 
     # @receiver(add_favorites, sender=Collection)
     def sync_favorites_add_callback(self, sender, instance, user, queryset, **kwargs):
@@ -138,21 +201,20 @@ class RedisFavoritesOperation(BaseRedis):
         :param kwargs: 额外参数
         :return:  同步是否成功, bool
         """
+        if instance.commodity_id is None:  # 收藏的是店铺，不在商品收藏夹中
+            return
         with manager_redis(self.db) as redis:
             user_pk = user.pk
             zset_key = self.zset_key_commodity(user_pk)
-            serialized_commodity = serializers.serialize('python', queryset)  # 序列化商品
+            data_key = self.data_key_commodity(user_pk)
+            rows = CommodityCardSerializer.rows(queryset)  # 商品卡片
             pipe = redis.pipeline()  # 开启管道
-            if serialized_commodity:
+            if rows:
                 collection_pk = instance.pk  # collection的pk
-                fields = serialized_commodity[0].get('fields')
-                fields.update({'pk': serialized_commodity[0].get('pk')})
-                timestamp = time.time()
-                pipe.zadd(zset_key, {collection_pk: timestamp})  # 向有序集合中添加收藏夹元素
-                hash_key_store = self.hash_key_commodity(user_pk, collection_pk)
-                pipe.hmset(hash_key_store, self.serializer_commodity_data(fields))  # 深度格式成JSON数据
-                pipe.expire(zset_key, 30)  # 重置zset过期时间30s
-                pipe.expire(hash_key_store, 30)  # 重置hash过期时间时间30s
+                pipe.zadd(zset_key, {collection_pk: time.time()})  # 最新的收藏加在最前，缓存仍是收藏夹的前缀
+                pipe.hset(data_key, collection_pk, self.serializer_commodity_data(rows[0]))  # 一条记录一个JSON
+                pipe.expire(zset_key, self.CACHE_SECONDS)  # 重置zset过期时间30s
+                pipe.expire(data_key, self.CACHE_SECONDS)  # 重置hash过期时间时间30s
             pipe.execute()
 
     # 动态跟着回调函数注册
@@ -165,17 +227,13 @@ class RedisFavoritesOperation(BaseRedis):
         with manager_redis(self.db) as redis:
             user_pk = user.pk
             zset_key = self.zset_key_commodity(user_pk)
+            data_key = self.data_key_commodity(user_pk)
             pipe = redis.pipeline()
             if is_all:
-                collection_list = (value.decode() for value in redis.zrange(zset_key, 0, -1))  # 返回所有的商品id列表，用于删除hash表
-                pipe.delete(zset_key)  # 删除zset中目标收藏的商品的元素
-                for pk in collection_list:
-                    hash_temp_key = self.hash_key_commodity(user_pk, pk)
-                    pipe.delete(hash_temp_key)
+                pipe.delete(zset_key, data_key, self.delta_key_commodity(user_pk))
             else:
-                hash_key = self.hash_key_commodity(user_pk, collection_pk)
-                pipe.zrem(zset_key, collection_pk)
-                pipe.delete(hash_key)  # 删除某一个hash表
+                pipe.zrem(zset_key, collection_pk)  # 删除zset中目标收藏的商品的元素，其余记录仍是收藏夹的前缀
+                pipe.hdel(data_key, collection_pk)  # 删除hash中对应的数据
             pipe.execute()
 
 
@@ -5,6 +5,7 @@
 # @Software: PyCharm
 import datetime
 import time
+from collections import OrderedDict
 
 from Emall.base_redis import BaseRedis, manager_redis
 from Emall.loggings import Logging
@@ -15,10 +16,43 @@ consumer_logger = Logging.logger('consumer_')
 
 
 class FootRedisOperation(BaseRedis):
-    """the operation of historical footprints about redis"""
+    """
+    the operation of historical footprints about redis
+    每个用户一个zset：foot-{user_id}，member为商品id，score为浏览时的毫秒时间戳
+    写入和截断由lua脚本一次完成，每个用户最多保留MAX_FOOT条
+    """
+
+    MAX_FOOT = 100  # 每个用户最多保留的足迹数量
+    LEGACY_SCORE = 10 ** 15  # 大于该值的是旧格式的分数：日期拼接秒级时间戳
+
+    DATA_SECONDS = 60  # 足迹商品数据的缓存时间
+    EMPTY_SECONDS = 6  # 空足迹的缓存时间
+
+    # KEYS[1]:足迹zset
+    # ARGV[1]:最多保留的数量  ARGV[2]:当前毫秒时间戳  ARGV[3]:旧格式分数的下限  ARGV[4...]:商品id，越靠前越新
+    # 返回写入的数量
+    RECORD_SCRIPT = """
+    local top = redis.call('ZRANGE', KEYS[1], -1, -1, 'WITHSCORES')
+    if top[2] and tonumber(top[2]) > tonumber(ARGV[3]) then
+        local entries = redis.call('ZRANGE', KEYS[1], 0, -1, 'WITHSCORES')
+        for i = 1, #entries, 2 do
+            redis.call('ZADD', KEYS[1], (tonumber(entries[i + 1]) % 1e10) * 1000, entries[i])
+        end
+    end
+    local now = tonumber(ARGV[2])
+    for i = 4, #ARGV do
+        redis.call('ZADD', KEYS[1], now - (i - 4), ARGV[i])
+    end
+    local overflow = redis.call('ZCARD', KEYS[1]) - tonumber(ARGV[1])
+    if overflow > 0 then
+        redis.call('ZREMRANGEBYRANK', KEYS[1], 0, overflow - 1)
+    end
+    return #ARGV - 3
+    """
 
     def __init__(self, db, redis):
         super().__init__(db, redis)
+        self.record_script = self.redis.register_script(self.RECORD_SCRIPT)
 
     '''
     def get_time_scope(self, limit, page):
@@ -41,30 +75,75 @@ class FootRedisOperation(BaseRedis):
 
     @property
     def score(self):
-        """设置足迹有序集合中对应键的分数值"""
-        return int('%s%d' % (''.join(datetime.datetime.now().strftime('%Y-%m-%d').split('-')),int(time.time())))
+        """设置足迹有序集合中对应键的分数值，毫秒时间戳"""
+        return int(time.time() * 1000)
 
+    @classmethod
+    def normalize_score(cls, score):
+        """旧格式的分数(日期拼接秒级时间戳)转换为毫秒时间戳，写入新足迹时由lua脚本永久转换"""
+        return int(score % 10 ** 10 * 1000) if score > cls.LEGACY_SCORE else int(score)
 
+    def data_key(self, user_id):
+        """足迹商品卡片row缓存的键"""
+        return self.key('foot', user_id, 'cards')
 
-    def get_foot_commodity_id_and_page(self, user_id, **kwargs):
+    def get_foot_commodity_dict(self, user_id):
         """
-        obtain limit list of commodity that stored in redis(use zset有序集合) to hit database
+        获取用户的全部足迹，按浏览时间倒序
         :param user_id:用户id
-        :param kwargs:request.data的Querydict实例
-        :return:Dict
+        :return:Dict  {commodity_pk: score}
         """
         with manager_redis(self.db) as redis:
             try:
                 key = self.key('foot', user_id)
-                page = kwargs.get('page', 1)
-                count = kwargs.get('page_size')
                 # zrevrange 返回 [(name,score),...]
-                commodity_dict = {int(name): score for name, score in
-                                  redis.zrevrange(key, (page - 1) * count, page * count, withscores=True)}
-                return commodity_dict
+                return {int(name): self.normalize_score(score)
+                        for name, score in redis.zrevrange(key, 0, -1, withscores=True)}
             except Exception as e:
                 consumer_logger.error(e)
-                return None
+                return {}
+
+    def get_foot_data(self, user_id, compute):
+        """
+        获取足迹商品的卡片row，同一用户同一时刻只有一个请求回源
+        足迹变化时缓存随之删除
+        :param compute: 回源函数，返回商品卡片row列表，见CommodityCardSerializer
+        :return: list
+        """
+        return self.get_or_compute(self.data_key(user_id), compute, ttl=self.DATA_SECONDS, empty_ttl=self.EMPTY_SECONDS)
+
+    @staticmethod
+    def group_by_day(items, field='timestamp'):
+        """
+        按浏览日期分组
+        :param items: 按浏览时间倒序的足迹，每一项包含毫秒时间戳
+        :return: OrderedDict  {'2020-11-23': [item, ...]}
+        """
+        days = OrderedDict()
+        for item in items:
+            day = datetime.datetime.fromtimestamp(item[field] / 1000).strftime('%Y-%m-%d')
+            days.setdefault(day, []).append(item)
+        return days
+
+    def record_views(self, user_id, commodity_ids):
+        """
+        批量记录浏览足迹，一次往返完成写入和截断，用于商品详情页和搜索结果
+        :param user_id:用户id
+        :param commodity_ids:商品id列表，越靠前越新
+        :return:boolean
+        """
+        if not commodity_ids:
+            return True
+        try:
+            args = [self.MAX_FOOT, self.score, self.LEGACY_SCORE] + list(commodity_ids)
+            with self.redis.pipeline(transaction=False) as pipe:
+                self.record_script(keys=[self.key('foot', user_id)], args=args, client=pipe)
+                pipe.delete(self.data_key(user_id))  # 足迹变化，商品数据缓存失效
+                pipe.execute()
+            return True
+        except Exception as e:
+            consumer_logger.error(e)
+            return False
 
     def add_foot_commodity_id(self, user_id, validated_data):
         """
@@ -74,22 +153,7 @@ class FootRedisOperation(BaseRedis):
         :return:boolean
         """
         # add_foot.apply_async(args=(pickle.dumps(self), user_id, validated_data))  # can't pickle _thread.lock objects
-        with manager_redis(self.db) as redis:
-            try:
-                key = self.key('foot', user_id)
-                timestamp = self.score  # 毫秒级别的时间戳
-                commodity_id = validated_data['pk']
-                # pipe = self.redis.pipeline()  # 添加管道，减少客户端和服务端之间的TCP包传输次数
-                redis.zadd(key, {commodity_id: timestamp})  # 分别表示用户id（加密），当前日期+时间戳（分数值），商品id
-                # 每个用户最多缓存100条历史记录
-                if redis.zcard(key) >= 100:  # 集合中key为键的数量
-                    redis.zremrangebyrank(key, 0, 0)  # 移除时间最早的那条记录
-                # pipe.execute()
-                return True
-            except Exception as e:
-                consumer_logger.error(e)
-                return False
-
+        return self.record_views(user_id, [validated_data['pk']])
 
     def delete_foot_commodity_id(self, user_id, **kwargs):
         """
@@ -102,10 +166,11 @@ class FootRedisOperation(BaseRedis):
             try:
                 key = self.key('foot', user_id)
                 if kwargs.get('is_all', None):  # 是否删除所有足迹
+                    delete_counts = redis.delete(key)  # 删除全部的记录
+                else:
                     commodity_id = kwargs.get('commodity_id')
                     delete_counts = redis.zrem(key, commodity_id)  # 移除zset中某商品号元素
-                else:
-                    delete_counts = redis.delete(key)  # 删除全部的记录
+                redis.delete(self.data_key(user_id))  # 足迹变化，商品数据缓存失效
                 return True if delete_counts else False
             except Exception as e:
                 consumer_logger.error(e)
@@ -5,8 +5,9 @@
 # @Software: PyCharm
 import math
 
-from shop_app.models.commodity_models import Commodity
-from Emall.base_redis import BaseRedis, manager_redis
+from shop_app.redis.commodity_redis import commodity_redis
+from user_app.model.trolley_models import Trolley
+from Emall.base_redis import BaseRedis
 from Emall.loggings import Logging
 
 common_logger = Logging.logger('django')
@@ -15,9 +16,183 @@ consumer_logger = Logging.logger('consumer_')
 
 
 class ShopCartRedisOperation(BaseRedis):
+    """
+    购物车
+    每个用户一个hash：Cart-{user_id}，field为 store_id:commodity_id，value为 counts|label，用户id作为哈希标签
+    价格不存入redis，读取购物车时按商品当前价格计算，避免价格快照过期
+    加减数量由lua脚本在服务端原子完成，不再需要lrange扫描店铺列表
+
+    redis是购物车的权威数据，Trolley表通过write-behind同步：
+    每次修改把用户加入脏集合Cart-dirty，由celery定时批量写回数据库，同一用户多次修改只写一次
+    用户首次访问购物车时从Trolley表加载到redis，并写入标记Cart-{user_id}-loaded
+    """
+
+    MAX_COUNTS = 9999  # 单个商品最大数量
+
+    # KEYS[1]:购物车hash
+    # ARGV[1]:field  ARGV[2]:增减数量  ARGV[3]:标签，空则保留原标签  ARGV[4]:不存在时是否新增  ARGV[5]:最大数量
+    # 返回修改后的数量，商品不在购物车中且不允许新增时返回-1
+    CHANGE_SCRIPT = """
+    local value = redis.call('HGET', KEYS[1], ARGV[1])
+    local counts, label = 0, ARGV[3]
+    if value then
+        local sep = string.find(value, '|', 1, true)
+        counts = tonumber(string.sub(value, 1, sep - 1))
+        if label == '' then
+            label = string.sub(value, sep + 1)
+        end
+    elseif ARGV[4] == '0' then
+        return -1
+    end
+    counts = math.min(math.max(counts + tonumber(ARGV[2]), 1), tonumber(ARGV[5]))
+    redis.call('HSET', KEYS[1], ARGV[1], counts .. '|' .. label)
+    return counts
+    """
+
+    # KEYS[1]:购物车hash  KEYS[2]:已加载标记
+    # ARGV:field, value, field, value...
+    # 检查标记和写入在同一个脚本中完成，已被其他请求加载(之后可能已删除商品)的购物车不再写入数据库中的旧数据
+    LOAD_SCRIPT = """
+    if redis.call('EXISTS', KEYS[2]) == 1 then
+        return 0
+    end
+    for i = 1, #ARGV, 2 do
+        redis.call('HSETNX', KEYS[1], ARGV[i], ARGV[i + 1])
+    end
+    redis.call('SET', KEYS[2], 1)
+    return 1
+    """
 
     def __init__(self, db, redis):
         super().__init__(db, redis)
+        self.change_script = self.redis.register_script(self.CHANGE_SCRIPT)
+        self.load_script = self.redis.register_script(self.LOAD_SCRIPT)
+
+    def cart_key(self, user_id):
+        """用户购物车hash的键"""
+        return self.key('Cart', self.tag(user_id))
+
+    def loaded_key(self, user_id):
+        """购物车已从数据库加载的标记"""
+        return self.key('Cart', self.tag(user_id), 'loaded')
+
+    @property
+    def dirty_key(self):
+        """
+        待写回数据库的用户集合，与购物车不在同一节点，无法与购物车的修改放在同一个pipeline或脚本中
+        总是在购物车修改完成之后再标记：标记之前被取出写回的用户，写回时读到的可能是修改前的购物车，
+        修改后的标记会让其再写回一次；先标记则写回可能发生在修改之前，修改丢失
+        """
+        return self.key('Cart', 'dirty')
+
+    def ensure_loaded(self, user_id):
+        """购物车尚未加载时从Trolley表加载"""
+        if not self.redis.exists(self.loaded_key(user_id)):
+            self.load_from_db(user_id)
+
+    def load_from_db(self, user_id):
+        """
+        从Trolley表加载购物车
+        由lua脚本在未加载时才写入：并发的请求中只有一个写入，先完成加载的请求删除的商品不会被后写入的旧数据恢复
+        使用HSETNX，加载期间发生的修改不会被数据库中的旧数据覆盖
+        :return: bool 本次是否写入
+        """
+        rows = Trolley.trolley_.filter(user_id=user_id).values_list('store_id', 'commodity_id', 'count', 'label')
+        args = []
+        for store_id, commodity_id, counts, label in rows:
+            args.extend((self.field(store_id, commodity_id), '{}|{}'.format(counts, label or '无')))
+        return bool(self.load_script(keys=[self.cart_key(user_id), self.loaded_key(user_id)], args=args))
+
+    def pop_dirty_users(self, count=500):
+        """取出一批待写回数据库的用户"""
+        return [int(user_id) for user_id in self.redis.spop(self.dirty_key, count)]
+
+    def mark_dirty(self, *user_ids):
+        """标记为待写回，购物车修改完成后以及写回失败时使用"""
+        if user_ids:
+            self.redis.sadd(self.dirty_key, *user_ids)
+
+    def get_carts(self, user_ids):
+        """
+        批量获取多个用户的购物车，一次pipeline
+        :return: dict  {user_id: {(store_id, commodity_id): (counts, label)}}
+        """
+        with self.redis.pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                pipe.hgetall(self.cart_key(user_id))
+            carts = pipe.execute()
+        return {user_id: {self.parse_field(field): self.parse_value(value) for field, value in cart.items()}
+                for user_id, cart in zip(user_ids, carts)}
+
+    @staticmethod
+    def field(store_id, commodity_id):
+        """购物车hash的field"""
+        return '{}:{}'.format(store_id, commodity_id)
+
+    @staticmethod
+    def parse_field(field):
+        """field -> (store_id, commodity_id)"""
+        store_id, commodity_id = field.decode().split(':')
+        return int(store_id), int(commodity_id)
+
+    @staticmethod
+    def parse_value(value):
+        """value -> (counts, label)"""
+        counts, label = value.decode().split('|', 1)
+        return int(counts), label
+
+    def change_counts(self, user_id, store_id, commodity_id, delta, label='', create=False):
+        """
+        原子地增减购物车中商品的数量，数量不小于1，不超过MAX_COUNTS
+        :param delta: 增减数量
+        :param label: 标签，空则保留原标签
+        :param create: 商品不在购物车中时是否新增
+        :return: int 修改后的数量，-1表示商品不在购物车中
+        """
+        self.ensure_loaded(user_id)
+        args = [self.field(store_id, commodity_id), delta, label or '', int(create), self.MAX_COUNTS]
+        counts = int(self.change_script(keys=[self.cart_key(user_id)], args=args))
+        if counts != -1:
+            self.mark_dirty(user_id)
+        return counts
+
+    def add_commodity(self, user_id, store_id, commodity_id, counts=1, label=''):
+        """加入购物车，已存在则累加数量"""
+        return self.change_counts(user_id, store_id, commodity_id, counts, label or '无', create=True)
+
+    def get_cart(self, user_id):
+        """
+        获取整个购物车，一次HGETALL
+        :return: dict  {(store_id, commodity_id): (counts, label)}
+        """
+        self.ensure_loaded(user_id)
+        return {self.parse_field(field): self.parse_value(value)
+                for field, value in self.redis.hgetall(self.cart_key(user_id)).items()}
+
+    def delete_commodities(self, user_id, commodity_ids):
+        """
+        从购物车中删除商品
+        :param commodity_ids: 商品pk列表
+        :return: int 删除的数量
+        """
+        commodity_ids = set(commodity_ids)
+        fields = [self.field(store_id, commodity_id) for store_id, commodity_id in self.get_cart(user_id)
+                  if commodity_id in commodity_ids]
+        if not fields:
+            return 0
+        deleted = self.redis.hdel(self.cart_key(user_id), *fields)
+        if deleted:
+            self.mark_dirty(user_id)
+        return deleted
+
+    @staticmethod
+    def get_prices(commodity_ids):
+        """
+        从商品缓存获取商品当前的折后单价
+        :return: dict  {commodity_id: price}，已删除的商品不在其中
+        """
+        commodities = commodity_redis.get_many(commodity_ids)
+        return {pk: commodity['price'] * commodity['discounts'] for pk, commodity in commodities.items()}
 
     def get_shop_cart_id_and_page(self, user_id, **data):
         """
@@ -25,112 +200,67 @@ class ShopCartRedisOperation(BaseRedis):
         and the goods stored in this shopping cart under these stores
         从redis中取出该用户购物车下的所有店铺，以及这些店铺下的存入的购物车商品
 
-        list + zset结构
+        hash结构，店铺按id倒序分页
         :param user_id:用户id
         :param data:HttpRequest.GET数据
         :return: dict  key:include(store id),value: include(commodity list)
         """
-        with manager_redis(self.db) as redis:
-            store_and_commodity = {}  # 商铺和商品映射
-            commodity_and_counts = {}  # 商品和其对应的数量之间的映射
-            commodity_and_price = {}  # 商品和其对应的数量乘积的总价格的映射
-            try:
-                limit = 3 if 'limit' not in data else int(data.get('page')[0])
-                page = int(data.get('page')[0])
-                start = (page - 1) * limit
-                end = page * limit
-                first_key = self.key('Cart', user_id, 'store')  # 用于存放用户购物车内商品所属的店铺，键
-                store_counts = redis.llen(first_key)  # 购物车所含有的店铺总数，O(1)
-                store_value_decode = [int(i.decode()) for i in redis.lrange(first_key, start, end)]  # 商铺id列表解码,O(N)
-
-                for store in store_value_decode:
-                    commodity_id = []  # 该用户购物车下的每个商铺下的商品id
-                    second_key = self.key('Cart', user_id, store, 'counts')  # 用于存放用户购物车内每个商铺有关商品数量对应的商品id，键
-                    third_key = self.key('Cart', user_id, store, 'price')  # 用于存放用户购物车内每个商铺有关商品总价格对应的商品id，键
-                    # 取出购物车中每个商铺中对应全部的商品id,进行解码
-                    # 时间复杂度O(log(n)+m),分数为float型，需转, m为成员数量
-
-                    # TODO:重构添加    withscore=True,用pipe减小网络延迟
-                    counts_list = [int(value.decode()) for value in redis.zrevrange(second_key, 0, -1)]
-                    price_list = [int(value.decode()) for value in redis.zrevrange(third_key, 0, -1)]
-                    for value in counts_list:
-                        commodity_and_counts[value] = float(redis.zscore(second_key, value))
-
-                    for value in price_list:
-                        commodity_id.append(value)
-                        commodity_and_price[value] = float(redis.zscore(third_key, value))
-
-                    store_and_commodity.setdefault(store, commodity_id)
-                common_logger.info(store_and_commodity)
-
-                page = math.ceil(store_counts / limit)
-                return store_and_commodity, commodity_and_price, commodity_and_counts, page
-            except Exception as e:
-                consumer_logger.error(e)
-                return None, None, 0
+        store_and_commodity = {}  # 商铺和商品映射
+        commodity_and_counts = {}  # 商品和其对应的数量之间的映射
+        commodity_and_price = {}  # 商品和其对应的数量乘积的总价格的映射
+        try:
+            limit = 3 if 'limit' not in data else int(data.get('limit')[0])
+            page = int(data.get('page')[0])
+            cart = self.get_cart(user_id)
+            stores = sorted({store_id for store_id, _ in cart}, reverse=True)
+            page_stores = set(stores[(page - 1) * limit: page * limit])
+            page_items = {key: value for key, value in cart.items() if key[0] in page_stores}
+            prices = self.get_prices([commodity_id for _, commodity_id in page_items])  # 读取时计算价格
+            for (store_id, commodity_id), (counts, _) in page_items.items():
+                if commodity_id not in prices:  # 商品已删除
+                    continue
+                store_and_commodity.setdefault(store_id, []).append(commodity_id)
+                commodity_and_counts[commodity_id] = counts
+                commodity_and_price[commodity_id] = float(prices[commodity_id] * counts)
+            return store_and_commodity, commodity_and_price, commodity_and_counts, math.ceil(len(stores) / limit)
+        except Exception as e:
+            consumer_logger.error(e)
+            return None, None, None, 0
 
     def delete_one_good(self, user_id, **kwargs):
         """
         delete goods based on commodity_id and store_id from redis
         :param user_id:
-        :param kwargs: 额外参数，包含store_id，good_id，counts
+        :param kwargs: 额外参数，包含store_id，good_id
         :return:bool
         """
-        with manager_redis(self.db) as redis:
-            if 'store_id' not in kwargs or 'good_id' not in kwargs:
-                return False
-            else:
-                try:
-                    store_id = int(kwargs['store_id'])
-                    first_key = self.key('Cart', user_id, 'store')
-                    store_list = [int(i.decode()) for i in redis.lrange(first_key, 0, -1)]  # O(n)
-                    if store_id not in store_list:  # 如果该用户名下没有该商铺，则返回删除失败
-                        return False
-                    else:
-                        good_id = int(kwargs['good_id'])
-                        second_key = self.key('Cart', user_id, store_id, 'counts')
-                        third_key = self.key('Cart', user_id, store_id, 'price')
-                        is_success = redis.zrem(second_key, good_id) and redis.zrem(third_key, good_id)  # O(1)
-                        return True if is_success else False
-                except Exception as e:
-                    consumer_logger.error(e)
-                    return False
+        if 'store_id' not in kwargs or 'good_id' not in kwargs:
+            return False
+        try:
+            self.ensure_loaded(user_id)
+            deleted = self.redis.hdel(self.cart_key(user_id),
+                                      self.field(int(kwargs['store_id']), int(kwargs['good_id'])))  # O(1)
+            if deleted:
+                self.mark_dirty(user_id)
+            return bool(deleted)
+        except Exception as e:
+            consumer_logger.error(e)
+            return False
 
     def edit_one_good(self, user_id, **kwargs):
         """
-        edit the information of goods which stored in redis based on commodity_id and store_id and counts
+        edit the counts of goods which stored in redis based on commodity_id and store_id
         :param user_id:
         :param kwargs: 额外参数，包含store_id，good_id，way(add or minus)
         :return:bool
         """
-        with manager_redis(self.db) as redis:
-            if 'store_id' not in kwargs or 'good_id' not in kwargs or 'way' not in kwargs:
-                return False
-            try:
-                store_id = int(kwargs['store_id'])
-                first_key = self.key('Cart', user_id, 'store')
-                store_list = [int(i.decode()) for i in redis.lrange(first_key, 0, -1)]  # O(n)
-                if store_id not in store_list:  # 如果该用户名下没有该商铺，则返回删除失败
-                    return False
-                else:
-                    good_id = int(kwargs['good_id'])
-                    signal_good = Commodity.commodity_.get(pk=good_id)  # 查询当前商品的单价和打折情况
-                    signal_good_price = signal_good.price
-                    signal_good_discounts = signal_good.discounts
-                    second_key = self.key('Cart', user_id, store_id, 'counts')
-                    third_key = self.key('Cart', user_id, store_id, 'price')
-                    if kwargs['way'] == 'add':
-                        redis.zincrby(second_key, 1, good_id)  # 对id为good_id的商品数量加1,O(1)
-                        redis.zincrby(third_key, float(signal_good_discounts * signal_good_price),
-                                           good_id)  # 对id为good_id的商品数量加上优惠价,O(1)
-                    elif kwargs['way'] == 'minus':
-                        redis.zincrby(second_key, -1, good_id)
-                        redis.zincrby(third_key, -(float(signal_good_discounts * signal_good_price)),
-                                           good_id)
-                    # self.redis.zadd(third_key,
-                    #                 {good_id: float(signal_good_price * signal_good_discounts * int(kwargs['counts']))})
-            except Exception as e:
-                consumer_logger.error(e)
-                return False
-            else:
-                return True
+        if 'store_id' not in kwargs or 'good_id' not in kwargs or kwargs.get('way') not in ('add', 'minus'):
+            return False
+        try:
+            delta = 1 if kwargs['way'] == 'add' else -1
+            counts = self.change_counts(user_id, int(kwargs['store_id']), int(kwargs['good_id']), delta)
+        except Exception as e:
+            consumer_logger.error(e)
+            return False
+        else:
+            return counts != -1  # 该商品不在购物车中则修改失败
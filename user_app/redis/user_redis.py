@@ -7,7 +7,6 @@ from Emall.base_redis import BaseRedis, manager_redis
 from Emall.loggings import Logging
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from django_redis import get_redis_connection
 from rest_framework import serializers
 from shop_app.models.commodity_models import Commodity
 import datetime
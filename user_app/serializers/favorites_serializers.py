@@ -5,6 +5,7 @@
 # @Software: PyCharm
 from Emall.loggings import Logging
 from shop_app.models.commodity_models import Commodity
+from shop_app.serializers.commodity_card_serializers import CommodityCardSerializer
 from user_app.models import Store
 from user_app.models import Collection, Address
 
@@ -16,19 +17,6 @@ consumer_logger = Logging.logger('consumer_')
 
 
 
-class CommoditySerializer(serializers.ModelSerializer):
-
-    class Meta:
-        model = Commodity
-        exclude = ('store', 'shopper', 'onshelve_time', 'unshelve_time')
-
-class StoreSerializer(serializers.ModelSerializer):
-
-    class Meta:
-        model = Store
-        fields = '__all__'
-
-
 class FavoritesSerializer(serializers.ModelSerializer):
     """收藏夹序列化器"""
 
@@ -38,10 +26,6 @@ class FavoritesSerializer(serializers.ModelSerializer):
     # 收藏商品
     commodity_pk = serializers.CharField(required=False, write_only=True)
 
-    commodity = CommoditySerializer(read_only=True)    # 必须和外键名同名
-
-    store = StoreSerializer(read_only=True)
-
 
     def validate(self, attrs):
         if not any([attrs.get('store_pk', None), attrs.get('commodity_pk', None)]):
@@ -63,6 +47,12 @@ class FavoritesSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Collection
-        fields =('pk', 'commodity_pk', 'store_pk', 'commodity', 'store')
+        fields =('pk', 'commodity_pk', 'store_pk')
         read_only_fields = ('commodity_name', 'pk')
 
+
+class FavoritesCardSerializer(CommodityCardSerializer):
+    """收藏夹列表，每条收藏记录为{'pk': 收藏记录pk, 'commodity': 商品卡片}"""
+
+    def to_representation(self, item):
+        return {'pk': item['pk'], 'commodity': super().to_representation(item['commodity'])}
@@ -4,6 +4,7 @@
 # @File : foot_serializers.py
 # @Software: PyCharm
 from shop_app.models.commodity_models import Commodity
+from shop_app.serializers.commodity_card_serializers import CommodityCardSerializer
 from Emall.loggings import Logging
 from rest_framework import serializers
 
@@ -13,15 +14,9 @@ consumer_logger = Logging.logger('consumer_')
 
 
 class FootSerializer(serializers.ModelSerializer):
-    """the serializer of Foot(足迹)"""
+    """the serializer of Foot(足迹)，只用于校验新增的足迹，列表见FootCardSerializer"""
 
     pk = serializers.IntegerField(write_only=True) #  商品 id
-    timestamp = serializers.SerializerMethodField()
-
-    def get_timestamp(self, obj):
-        """为每个足迹追加时间戳"""
-        timestamp_dict = self.context.get('timestamp')
-        return timestamp_dict.get(obj.pk)
 
     def validate_pk(self, value):
         if not Commodity.commodity_.all().exists():
@@ -30,7 +25,13 @@ class FootSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Commodity
-        fields = ('id', 'timestamp', 'commodity_name', 'price', 'intro',
-                  'category', 'status', 'discounts', 'image', 'pk')
-        read_only_fields = (
-            'id', 'commodity_name', 'price', 'intro', 'category', 'status', 'discounts', 'image')
+        fields = ('pk',)
+
+
+class FootCardSerializer(CommodityCardSerializer):
+    """足迹列表，商品卡片附带浏览时间(毫秒时间戳)"""
+
+    def to_representation(self, row):
+        card = super().to_representation(row)
+        card['timestamp'] = row['timestamp']
+        return card
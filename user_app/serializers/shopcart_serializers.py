@@ -3,14 +3,14 @@
 # @Author : 司云中 
 # @File : shopcart_serializers.py
 # @Software: PyCharm
-import datetime
 import json
 
 from rest_framework import serializers
 
 from Emall.loggings import Logging
 from shop_app.models.commodity_models import Commodity
-from user_app.model.seller_models import Store
+from shop_app.redis.commodity_redis import commodity_redis
+from shop_app.serializers.commodity_card_serializers import CommodityCardSerializer
 from user_app.model.trolley_models import Trolley
 
 common_logger = Logging.logger('django')
@@ -18,29 +18,8 @@ common_logger = Logging.logger('django')
 consumer_logger = Logging.logger('consumer_')
 
 
-class CommoditySerializer(serializers.ModelSerializer):
-    price = serializers.SerializerMethodField()
-
-    def get_price(self, obj):
-        """获取打折后的价格"""
-        return obj.price * obj.discounts
-
-    class Meta:
-        model = Commodity
-        fields = ('pk', 'commodity_name', 'price')
-
-
-class StoreSerializer(serializers.ModelSerializer):
-    commodity = CommoditySerializer(many=True, read_only=True)  # 一条trolley中的一个store对应的是多个commodity
-
-    class Meta:
-        model = Store
-        fields = ('pk', 'store_name',)
-
-
 class ShopCartSerializer(serializers.ModelSerializer):
-    store = StoreSerializer(read_only=True)  # 一条trolley记录对应一个store
-
+    """购物车的增删校验，列表见ShopCartCardSerializer"""
     pk_list = serializers.ListField(child=serializers.IntegerField(min_value=1), allow_empty=None, max_length=99999,
                                     write_only=True, required=False)  # 删除的pk列表
 
@@ -98,46 +77,46 @@ class ShopCartSerializer(serializers.ModelSerializer):
     def label_exist(self, obj, label_pk, label_content):
         """
         判断选择是否存在商品的总label中
-        :param obj: Commodity object
+        :param obj: 商品缓存dict
         :param label_pk: 选择标签pk
         :param label_choice: 选择标签content
         :return:
         """
-        labels = json.loads(obj.label)
+        labels = json.loads(obj['label'])
         return True if label_pk in labels and labels[label_pk] == label_content else False
 
-    def compute_price(self, obj, count):
-        """
-        计算商品价格
-        :return:
-        """
-        price = obj.price * obj.discounts
-        return price * count
-
-    def add_trolley(self, validated_data):
-        """添加商品到购物车"""
+    def add_trolley(self, validated_data, redis):
+        """添加商品到购物车，写入redis，由定时任务写回数据库"""
         user = self.context.get('request').user
         provision = validated_data.get('provision')
         commodity_pk = provision.get('pk')
         commodity_count = provision.get('count')
         label = provision.get('label')
-        try:
-            commodity_obj = Commodity.commodity_.select_related('store').get(
-                pk=commodity_pk)  # 这里不计算是否还有库存，结算时再计算是否还有库存
-            is_exist = self.label_exist(commodity_obj, label.pop('pk'), label.pop('content'))
-            if is_exist:
-                price = self.compute_price(commodity_obj, commodity_count)
-                time = datetime.datetime.now()
-                trolley_obj = self.Meta.model.trolley_.create(user=user, commodity=commodity_obj,
-                                                              store=commodity_obj.store,
-                                                              time=time, count=commodity_count, price=price)
-                if trolley_obj:
-                    return True
-            raise serializers.ValidationError({'error': '不存在选择标签'})
-        except Commodity.DoesNotExist:
+        commodity = commodity_redis.get(commodity_pk)  # 这里不计算是否还有库存，结算时再计算是否还有库存
+        if commodity is None:
             return False
+        if not self.label_exist(commodity, label.get('pk'), label.get('content')):
+            raise serializers.ValidationError({'error': '不存在选择标签'})
+        redis.add_commodity(user.pk, commodity['store_id'], commodity['pk'], commodity_count, label.get('content'))
+        return True
 
     class Meta:
         model = Trolley
-        fields = ('pk', 'store', 'time', 'pk_list', 'provision')
-        read_only_fields = ('pk', 'store', 'time')
+        fields = ('pk', 'store', 'commodity', 'count', 'price', 'label', 'time', 'pk_list', 'provision')
+        read_only_fields = ('pk', 'store', 'commodity', 'count', 'price', 'label', 'time')
+
+
+class ShopCartCardSerializer(CommodityCardSerializer):
+    """
+    购物车列表，每一项为{'commodity': 商品卡片row, 'count': 数量, 'label': 选择的标签}
+    price为折后价乘以数量
+    """
+
+    def to_representation(self, item):
+        card = super().to_representation(item['commodity'])
+        return {
+            'commodity': card,
+            'count': item['count'],
+            'label': item['label'],
+            'price': round(card['price'] * item['count'], 2),
+        }
@@ -3,9 +3,15 @@
 # @Author : 司云中
 # @File : tasks.py
 # @Software: PyCharm
+from django.db import DatabaseError
 
+from user_app.model.trolley_models import Trolley
+from user_app.redis.shopcart_redis import ShopCartRedisOperation
 from user_app.views.ali_card_ocr import Interface_identify
 from Emall import celery_apps as app
+from Emall.loggings import Logging
+
+trolley_logger = Logging.logger('trolley_')
 
 
 @app.task
@@ -20,6 +26,29 @@ def ocr(image_instance, type_):
     return identify_instance.is_success
 
 
+@app.task
+def flush_shop_carts(batch_size=500, max_batches=20):
+    """
+    定时将redis中修改过的购物车批量写回Trolley表
+    写回失败的用户重新加入脏集合，下次重试
+    :return: int 写回的用户数量
+    """
+    redis = ShopCartRedisOperation.choice_redis_db('redis')
+    flushed = 0
+    for _ in range(max_batches):
+        user_ids = redis.pop_dirty_users(batch_size)
+        if not user_ids:
+            break
+        try:
+            Trolley.trolley_.sync_carts(redis.get_carts(user_ids))
+        except DatabaseError as e:
+            trolley_logger.error(e)
+            redis.mark_dirty(*user_ids)
+            break
+        flushed += len(user_ids)
+    return flushed
+
+
 # @app.task
 # def add_foot(obj, user_id, validated_data):
 #     """
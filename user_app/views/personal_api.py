@@ -8,7 +8,6 @@ import importlib
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.db.models.query import QuerySet
 from django.http import Http404
 from django.utils.decorators import method_decorator
 from django.views.decorators.cache import cache_page
@@ -22,7 +21,7 @@ from rest_framework.viewsets import GenericViewSet
 from Emall.loggings import Logging
 from Emall.response_code import response_code
 from shop_app.models.commodity_models import Commodity
-from user_app.model.trolley_models import Trolley
+from shop_app.serializers.commodity_card_serializers import CommodityCardSerializer
 from user_app.models import Address, Collection
 from user_app.redis.favorites_redis import favorites_redis
 from user_app.redis.foot_redis import FootRedisOperation
@@ -30,12 +29,12 @@ from user_app.redis.shopcart_redis import ShopCartRedisOperation
 from user_app.redis.user_redis import RedisUserOperation
 from user_app.serializers.address_serializers import AddressSerializers
 from user_app.serializers.bind_email_phone_serializers import BindPhoneOrEmailSerializer
-from user_app.serializers.favorites_serializers import FavoritesSerializer
-from user_app.serializers.foot_serializers import FootSerializer
+from user_app.serializers.favorites_serializers import FavoritesSerializer, FavoritesCardSerializer
+from user_app.serializers.foot_serializers import FootSerializer, FootCardSerializer
 from user_app.serializers.individual_info_serializers import IndividualInfoSerializer, HeadImageSerializer, \
     VerifyIdCardSerializer
 from user_app.serializers.password_serializers import PasswordSerializer
-from user_app.serializers.shopcart_serializers import ShopCartSerializer
+from user_app.serializers.shopcart_serializers import ShopCartSerializer, ShopCartCardSerializer
 from user_app.signals import add_favorites, delete_favorites
 from user_app.utils.pagination import FootResultsSetPagination, FavoritesPagination, TrolleyResultsSetPagination
 
@@ -351,15 +350,20 @@ class FavoriteOperation(GenericViewSet):
 
     serializer_class = FavoritesSerializer  # favorites序列化类
 
+    card_serializer_class = FavoritesCardSerializer  # 收藏夹列表的序列化类
+
     pagination_class = FavoritesPagination
 
     def get_queryset(self):
         """
         先hit缓存数据库，如果过期则重新添加到缓存中，否则直接从缓存中取
-        :return 结果集/异步任务/空列表 QuerySet/AsyncResult/List
+        :return list 收藏记录  [{'pk': 收藏记录pk, 'commodity': 商品卡片row}]，'null'表示空收藏夹
         """
         page_size = FootResultsSetPagination.page_size
-        page = self.request.query_params.get(self.pagination_class.page_query_param, 1)  # 默认使用第一页
+        try:
+            page = max(int(self.request.query_params.get(self.pagination_class.page_query_param, 1)), 1)  # 默认使用第一页
+        except ValueError:
+            page = 1
         resultSet = self.redis.get_resultSet(self.request.user, page=page, page_size=page_size)
         return resultSet
 
@@ -382,41 +386,12 @@ class FavoriteOperation(GenericViewSet):
 
     @method_decorator(cache_page(10 * 1, cache='redis'))
     def list(self, request):
-        """显示收藏夹的商品"""
-
-        queryset = self.get_queryset()
-
-        if isinstance(queryset, QuerySet):  # 命中数据库
-            page = self.paginate_queryset(queryset)
-            if page is not None:
-                serializer = self.get_serializer(page, many=True)
-                return self.get_paginated_response(serializer.data)
-            serializer = self.get_serializer(queryset, many=True)
-            return Response(serializer.data)
-
-        queryset = self.get_queryset()
-        if isinstance(queryset, QuerySet):  # 命中数据库
-            page = self.paginate_queryset(queryset)
-            if page is not None:
-                serializer = self.get_serializer(page, many=True)
-                return self.get_paginated_response(serializer.data)
-            serializer = self.get_serializer(queryset, many=True)
-            return Response(serializer.data)
-        # if isinstance(queryset, AsyncResult):   # 命中缓存
-        #     # 最迟2s获取数据
-        #     limit = 2
-        #     while not queryset.get() or limit:  # 轮循一直有结果才返回get()
-        #         time.sleep(1)
-        #         limit -= 1
-        #     return Response(queryset.get())
-        elif isinstance(queryset, str):  # 命中缓存，读取缓存中的数据
-            # 将redis中的序列化数据格式成分页器
-            return Response({'data': queryset})
-        elif isinstance(queryset, list):  # 缓存为空，数据库也为空，防止缓存击穿
-            return Response({'data': queryset})
-        else:
-            common_logger.info(type(queryset))
-            return Response(response_code.verification_code_error, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        """显示收藏夹的商品，缓存和数据库返回相同格式的收藏记录"""
+        items = self.get_queryset()
+        if items == 'null':  # 缓存为空，数据库也为空，防止缓存击穿
+            return Response({'data': items})
+        serializer = self.card_serializer_class(items, many=True, context=self.get_serializer_context())
+        return Response({'data': serializer.data})
 
     def create_collection(self, type, queryset):
         """
@@ -501,27 +476,28 @@ class FootOperation(GenericViewSet):
 
     serializer_class = FootSerializer  # 序列化器
 
-    def get_serializer_context(self):
-        return {
-            'timestamp': self.get_commodity_dict
-        }
+    card_serializer_class = FootCardSerializer  # 足迹列表的序列化类
 
-    @property
-    def get_commodity_dict(self):
-        """缓存{commodity_pk:timestamp}"""
-        return self.commodity_dict if hasattr(self, 'commodity_dict') else {}
+    def get_cards(self, rows):
+        return self.card_serializer_class(rows, many=True, context=self.get_serializer_context()).data
 
-    def get_queryset(self):
-        """获取足迹固定数量的商品查询集"""
-        page_size = FootResultsSetPagination.page_size
-        page = self.request.query_params.get(self.pagination_class.page_query_param, 1)  # 默认使用第一页
-        # 按照固定顺序查询固定范围内的商品pk列表
-        commodity_dict = self.redis.get_foot_commodity_id_and_page(self.request.user.pk, page=page, page_size=page_size)
-        setattr(self, 'commodity_dict', commodity_dict)
-        ordering = 'FIELD(`id`,{})'.format(','.join((str(pk) for pk in commodity_dict.keys())))
-        return Commodity.commodity_.filter(pk__in=commodity_dict.keys()).extra(select={"ordering": ordering},
-                                                                               order_by=(
-                                                                                   "ordering",)) if commodity_dict else []
+    @action(methods=['get'], detail=False)
+    def days(self, request, *args, **kwargs):
+        """按浏览日期分组显示足迹"""
+        rows = self.redis.get_foot_data(request.user.pk, self.load_foot_data)
+        return Response({'data': {day: self.get_cards(day_rows)
+                                  for day, day_rows in self.redis.group_by_day(rows).items()}})
+
+    def load_foot_data(self):
+        """
+        回源：按浏览时间倒序查询足迹中商品的卡片row，附带浏览时间戳
+        足迹最多100条，一次values()查询，由分页器分页
+        """
+        commodity_dict = self.redis.get_foot_commodity_dict(self.request.user.pk)
+        rows = CommodityCardSerializer.rows_in_order(commodity_dict.keys())
+        for row in rows:
+            row['timestamp'] = commodity_dict[row['pk']]
+        return rows
 
     def create(self, request):
         """单增用户足迹"""
@@ -535,15 +511,14 @@ class FootOperation(GenericViewSet):
     def list(self, request, *args, **kwargs):
         """
         处理某用户固定数量的足迹
+        足迹商品的卡片row缓存在redis中，缓存失效时只有一个请求查询数据库
         """
         try:
-            queryset = self.get_queryset()
-            page = self.paginate_queryset(queryset)
+            rows = self.redis.get_foot_data(request.user.pk, self.load_foot_data)
+            page = self.paginate_queryset(rows)
             if page is not None:
-                serializer = self.get_serializer(page, many=True)
-                return self.get_paginated_response(serializer.data)
-            serializer = self.get_serializer(queryset, many=True)
-            return Response(serializer.data)
+                return self.get_paginated_response(self.get_cards(page))
+            return Response(self.get_cards(rows))
         except Exception as e:
             consumer_logger.error(e)
             return Response(response_code.server_error, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -564,9 +539,10 @@ class FootOperation(GenericViewSet):
 
 
 class ShopCartOperation(GenericViewSet):
-    """购物车的相关操作"""
-
-    model_class = Trolley
+    """
+    购物车的相关操作
+    读写全部走redis，Trolley表由定时任务flush_shop_carts批量同步
+    """
 
     permission_classes = [IsAuthenticated]
 
@@ -574,44 +550,46 @@ class ShopCartOperation(GenericViewSet):
 
     serializer_class = ShopCartSerializer  # 序列化器
 
-    pagination_class = TrolleyResultsSetPagination
+    card_serializer_class = ShopCartCardSerializer  # 购物车列表的序列化类
 
-    def get_model_class(self):
-        return self.model_class
+    pagination_class = TrolleyResultsSetPagination
 
     def get_queryset(self):
-        return self.get_model_class().trolley_.select_related('commodity', 'store').filter(user=self.request.user)
-
-    def get_delete_queryset(self, pk_list):
-        return self.get_model_class().trolley_.filter(user=self.request.user, pk__in=pk_list)
+        """
+        从redis中的购物车和商品卡片row构造购物车列表，一次values()查询
+        按店铺、商品倒序排列
+        """
+        cart = self.redis.get_cart(self.request.user.pk)
+        rows = {row['pk']: row for row in CommodityCardSerializer.rows(
+            Commodity.commodity_.filter(pk__in=[pk for _, pk in cart]))}
+        return [{'commodity': rows[commodity_pk], 'count': counts, 'label': label}
+                for (store_pk, commodity_pk), (counts, label) in sorted(cart.items(), reverse=True)
+                if commodity_pk in rows]
 
     def list(self, request, *args, **kwargs):
         """显示购物车列表"""
 
-        queryset = self.get_queryset()
-        page = self.paginate_queryset(queryset)
+        items = self.get_queryset()
+        page = self.paginate_queryset(items)
+        context = self.get_serializer_context()
         if page is not None:
-            serializer = self.get_serializer(page, many=True)
+            serializer = self.card_serializer_class(page, many=True, context=context)
             return self.get_paginated_response(serializer.data)
-        serializer = self.get_serializer(queryset, many=True)
+        serializer = self.card_serializer_class(items, many=True, context=context)
         return Response(serializer.data)
 
     def destroy(self, request, *args, **kwargs):
-        """单删购物车中的商品"""
-        obj = self.get_object()
-        row_counts, delete_dict = obj.delete()
-        if row_counts:
+        """单删购物车中的商品，pk为商品pk"""
+        if self.redis.delete_commodities(request.user.pk, [int(kwargs.get('pk'))]):
             return Response(response_code.delete_shop_cart_good_success)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
     @action(methods=['delete'], detail=False)
     def destroy_many(self, request, *args, **kwargs):
-        """群删购物车中的商品"""
+        """群删购物车中的商品，pk_list为商品pk列表"""
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
-        queryset = self.get_delete_queryset(serializer.validated_data.get('pk_list'))
-        row_counts, delete_dict = queryset.delete()
-        if row_counts:
+        if self.redis.delete_commodities(request.user.pk, serializer.validated_data.get('pk_list')):
             return Response(response_code.delete_shop_cart_good_success)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
@@ -619,7 +597,7 @@ class ShopCartOperation(GenericViewSet):
         """添加商品到购物车"""
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
-        is_created = serializer.add_trolley(serializer.validated_data)
+        is_created = serializer.add_trolley(serializer.validated_data, self.redis)
         if is_created:
             return Response(response_code.add_goods_into_shop_cart_success)
         return Response(response_code.server_error, status=status.HTTP_500_INTERNAL_SERVER_ERROR)